@@ -0,0 +1,35 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+"""
+Latency of ThreadManager.get_threads_where_participant_is_active as the number of threads of a participant grows.
+The lookup is a single query joining the participations on the (participant, is_active) index, so the time to get the
+first page of threads or to check if the participant is in a thread does not depend on the number of threads.
+"""
+
+from __future__ import print_function, unicode_literals
+from benchmarks.utils import best_of, print_table, setup
+
+
+def run():
+    setup()
+    from rest_messaging.models import Participant, Participation, Thread
+
+    participant = Participant.objects.create(id=1)
+    rows = []
+    created = 0
+    for count in [10, 100, 1000, 10000]:
+        Thread.objects.bulk_create([Thread(name="Thread") for i in range(count - created)])
+        thread_ids = Thread.objects.exclude(participation__participant=participant).values_list('id', flat=True)
+        Participation.objects.bulk_create([Participation(participant=participant, thread_id=thread_id) for thread_id in thread_ids])
+        created = count
+        first_page = best_of(lambda: list(Thread.managers.get_threads_where_participant_is_active(participant.id)[:30]))
+        exists = best_of(lambda: Thread.managers.get_threads_where_participant_is_active(participant.id).filter(id=1).exists())
+        rows.append((count, first_page, exists))
+
+    print_table("get_threads_where_participant_is_active (ms)", ("threads", "first 30", "membership"), rows)
+
+
+if __name__ == "__main__":
+    run()
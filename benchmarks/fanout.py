@@ -0,0 +1,58 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+"""
+Delivering a new message to the participants of a thread: pushed to their WebSocket connections by the Channels groups
+(in-memory channel layer), or found by polling the list of their threads.
+The push costs one group send per message and delivers it at once (push is the time to post the message and to receive it
+on every connection). Polling costs a query per client and per poll, whether or not a message was posted, and the message
+is only found half a polling interval later on average.
+Requires Django Channels 1.x.
+"""
+
+from __future__ import print_function, unicode_literals
+from benchmarks.utils import best_of, print_table, setup
+
+
+def run():
+    setup()
+    from channels import Group, channel_layers
+    from django.test.utils import override_settings
+    from rest_messaging.consumers import get_thread_group_name
+    from rest_messaging.models import Message, Participant, Participation, Thread
+
+    channel_layer = channel_layers['default']
+    poll_interval = 5.0  # seconds, a common polling interval
+    rows = []
+    created = 0
+    for count in [10, 100, 1000]:
+        Participant.objects.bulk_create([Participant(id=i) for i in range(created + 1, count + 1)])
+        created = count
+        participants = list(Participant.objects.all())
+        thread = Thread.objects.create(name="Thread {0}".format(count))
+        Participation.objects.bulk_create([Participation(participant=participant, thread=thread) for participant in participants])
+        reply_channels = ["websocket.send.{0}".format(participant.id) for participant in participants]
+        for name in reply_channels:
+            Group(get_thread_group_name(thread.id)).add(name)
+
+        def push():
+            Message.objects.create(sender=participants[0], thread=thread, body="hi")
+            for name in reply_channels:
+                assert channel_layer.receive_many([name])[0] is not None
+
+        def poll():
+            for participant in participants:
+                list(Message.managers.get_lasts_messages_of_threads(participant.id)[:30])
+
+        with override_settings(REST_MESSAGING_CHANNELS=True):
+            push_time = best_of(push, number=5)
+        poll_time = best_of(poll, number=1)
+        rows.append((count, push_time, poll_time, poll_interval * 1000 / 2 + poll_time))
+        Message.objects.all().delete()
+
+    print_table("Delivering a message to the participants of a thread (ms)", ("participants", "push", "poll round", "poll latency"), rows)
+
+
+if __name__ == "__main__":
+    run()
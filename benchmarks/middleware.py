@@ -0,0 +1,65 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+"""
+Cost of MessagingMiddleware for a view that does not use rest_messaging, with a session authenticated user.
+Resolving the participant eagerly loads request.user (the session and the user) and hits the cache on every request.
+With the lazy participant, the middleware only creates the lazy object, without loading the session or the user (the anonymous
+users are told apart when it is resolved), and it does nothing for the non-messaging views when REST_MESSAGING_MIDDLEWARE_ONLY_FOR_MESSAGING_VIEWS is set.
+"""
+
+from __future__ import print_function, unicode_literals
+from benchmarks.utils import best_of, print_table, setup
+
+
+def run():
+    setup()
+    from django.conf import settings
+    from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+    from django.contrib.auth.middleware import AuthenticationMiddleware
+    from django.contrib.auth.models import User
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.contrib.sessions.middleware import SessionMiddleware
+    from django.test import RequestFactory
+    from django.test.utils import override_settings
+    from rest_messaging.middleware import MessagingMiddleware
+
+    user = User.objects.create(username="User")
+    session = SessionStore()
+    session[SESSION_KEY] = user.pk
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+
+    def other_view(request):
+        return None
+
+    def get_request():
+        request = RequestFactory().get('/other/')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = session.session_key
+        SessionMiddleware().process_request(request)
+        AuthenticationMiddleware().process_request(request)
+        return request
+
+    middleware = MessagingMiddleware()
+
+    def eager():
+        # the participant was resolved by the middleware before it became lazy
+        request = get_request()
+        middleware.process_view(request, other_view, (), {})
+        request.rest_messaging_participant.id
+
+    def lazy():
+        middleware.process_view(get_request(), other_view, (), {})
+
+    rows = [("eager", best_of(eager, number=200)), ("lazy", best_of(lazy, number=200))]
+    with override_settings(REST_MESSAGING_MIDDLEWARE_ONLY_FOR_MESSAGING_VIEWS=True):
+        rows.append(("messaging only", best_of(lazy, number=200)))
+    rows.append(("no middleware", best_of(get_request, number=200)))
+
+    print_table("MessagingMiddleware on a non-messaging view (ms per request)", ("participant", "time"), rows)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,47 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+"""
+Listing the messages of a thread with their readers and notifications: fetched as messages and serialized by ComplexMessageSerializer,
+or fetched as rows (MessageQuerySet.as_rows) and serialized by MessageRowSerializer (REST_MESSAGING_FAST_SERIALIZATION).
+Both times include the queries.
+"""
+
+from __future__ import print_function, unicode_literals
+from benchmarks.utils import best_of, print_table, setup
+
+
+def run():
+    setup()
+    from django.utils.timezone import now, timedelta
+    from rest_messaging.models import Message, NotificationCheck, Participant, Participation, Thread
+    from rest_messaging.serializers import ComplexMessageSerializer, MessageRowSerializer
+
+    participants = [Participant.objects.create(id=i) for i in range(1, 6)]
+    NotificationCheck.objects.create(participant=participants[0], date_check=now() - timedelta(hours=1))
+    rows = []
+    for count in [30, 300, 3000]:
+        thread = Thread.objects.create(name="Thread {0}".format(count))
+        Participation.objects.bulk_create([Participation(participant=participant, thread=thread, date_last_check=now()) for participant in participants])
+        Message.objects.bulk_create([Message(sender=participants[i % 2], thread=thread, body="Message {0}".format(i)) for i in range(count)])
+
+        def messages():
+            return Message.managers.get_all_messages_in_thread(participants[0].id, thread.id).with_notifications(participants[0].id)
+
+        def serializer():
+            return ComplexMessageSerializer(messages(), many=True).data
+
+        def fast():
+            return MessageRowSerializer(messages().as_rows()).data
+
+        assert [dict(message) for message in serializer()] == [dict(message) for message in fast()]
+        serializer_time = best_of(serializer, number=3)
+        fast_time = best_of(fast, number=3)
+        rows.append((count, serializer_time, fast_time, serializer_time / fast_time))
+
+    print_table("Serializing the messages of a thread (ms)", ("messages", "serializer", "rows", "speedup"), rows)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,36 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+"""
+Helpers for the benchmarks.
+The benchmarks use the test settings and an in-memory SQLite database.
+Run them from the project's root, for instance: python -m benchmarks.active_threads
+"""
+
+from __future__ import print_function, unicode_literals
+import os
+import sys
+import timeit
+
+
+def setup():
+    """ Configures django with the test settings and creates the tables. """
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from tests.conftest import pytest_configure
+    pytest_configure()
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def best_of(function, repeat=5, number=20):
+    """ Returns the best time of a call to function, in milliseconds. """
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number * 1000
+
+
+def print_table(title, header, rows):
+    print(title)
+    print(" | ".join(["{0:>14}".format(h) for h in header]))
+    for row in rows:
+        print(" | ".join(["{0:>14.3f}".format(v) if isinstance(v, float) else "{0:>14}".format(v) for v in row]))
+    print("")
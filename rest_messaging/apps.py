@@ -12,6 +12,9 @@ class MessagesAppConfig(AppConfig):
     verbose_name = 'Messages App'
 
     def ready(self):
-        # import signal handlers
-        # from rest_messaging import signals
-        pass  # we use no signal for now
+        # import signal handlers (they invalidate the cached participations of the threads)
+        from rest_messaging import signals  # NOQA
+        # the read state buffer needs a shared cache
+        from django.core import checks
+        from rest_messaging.readstate import check_cache
+        checks.register(check_cache, checks.Tags.caches)
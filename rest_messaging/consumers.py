@@ -0,0 +1,103 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+"""
+WebSocket delivery with Django Channels 1.x (optional, pip install "channels<2").
+The connections of a participant join one group per thread he is active in, the messages and the read watermarks
+of a thread are sent to its group.
+"""
+
+from __future__ import unicode_literals
+from channels import Group
+from channels.generic.websockets import WebsocketConsumer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_messaging.middleware import MessagingMiddleware
+from rest_messaging.models import Thread
+from rest_messaging.serializers import SimpleMessageSerializer
+import json
+
+
+def get_thread_group_name(thread_id):
+    return 'rest_messaging_thread_{0}'.format(thread_id)
+
+
+def get_reply_channels_cache_key(participant_id):
+    return 'rest_messaging_reply_channels_{0}'.format(participant_id)
+
+
+def get_reply_channels(participant_id):
+    """ Returns the reply channels of the connections of the participant. """
+    return cache.get(get_reply_channels_cache_key(participant_id), [])
+
+
+def set_reply_channels(participant_id, reply_channels):
+    # the list is not updated atomically, two connections opened at the same time by a participant may lose one of them,
+    # which then only misses the changes of its threads (joined or left) until it reconnects
+    cache.set(get_reply_channels_cache_key(participant_id), reply_channels, getattr(settings, 'REST_MESSAGING_CHANNELS_TIMEOUT', 24 * 60 * 60))
+
+
+def group_send(thread_id, content):
+    Group(get_thread_group_name(thread_id)).send({'text': json.dumps(content, cls=DjangoJSONEncoder)})
+
+
+class MessagingConsumer(WebsocketConsumer):
+    """
+    Pushes the new messages and the read watermarks of the threads of the participant.
+    The user is authenticated by his session and resolved to a participant as the MessagingMiddleware does it.
+    The anonymous users are rejected.
+    """
+
+    http_user = True
+
+    def get_participant(self):
+        # the message has a user attribute, as the request the middleware resolves
+        return MessagingMiddleware().get_participant(self.message)
+
+    def connection_groups(self, **kwargs):
+        """ The groups of the threads are computed on connect and kept in the channel session for the disconnection. """
+        if self.message.channel.name == 'websocket.connect':
+            participant = self.get_participant()
+            if participant is None:
+                return []
+            thread_ids = [thread.id for thread in Thread.managers.get_threads_where_participant_is_active(participant.id)]
+            self.message.channel_session['rest_messaging_participant_id'] = participant.id
+            self.message.channel_session['rest_messaging_thread_ids'] = thread_ids
+            set_reply_channels(participant.id, get_reply_channels(participant.id) + [self.message.reply_channel.name])
+        return [get_thread_group_name(thread_id) for thread_id in self.message.channel_session.get('rest_messaging_thread_ids', [])]
+
+    def connect(self, message, **kwargs):
+        accept = 'rest_messaging_participant_id' in message.channel_session
+        message.reply_channel.send({'accept': accept} if accept else {'close': True})
+
+    def disconnect(self, message, **kwargs):
+        participant_id = message.channel_session.get('rest_messaging_participant_id', None)
+        if participant_id is not None:
+            set_reply_channels(participant_id, [name for name in get_reply_channels(participant_id) if name != message.reply_channel.name])
+
+
+def send_messages(messages):
+    for message in messages:
+        group_send(message.thread_id, {'type': 'message', 'message': SimpleMessageSerializer(message).data})
+
+
+def send_read_watermark(participation):
+    group_send(participation.thread_id, {
+        'type': 'read',
+        'thread': participation.thread_id,
+        'participant': participation.participant_id,
+        'date_last_check': participation.date_last_check,
+    })
+
+
+def update_thread_groups(thread_id, added_participant_ids=(), removed_participant_ids=()):
+    """ The connections of the participants who joined the thread join its group, those of the participants who left it leave it. """
+    group = Group(get_thread_group_name(thread_id))
+    for participant_id in added_participant_ids:
+        for name in get_reply_channels(participant_id):
+            group.add(name)
+    for participant_id in removed_participant_ids:
+        for name in get_reply_channels(participant_id):
+            group.discard(name)
@@ -0,0 +1,175 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from collections import deque
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import six
+from django.utils.module_loading import import_string
+import threading
+import time
+
+
+class BaseEventBus(object):
+    """
+    Publishes the events of the participants (a message was posted in one of their threads) to the clients waiting for them.
+    The events of each participant are numbered: a client waits for the events after the last cursor it received.
+    Only the last REST_MESSAGING_EVENT_BUS_BACKLOG events of a participant are kept, a client which gets less events than
+    the cursor moved forward has missed some and must reload its inbox.
+    """
+
+    def __init__(self):
+        self.backlog = getattr(settings, 'REST_MESSAGING_EVENT_BUS_BACKLOG', 100)
+
+    def get_cursor(self, participant_id):
+        """ Returns the cursor of the last event published for the participant (0 if there is none). """
+        raise NotImplementedError
+
+    def publish(self, participant_ids, event):
+        """ Publishes the event (a json serializable dict) for each participant. """
+        raise NotImplementedError
+
+    def get_events(self, participant_id, cursor):
+        """ Returns (the new cursor, the events published for the participant after cursor). """
+        raise NotImplementedError
+
+    def wait(self, participant_id, cursor, timeout):
+        """ Waits for the events after cursor, for timeout seconds at most. Returns (the new cursor, the events). """
+        raise NotImplementedError
+
+
+class InProcessEventBus(BaseEventBus):
+    """
+    Keeps the events in memory. The clients are only notified of the messages posted in the same process,
+    so this bus is for the single process deployments and the tests.
+    """
+
+    def __init__(self):
+        super(InProcessEventBus, self).__init__()
+        self._condition = threading.Condition()
+        self._cursors = {}
+        self._events = {}  # participant_id: deque of (cursor, event)
+
+    def get_cursor(self, participant_id):
+        with self._condition:
+            return self._cursors.get(participant_id, 0)
+
+    def publish(self, participant_ids, event):
+        with self._condition:
+            for participant_id in participant_ids:
+                cursor = self._cursors.get(participant_id, 0) + 1
+                self._cursors[participant_id] = cursor
+                self._events.setdefault(participant_id, deque(maxlen=self.backlog)).append((cursor, event))
+            self._condition.notify_all()
+
+    def _get_events(self, participant_id, cursor):
+        return self._cursors.get(participant_id, 0), [event for event_cursor, event in self._events.get(participant_id, ()) if event_cursor > cursor]
+
+    def get_events(self, participant_id, cursor):
+        with self._condition:
+            return self._get_events(participant_id, cursor)
+
+    def wait(self, participant_id, cursor, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            # a cursor ahead of ours comes from a previous process, the client gets ours back
+            while self._cursors.get(participant_id, 0) == cursor:
+                remaining = deadline - time.time()
+                if not remaining > 0:
+                    break
+                self._condition.wait(remaining)
+            return self._get_events(participant_id, cursor)
+
+
+class CacheEventBus(BaseEventBus):
+    """
+    Keeps the events in the Django cache, so the clients are notified of the messages posted by any process.
+    The waiting clients check the cursor of their participant every REST_MESSAGING_EVENT_BUS_POLL_INTERVAL seconds,
+    which is a cache lookup and no database query. The cache must be shared by the processes (memcached, redis).
+    """
+
+    def __init__(self):
+        super(CacheEventBus, self).__init__()
+        self.poll_interval = getattr(settings, 'REST_MESSAGING_EVENT_BUS_POLL_INTERVAL', 0.5)
+        self.timeout = getattr(settings, 'REST_MESSAGING_EVENT_BUS_TIMEOUT', 5 * 60)
+
+    def get_cursor_key(self, participant_id):
+        return 'rest_messaging_events_cursor_{0}'.format(participant_id)
+
+    def get_event_key(self, participant_id, cursor):
+        return 'rest_messaging_events_{0}_{1}'.format(participant_id, cursor)
+
+    def get_cursor(self, participant_id):
+        return cache.get(self.get_cursor_key(participant_id), 0)
+
+    def publish(self, participant_ids, event):
+        events = {}
+        for participant_id in participant_ids:
+            key = self.get_cursor_key(participant_id)
+            # add does nothing if the cursor exists, and incr is atomic on the backends that support it (memcached, redis)
+            cache.add(key, 0, None)
+            try:
+                cursor = cache.incr(key)
+            except ValueError:
+                # the cursor was evicted between the two calls
+                cursor = 1
+                cache.set(key, cursor, None)
+            events[self.get_event_key(participant_id, cursor)] = event
+        cache.set_many(events, self.timeout)
+
+    def get_events(self, participant_id, cursor):
+        current = self.get_cursor(participant_id)
+        cursors = range(max(cursor + 1, current - self.backlog + 1), current + 1)
+        keys = [self.get_event_key(participant_id, event_cursor) for event_cursor in cursors]
+        events = cache.get_many(keys)
+        if len(events) < len(keys):
+            # the publisher increments the cursor before it stores the event, we give it some time
+            time.sleep(self.poll_interval)
+            events = cache.get_many(keys)
+        return current, [events[key] for key in keys if key in events]
+
+    def wait(self, participant_id, cursor, timeout):
+        deadline = time.time() + timeout
+        while self.get_cursor(participant_id) == cursor and time.time() + self.poll_interval <= deadline:
+            time.sleep(self.poll_interval)
+        return self.get_events(participant_id, cursor)
+
+
+_event_buses = {}
+_event_buses_lock = threading.Lock()
+
+
+def get_event_bus():
+    """
+    Returns the event bus of the process, or None if REST_MESSAGING_EVENT_BUS is not set. It may be a class or its dotted path.
+    The bus is created once, the in-process bus must be shared by the requests.
+    """
+    bus_class = getattr(settings, 'REST_MESSAGING_EVENT_BUS', None)
+    if bus_class is None:
+        return None
+    if isinstance(bus_class, six.string_types):
+        bus_class = import_string(bus_class)
+    with _event_buses_lock:
+        if bus_class not in _event_buses:
+            _event_buses[bus_class] = bus_class()
+        return _event_buses[bus_class]
+
+
+def publish_messages(messages):
+    """ Publishes an event for each message to the active participants of its thread (the sender included, for his other clients). """
+    from rest_messaging.models import Thread
+    bus = get_event_bus()
+    if bus is None:
+        return
+    participations = Thread.managers.get_participations(set(message.thread_id for message in messages))
+    for message in messages:
+        participant_ids = [participation.participant_id for participation in participations[message.thread_id] if participation.is_active]
+        bus.publish(participant_ids, {
+            'type': 'message',
+            'thread': message.thread_id,
+            'message': message.id,
+            'sender': message.sender_id,
+            'sent_at': message.sent_at.isoformat() if message.sent_at else None,
+        })
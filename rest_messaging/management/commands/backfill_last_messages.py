@@ -0,0 +1,30 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from django.core.management.base import BaseCommand
+from rest_messaging.models import Thread
+
+
+class Command(BaseCommand):
+    """
+    Fills Thread.last_message and Thread.last_message_at for the existing threads.
+    The threads are updated in batches so the command can run on large tables.
+    """
+    help = 'Sets the last message of every thread.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, dest='batch_size', help='Number of threads updated by each query.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        updated = 0
+        while True:
+            thread_ids = list(Thread.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+            if len(thread_ids) == 0:
+                break
+            updated += Thread.managers.refresh_last_messages(thread_ids)
+            last_id = thread_ids[-1]
+        self.stdout.write('{0} threads updated.'.format(updated))
@@ -0,0 +1,33 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from django.core.management.base import BaseCommand
+from rest_messaging.outbox import drain_outbox
+import time
+
+
+class Command(BaseCommand):
+    """
+    Delivers the events of the outbox to REST_MESSAGING_OUTBOX_HANDLERS, in batches.
+    Without --loop, the command stops when the outbox is empty or a batch fails (run it from cron); with it, it waits for new events.
+    """
+    help = 'Delivers the events of the outbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, dest='batch_size', help='Number of events delivered at once.')
+        parser.add_argument('--loop', action='store_true', default=False, dest='loop', help='Keep waiting for new events.')
+        parser.add_argument('--interval', type=float, default=1.0, dest='interval', help='Seconds between two checks of the outbox, with --loop.')
+
+    def handle(self, *args, **options):
+        delivered = failed = 0
+        while True:
+            batch_delivered, batch_failed = drain_outbox(batch_size=options['batch_size'])
+            delivered += batch_delivered
+            failed += batch_failed
+            if batch_delivered == 0:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write('{0} events delivered, {1} to retry.'.format(delivered, failed))
@@ -0,0 +1,29 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from django.core.management.base import BaseCommand
+from rest_messaging.readstate import flush_read_states
+import time
+
+
+class Command(BaseCommand):
+    """
+    Writes the read state buffered in the cache (REST_MESSAGING_BUFFER_READ_STATE) to the database.
+    Without --loop, the command flushes once (run it from cron); with it, it flushes every --interval seconds.
+    """
+    help = 'Writes the buffered read state to the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, dest='batch_size', help='Number of checks written by each query.')
+        parser.add_argument('--loop', action='store_true', default=False, dest='loop', help='Keep flushing.')
+        parser.add_argument('--interval', type=float, default=5.0, dest='interval', help='Seconds between two flushes, with --loop.')
+
+    def handle(self, *args, **options):
+        while True:
+            participations, notification_checks = flush_read_states(batch_size=options['batch_size'])
+            self.stdout.write('{0} read participations and {1} notification checks flushed.'.format(participations, notification_checks))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,30 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from django.core.management.base import BaseCommand
+from rest_messaging.models import InboxEntry, Thread
+
+
+class Command(BaseCommand):
+    """
+    Creates the inbox entries (REST_MESSAGING_INBOX) of the existing threads, or repairs them.
+    The threads are rebuilt in batches so the command can run on large tables.
+    """
+    help = 'Rebuilds the inbox of every participant.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, dest='batch_size', help='Number of threads rebuilt at once.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        rebuilt = 0
+        while True:
+            thread_ids = list(Thread.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+            if len(thread_ids) == 0:
+                break
+            rebuilt += InboxEntry.managers.rebuild(thread_ids)
+            last_id = thread_ids[-1]
+        self.stdout.write('{0} inbox entries rebuilt.'.format(rebuilt))
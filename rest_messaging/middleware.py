@@ -3,15 +3,76 @@
 # vim: set fileencoding=utf8 :
 
 from __future__ import unicode_literals
+from django.conf import settings
 from django.core.cache import cache
+from django.db import router
+from django.utils.functional import SimpleLazyObject, empty
 from rest_messaging.models import Participant
+from rest_messaging.utils import LRUCache
 
 
 class MessagingMiddleware(object):
     """
-    Ensures we can access request.user as request.rest_messaging_participant in every request.
+    Ensures we can access request.user as request.rest_messaging_participant in every request (None for the other views with
+    REST_MESSAGING_MIDDLEWARE_ONLY_FOR_MESSAGING_VIEWS). It is a lazy object, resolved to None for the anonymous users,
+    unless request.user was already loaded: it is then None for the anonymous users.
+    The id of the participant is cached in the Django cache and, optionally, in a small in-process cache in front of it
+    (REST_MESSAGING_PARTICIPANT_LOCAL_CACHE_SIZE entries, for REST_MESSAGING_PARTICIPANT_LOCAL_CACHE_TTL seconds).
     """
 
+    def __init__(self):
+        local_cache_size = getattr(settings, 'REST_MESSAGING_PARTICIPANT_LOCAL_CACHE_SIZE', 0)
+        self.local_cache = LRUCache(local_cache_size, getattr(settings, 'REST_MESSAGING_PARTICIPANT_LOCAL_CACHE_TTL', 60)) if local_cache_size else None
+        self.shared_cache_hits = 0
+        self.shared_cache_misses = 0
+
+    def get_stats(self):
+        """ Returns the hit and miss counters of the caches, for monitoring. """
+        return {
+            'local_cache_hits': self.local_cache.hits if self.local_cache is not None else 0,
+            'local_cache_misses': self.local_cache.misses if self.local_cache is not None else 0,
+            'shared_cache_hits': self.shared_cache_hits,
+            'shared_cache_misses': self.shared_cache_misses,
+        }
+
+    def get_participant_id(self, user_id):
+        """ Returns the id of the participant of the user, creating the participant if needed. """
+        participant_id = self.local_cache.get(user_id) if self.local_cache is not None else None
+        if participant_id is not None:
+            return participant_id
+
+        cache_key = 'rest_messaging_participant_id_{0}'.format(user_id)
+        participant_id = cache.get(cache_key, None)
+        if participant_id is None:
+            self.shared_cache_misses += 1
+            # get_or_create handles the requests creating the same participant concurrently
+            participant_id = Participant.objects.get_or_create(id=user_id)[0].id
+            cache.set(cache_key, participant_id, 60 * 60)  # cached for 60 minutes
+        else:
+            self.shared_cache_hits += 1
+
+        if self.local_cache is not None:
+            self.local_cache.set(user_id, participant_id)
+        return participant_id
+
+    def get_participant(self, request):
+        """ Returns the participant of request.user, or None if the user is not authenticated. """
+        if not request.user.is_authenticated():
+            return None
+        # a participant only has an id, we do not need to fetch it
+        return Participant.from_db(router.db_for_read(Participant), ['id'], [self.get_participant_id(request.user.id)])
+
+    def is_user_loaded(self, request):
+        """ Checks request.user is not the lazy user of the authentication middleware, or was already loaded. """
+        user = request.user
+        return not isinstance(user, SimpleLazyObject) or user._wrapped is not empty
+
+    def is_messaging_view(self, callback):
+        """ Checks the view is one of the viewsets of the rest_messaging.urls router, or a subclass. """
+        from rest_messaging.urls import router as messaging_router
+        view_class = getattr(callback, 'cls', None)
+        return view_class is not None and any(issubclass(view_class, viewset) for prefix, viewset, base_name in messaging_router.registry)
+
     def process_view(self, request, callback, callback_args, callback_kwargs):
 
         assert hasattr(request, 'user'), (
@@ -19,20 +80,15 @@ class MessagingMiddleware(object):
             "to be installed because request.user must be available."
         )
 
-        if request.user.is_authenticated():
+        if getattr(settings, 'REST_MESSAGING_MIDDLEWARE_ONLY_FOR_MESSAGING_VIEWS', False) and not self.is_messaging_view(callback):
+            request.rest_messaging_participant = None
+            return None
 
-            participant = cache.get('rest_messaging_participant_{0}'.format(request.user.id), None)
-
-            if participant is None:
-                # either we create the participant or we retrieve him
-                try:
-                    participant = Participant.objects.get(id=request.user.id)
-                except:
-                    participant = Participant.objects.create(id=request.user.id)
-                cache.set('rest_messaging_participant_{0}'.format(request.user.id), participant, 60 * 60)  # cached for 60 minutes
+        if self.is_user_loaded(request) and not request.user.is_authenticated():
+            request.rest_messaging_participant = None
         else:
-            participant = None
-
-        request.rest_messaging_participant = participant
+            # the participant is resolved when it is first used (None for the anonymous users), so the views that do not use it
+            # do not load the session and the user
+            request.rest_messaging_participant = SimpleLazyObject(lambda: self.get_participant(request))
 
         return None
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import hashlib
+
+
+def fill_participants_fingerprints(apps, schema_editor):
+    """ Computes the fingerprint of the existing threads where no participant has left. """
+    Thread = apps.get_model('rest_messaging', 'Thread')
+    Participation = apps.get_model('rest_messaging', 'Participation')
+    taken = set()
+
+    def fill(thread_id, participant_ids):
+        canonical = ",".join(["{0}".format(participant_id) for participant_id in sorted(participant_ids)])
+        fingerprint = hashlib.sha1(canonical.encode('utf8')).hexdigest()
+        if fingerprint not in taken:
+            # the oldest thread keeps the fingerprint
+            taken.add(fingerprint)
+            Thread.objects.filter(id=thread_id).update(participants_fingerprint=fingerprint)
+
+    # we stream the participations thread by thread
+    current_thread_id, participant_ids, someone_left = None, set(), False
+    for thread_id, participant_id, date_left in Participation.objects.order_by('thread_id').values_list('thread_id', 'participant_id', 'date_left').iterator():
+        if thread_id != current_thread_id:
+            if current_thread_id is not None and not someone_left:
+                fill(current_thread_id, participant_ids)
+            current_thread_id, participant_ids, someone_left = thread_id, set(), False
+        participant_ids.add(participant_id)
+        someone_left = someone_left or date_left is not None
+    if current_thread_id is not None and not someone_left:
+        fill(current_thread_id, participant_ids)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_messaging', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='participants_fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=40, null=True, unique=True),
+        ),
+        migrations.RunPython(fill_participants_fingerprints, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_is_active(apps, schema_editor):
+    """ The participants who have left are no longer active. """
+    Participation = apps.get_model('rest_messaging', 'Participation')
+    Participation.objects.exclude(date_left=None).update(is_active=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_messaging', '0003_thread_last_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participation',
+            name='is_active',
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.AlterIndexTogether(
+            name='participation',
+            index_together=set([('participant', 'is_active')]),
+        ),
+        migrations.RunPython(fill_is_active, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_messaging', '0004_participation_is_active'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageCountBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.PositiveIntegerField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rest_messaging.Participant')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='messagecountbucket',
+            unique_together=set([('participant', 'bucket')]),
+        ),
+    ]
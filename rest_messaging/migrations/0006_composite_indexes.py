@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+ACTIVE_PARTICIPATION_INDEX = 'rest_messaging_participation_active_uniq'
+
+
+def create_active_participation_index(apps, schema_editor):
+    """ A participant is active at most once in a thread. Only the backends supporting partial indexes get the index. """
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    Participation = apps.get_model('rest_messaging', 'Participation')
+    schema_editor.execute("CREATE UNIQUE INDEX {0} ON {1} ({2}, {3}) WHERE {4} IS NULL".format(
+        schema_editor.quote_name(ACTIVE_PARTICIPATION_INDEX),
+        schema_editor.quote_name(Participation._meta.db_table),
+        schema_editor.quote_name(Participation._meta.get_field('thread').column),
+        schema_editor.quote_name(Participation._meta.get_field('participant').column),
+        schema_editor.quote_name(Participation._meta.get_field('date_left').column),
+    ))
+
+
+def drop_active_participation_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    schema_editor.execute("DROP INDEX {0}".format(schema_editor.quote_name(ACTIVE_PARTICIPATION_INDEX)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_messaging', '0005_message_count_bucket'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('sender', 'sent_at'), ('thread', 'id')]),
+        ),
+        # the composite indexes make the indexes of the foreign keys redundant
+        migrations.AlterField(
+            model_name='message',
+            name='sender',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='rest_messaging.Participant'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='thread',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='rest_messaging.Thread'),
+        ),
+        migrations.RunPython(create_active_participation_index, drop_active_participation_index),
+    ]
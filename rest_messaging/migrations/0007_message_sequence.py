@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Case, Value, When
+import django.utils.timezone
+import importlib
+
+BATCH_SIZE = 500
+
+
+def _update_by_id(queryset, field_name, values):
+    """ Sets the field of the rows to their values, {id: value}, in a single UPDATE. """
+    field = queryset.model._meta.get_field(field_name)
+    queryset.filter(id__in=list(values)).update(**{field_name: Case(
+        *[When(id=row_id, then=Value(value)) for row_id, value in values.items()], output_field=field)})
+
+
+def number_messages(apps, schema_editor):
+    """
+    Numbers the existing messages of each thread by id, and sets the sequence of the threads to their last message.
+    The messages are read and updated by batches of ids (a correlated COUNT(*) is quadratic, and MySQL refuses an UPDATE reading its own table).
+    """
+    Message = apps.get_model('rest_messaging', 'Message')
+    Thread = apps.get_model('rest_messaging', 'Thread')
+    sequences = {}
+    last_id = 0
+    while True:
+        rows = list(Message.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'thread_id')[:BATCH_SIZE])
+        if len(rows) == 0:
+            break
+        numbers = {}
+        for message_id, thread_id in rows:
+            sequences[thread_id] = sequences.get(thread_id, 0) + 1
+            numbers[message_id] = sequences[thread_id]
+        _update_by_id(Message.objects.all(), 'sequence', numbers)
+        last_id = rows[-1][0]
+    thread_ids = sorted(sequences)
+    for start in range(0, len(thread_ids), BATCH_SIZE):
+        _update_by_id(Thread.objects.all(), 'message_sequence', dict((thread_id, sequences[thread_id]) for thread_id in thread_ids[start:start + BATCH_SIZE]))
+
+
+def recreate_active_participation_index(apps, schema_editor):
+    """ SQLite rebuilds the table of the participations to add a column, which drops the partial index of 0006_composite_indexes. """
+    if schema_editor.connection.vendor == 'sqlite':
+        importlib.import_module('rest_messaging.migrations.0006_composite_indexes').create_active_participation_index(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_messaging', '0006_composite_indexes'),
+    ]
+
+    operations = [
+        # when the migration is reverted, the index is recreated after the column is removed
+        migrations.RunPython(migrations.RunPython.noop, recreate_active_participation_index),
+        migrations.AddField(
+            model_name='message',
+            name='sequence',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='message_sequence',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='participation',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(recreate_active_participation_index, migrations.RunPython.noop),
+        migrations.RunPython(number_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_messaging', '0008_outbox_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('snippet', models.CharField(blank=True, max_length=255)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='rest_messaging.Message')),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rest_messaging.Participant')),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rest_messaging.Thread')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='inboxentry',
+            unique_together=set([('participant', 'thread')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='inboxentry',
+            index_together=set([('participant', 'last_message')]),
+        ),
+    ]
@@ -3,12 +3,50 @@
 # vim: set fileencoding=utf8 :
 
 from __future__ import unicode_literals
+from collections import OrderedDict
+from contextlib import contextmanager
 from django.conf import settings
-from django.db import models
-from django.db.models import Count, Max
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, connection, models, router, transaction
+from django.db.models import Case, Count, F, Max, Q, Value, When
+from django.db.models.expressions import RawSQL
 from django.db.models.signals import post_save
+from django.utils import six
 from django.utils.encoding import python_2_unicode_compatible
+from django.utils.six.moves import reduce
 from django.utils.timezone import now, timedelta
+from rest_messaging import readstate
+from rest_messaging.ratelimit import get_daily_limit_backend, get_daily_limit_callback
+from rest_messaging.receipts import ReadReceipts
+from rest_messaging.signals import messages_bulk_created, on_commit, threads_bulk_created, threads_marked_as_read
+import hashlib
+import json
+import operator
+import time
+
+
+def compute_participants_fingerprint(participant_ids):
+    """ Returns a canonical, fixed-length fingerprint of a set of participant ids (the order and duplicates do not matter). """
+    canonical = ",".join(["{0}".format(participant_id) for participant_id in sorted(set(int(participant_id) for participant_id in participant_ids))])
+    return hashlib.sha1(canonical.encode('utf8')).hexdigest()
+
+
+def _new_cache_version():
+    """ Returns a version for a cache key, higher than the versions previously used for it (unless it was incremented more than once per microsecond). """
+    return int(time.time() * 1000000)
+
+
+@contextmanager
+def _no_transaction():
+    yield
+
+
+def _chunks(items, size):
+    """ Splits a list in lists of size items at most (the databases limit the number of parameters of a query). """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 
 @python_2_unicode_compatible
@@ -33,15 +71,9 @@ class ThreadManager(models.Manager):
 
     def get_threads_where_participant_is_active(self, participant_id):
         """ Gets all the threads in which the current participant is involved. The method excludes threads where the participant has left. """
-        participations = Participation.objects.\
-            filter(participant__id=participant_id).\
-            exclude(date_left__lte=now()).\
-            distinct().\
-            select_related('thread')
-
-        return Thread.objects.\
-            filter(id__in=[p.thread.id for p in participations]).\
-            distinct()
+        # a single join driven by the (participant, is_active) index
+        # add_participants never creates two active participations of the same participant in a thread, so the threads are not repeated
+        return Thread.objects.filter(participation__participant__id=participant_id, participation__is_active=True)
 
     def get_active_threads_involving_all_participants(self, *participant_ids):
         """ Gets the threads where the specified participants are active and no one has left. """
@@ -56,6 +88,178 @@ class ThreadManager(models.Manager):
 
         return query.distinct()
 
+    def get_thread_by_participants_fingerprint(self, *participant_ids):
+        """ Gets the thread whose active participants are exactly the specified participants, using the indexed fingerprint. """
+        fingerprint = compute_participants_fingerprint(participant_ids)
+        return Thread.objects.filter(participants_fingerprint=fingerprint).first()
+
+    def get_thread_with_participations(self, thread_id):
+        """
+        Fetches the thread and all its participations in a single query, for the views working on one thread.
+        The participations are cached on the thread, so checking the permissions and the participants does not query again.
+        """
+        participations = list(Participation.objects.filter(thread__id=thread_id).select_related('thread').order_by('id'))
+        if len(participations) == 0:
+            # raises Thread.DoesNotExist if there is no thread
+            thread = Thread.objects.get(id=thread_id)
+        else:
+            thread = participations[0].thread
+        if readstate.is_enabled():
+            readstate.apply_thread_checks(participations)
+        thread.set_participations_cache(participations)
+        return thread
+
+    def _participations_version_key(self, thread_id):
+        return 'rest_messaging_thread_participations_version_{0}'.format(thread_id)
+
+    def _participations_cache_key(self, thread_id, version):
+        return 'rest_messaging_thread_participations_{0}_{1}'.format(thread_id, version)
+
+    def _get_participations_versions(self, thread_ids):
+        keys = dict((self._participations_version_key(thread_id), thread_id) for thread_id in thread_ids)
+        versions = dict((keys[key], version) for key, version in six.iteritems(cache.get_many(list(keys))))
+        for thread_id in thread_ids:
+            if thread_id not in versions:
+                # the version may have been evicted, a new one is not used by any stored participations
+                key = self._participations_version_key(thread_id)
+                version = _new_cache_version()
+                cache.add(key, version, None)
+                versions[thread_id] = cache.get(key, version)
+        return versions
+
+    def get_participations(self, thread_ids):
+        """
+        Returns the participations of the threads, {thread_id: [participations]}, from the cache.
+        The participations of a thread are cached under its version, which invalidate_participations increments:
+        the participations read from the database before an invalidation are stored under the previous version, and never read.
+        """
+        thread_ids = list(set(thread_ids))
+        fields = [field.attname for field in Participation._meta.concrete_fields]
+        versions = self._get_participations_versions(thread_ids)
+        keys = dict((self._participations_cache_key(thread_id, versions[thread_id]), thread_id) for thread_id in thread_ids)
+        rows = dict((keys[key], thread_rows) for key, thread_rows in six.iteritems(cache.get_many(list(keys))))
+        missing = [thread_id for thread_id in thread_ids if thread_id not in rows]
+        if len(missing) > 0:
+            fetched = dict((thread_id, []) for thread_id in missing)
+            for chunk in _chunks(missing, getattr(settings, 'REST_MESSAGING_BULK_BATCH_SIZE', 500)):
+                for row in Participation.objects.filter(thread__id__in=chunk).order_by('id').values_list(*fields):
+                    fetched[row[fields.index('thread_id')]].append(row)
+            timeout = getattr(settings, 'REST_MESSAGING_PARTICIPATIONS_CACHE_TIMEOUT', 60 * 60)
+            uncommitted_thread_ids = self._get_uncommitted_thread_ids()
+            cache.set_many(dict((self._participations_cache_key(thread_id, versions[thread_id]), thread_rows) for thread_id, thread_rows in six.iteritems(fetched) if thread_id not in uncommitted_thread_ids), timeout)
+            rows.update(fetched)
+        db = router.db_for_read(Participation)
+        participations = dict((thread_id, [Participation.from_db(db, fields, row) for row in thread_rows]) for thread_id, thread_rows in six.iteritems(rows))
+        if readstate.is_enabled():
+            # the cached participations hold the checks flushed to the database
+            readstate.apply_thread_checks(participation for thread_participations in participations.values() for participation in thread_participations)
+        return participations
+
+    def mark_threads_as_read(self, participant_id, thread_ids=None, before=None):
+        """
+        Marks the active threads of the participant as read with a single UPDATE, instead of saving each participation.
+        thread_ids limits the threads marked, before marks the messages sent before it only (the default is now).
+        The threads already checked later are left as they are. Returns the ids of the threads marked and their last check.
+        """
+        # a check in the future would mark the messages sent until then as read
+        when = min(before, now()) if before is not None else now()
+        participations = Participation.objects.\
+            filter(participant__id=participant_id, is_active=True).\
+            filter(Q(date_last_check__isnull=True) | Q(date_last_check__lt=when))
+        if thread_ids is not None:
+            participations = participations.filter(thread__id__in=thread_ids)
+        if participations.update(date_last_check=when, updated_at=now()) == 0:
+            return [], when
+        # the participations updated hold the check (MySQL does not return the rows updated)
+        marked_thread_ids = list(Participation.objects.filter(participant__id=participant_id, is_active=True, date_last_check=when).order_by('thread_id').values_list('thread_id', flat=True))
+        InboxEntry.managers.refresh_unread_counts((thread_id, participant_id) for thread_id in marked_thread_ids)
+        Message.managers.clear_unread_totals([participant_id])
+        threads_marked_as_read.send(sender=Thread, participant_id=participant_id, thread_ids=marked_thread_ids, date_last_check=when)
+        return marked_thread_ids, when
+
+    def _get_uncommitted_thread_ids(self):
+        """ The threads whose participations changed in the current transaction, on this connection (see invalidate_participations). """
+        if not connection.in_atomic_block:
+            # the transaction which changed them was rolled back
+            connection.rest_messaging_uncommitted_thread_ids = set()
+        elif not hasattr(connection, 'rest_messaging_uncommitted_thread_ids'):
+            connection.rest_messaging_uncommitted_thread_ids = set()
+        return connection.rest_messaging_uncommitted_thread_ids
+
+    def _increment_participations_versions(self, thread_ids):
+        for thread_id in thread_ids:
+            key = self._participations_version_key(thread_id)
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, _new_cache_version(), None)
+
+    def invalidate_participations(self, thread_ids):
+        """
+        Invalidates the cached participations of the threads, when participants join or leave or read a thread.
+        In a transaction, the other processes may cache the participations of before the change until it is committed:
+        they are invalidated again once it is committed, and the change is not cached by its own transaction meanwhile.
+        """
+        thread_ids = set(thread_ids)
+        self._increment_participations_versions(thread_ids)
+        if connection.in_atomic_block and len(thread_ids) > 0:
+            uncommitted_thread_ids = self._get_uncommitted_thread_ids()
+            uncommitted_thread_ids.update(thread_ids)
+
+            def invalidate():
+                uncommitted_thread_ids.difference_update(thread_ids)
+                self._increment_participations_versions(thread_ids)
+
+            on_commit(invalidate)
+
+    def set_last_message(self, message, message_sequence=None):
+        """
+        Points the thread to the message, unless a more recent message is already the last one.
+        With message_sequence, the sequence of the thread is set by the same UPDATE (see Message.save).
+        """
+        threads = Thread.objects.filter(id=message.thread_id)
+        is_last = Q(last_message__isnull=True) | Q(last_message__lte=message.id)
+        if message_sequence is None:
+            return threads.filter(is_last).update(last_message=message.id, last_message_at=message.sent_at)
+        return threads.update(
+            message_sequence=message_sequence,
+            last_message=Case(When(is_last, then=Value(message.id)), default=F('last_message'), output_field=models.IntegerField()),
+            last_message_at=Case(When(is_last, then=Value(message.sent_at)), default=F('last_message_at'), output_field=models.DateTimeField()))
+
+    def lock_sequence(self, thread_id):
+        """ Returns the sequence of the thread, locked until the end of the transaction (on the databases supporting SELECT ... FOR UPDATE). """
+        return Thread.objects.select_for_update().filter(id=thread_id).values_list('message_sequence', flat=True).get()
+
+    def reserve_sequences(self, counts, batch_size=None):
+        """
+        Reserves counts[thread_id] sequence numbers for the messages posted in each thread, returns the first number of each thread.
+        Must be called in a transaction: the UPDATE locks the threads until the messages are saved.
+        """
+        batch_size = batch_size or getattr(settings, 'REST_MESSAGING_BULK_BATCH_SIZE', 500)
+        threads_by_count = {}
+        for thread_id, count in six.iteritems(counts):
+            threads_by_count.setdefault(count, []).append(thread_id)
+        # a broadcast posts as many messages in each thread, the threads are updated by one statement per count
+        for count, thread_ids in six.iteritems(threads_by_count):
+            for chunk in _chunks(thread_ids, batch_size):
+                Thread.objects.filter(id__in=chunk).update(message_sequence=F('message_sequence') + count)
+        first_sequences = {}
+        for chunk in _chunks(list(counts), batch_size):
+            for thread_id, sequence in Thread.objects.filter(id__in=chunk).values_list('id', 'message_sequence'):
+                first_sequences[thread_id] = sequence - counts[thread_id] + 1
+        return first_sequences
+
+    def refresh_last_messages(self, thread_ids=None):
+        """ Recomputes the last message of the threads (all of them by default) from the messages, in a single UPDATE. """
+        message_table = connection.ops.quote_name(Message._meta.db_table)
+        thread_table = connection.ops.quote_name(Thread._meta.db_table)
+        last_message_id = "SELECT MAX(m.id) FROM {0} m WHERE m.thread_id = {1}.id".format(message_table, thread_table)
+        last_message_at = "SELECT lm.sent_at FROM {0} lm WHERE lm.id = ({1})".format(message_table, last_message_id)
+        threads = Thread.objects.all()
+        if thread_ids is not None:
+            threads = threads.filter(id__in=thread_ids)
+        return threads.update(last_message=RawSQL(last_message_id, []), last_message_at=RawSQL(last_message_at, []))
+
     def get_or_create_thread(self, request, name=None, *participant_ids):
         """
         When a Participant posts a message to other participants without specifying an existing Thread,
@@ -77,24 +281,118 @@ class ThreadManager(models.Manager):
         if len(participant_ids) < 2:
             raise Exception('At least two participants are required.')
 
-        if getattr(settings, "REST_MESSAGING_THREAD_UNIQUE_FOR_ACTIVE_RECIPIENTS", True) is True:
+        unique = getattr(settings, "REST_MESSAGING_THREAD_UNIQUE_FOR_ACTIVE_RECIPIENTS", True) is True
+        if unique:
             # if we limit the number of threads by active participants
             # we ensure a thread is not already running
-            existing_threads = self.get_active_threads_involving_all_participants(*participant_ids)
-            if len(list(existing_threads)) > 0:
-                return existing_threads[0]
+            existing_thread = self.get_thread_by_participants_fingerprint(*participant_ids)
+            if existing_thread is not None:
+                return existing_thread
 
-        # we have no existing Thread or multiple Thread instances are allowed
-        thread = Thread.objects.create(name=name)
+        # the thread and its participants are created together, a thread without participants must not hold the fingerprint
+        with transaction.atomic():
+            if unique:
+                # the fingerprint is unique, so if another request has just opened the same discussion
+                # the insert fails and we return the thread it created
+                fingerprint = compute_participants_fingerprint(participant_ids)
+                try:
+                    with transaction.atomic():
+                        thread = Thread.objects.create(name=name, participants_fingerprint=fingerprint)
+                except IntegrityError:
+                    return Thread.objects.get(participants_fingerprint=fingerprint)
+            else:
+                # multiple Thread instances are allowed
+                thread = Thread.objects.create(name=name)
 
-        # we add the participants
-        thread.add_participants(request, *participant_ids)
+            # we add the participants, the creation is recorded as a single event
+            added = thread._add_participants(request, participant_ids)
+            OutboxEvent.managers.record('thread.created', thread.id, {'thread': thread.id, 'participants': added, 'request_participant': request.rest_messaging_participant.id, 'created_and_add_participants': True})
 
         # we send a signal to say the thread with participants is created
-        post_save.send(Thread, instance=thread, created=True, created_and_add_participants=True, request_participant_id=request.rest_messaging_participant.id)
+        thread.send_participants_changed(request, created=True, created_and_add_participants=True)
 
         return thread
 
+    def get_or_create_threads(self, request, participant_groups, name=None, batch_size=None):
+        """
+        Opens many discussions at once, for instance between a staff account and each of its users.
+        participant_groups is a list of lists of participant ids, the current participant is added to each group.
+        The existing threads are looked up and the missing threads and participations are created with a few queries per batch.
+        Returns the threads, in the order of the groups. threads_bulk_created is sent once instead of post_save for each thread.
+        """
+        batch_size = batch_size or getattr(settings, 'REST_MESSAGING_BULK_BATCH_SIZE', 500)
+        groups = []
+        for participant_ids in participant_groups:
+            participant_ids = list(participant_ids)
+            if request.rest_messaging_participant.id not in participant_ids:
+                participant_ids.append(request.rest_messaging_participant.id)
+            if len(participant_ids) < 2:
+                raise Exception('At least two participants are required.')
+            groups.append(participant_ids)
+
+        unique = getattr(settings, "REST_MESSAGING_THREAD_UNIQUE_FOR_ACTIVE_RECIPIENTS", True) is True
+        threads = {}
+        if unique:
+            # the threads are identified by the fingerprints of the groups, so the same group gets the same thread
+            keys = [compute_participants_fingerprint(participant_ids) for participant_ids in groups]
+            for chunk in _chunks(sorted(set(keys)), batch_size):
+                threads.update((thread.participants_fingerprint, thread) for thread in Thread.objects.filter(participants_fingerprint__in=chunk))
+        else:
+            keys = list(range(len(groups)))
+        missing = OrderedDict((key, participant_ids) for key, participant_ids in zip(keys, groups) if key not in threads)
+        if len(missing) == 0:
+            return [threads[key] for key in keys]
+
+        created = {}
+        with transaction.atomic():
+            if unique:
+                try:
+                    with transaction.atomic():
+                        for chunk in _chunks(list(missing), batch_size):
+                            Thread.objects.bulk_create([Thread(name=name, participants_fingerprint=fingerprint) for fingerprint in chunk])
+                except IntegrityError:
+                    # another request has opened some of the discussions, we create the threads one by one
+                    for fingerprint in list(missing):
+                        try:
+                            with transaction.atomic():
+                                Thread.objects.create(name=name, participants_fingerprint=fingerprint)
+                        except IntegrityError:
+                            threads[fingerprint] = Thread.objects.get(participants_fingerprint=fingerprint)
+                            del missing[fingerprint]
+                # bulk_create does not return the ids on every database, we fetch the threads by their fingerprints
+                for chunk in _chunks(list(missing), batch_size):
+                    created.update((thread.participants_fingerprint, thread) for thread in Thread.objects.filter(participants_fingerprint__in=chunk))
+            else:
+                # multiple Thread instances are allowed, they have no fingerprint to be fetched with
+                for key in missing:
+                    created[key] = Thread.objects.create(name=name)
+
+            # the new threads have no participants yet
+            callback = getattr(settings, 'REST_MESSAGING_ADD_PARTICIPANTS_CALLBACK', None)
+            participations = []
+            participant_ids = set()
+            changed_fingerprints = []
+            events = []
+            for key, group in six.iteritems(missing):
+                thread = created[key]
+                added = callback(request, *group) if callback is not None else Thread._select_participants(group, [])
+                for participant_id in added:
+                    participations.append(Participation(participant_id=participant_id, thread=thread))
+                    participant_ids.add(participant_id)
+                if not unique or compute_participants_fingerprint(added) != thread.participants_fingerprint:
+                    changed_fingerprints.append(thread)
+                events.append((thread.id, {'thread': thread.id, 'participants': list(added), 'request_participant': request.rest_messaging_participant.id}))
+            Participation.objects.bulk_create(participations, batch_size=batch_size)
+            InboxEntry.managers.add_entries(((participation.thread_id, participation.participant_id) for participation in participations), batch_size=batch_size)
+            OutboxEvent.managers.record_many('thread.created', events, batch_size=batch_size)
+            for thread in changed_fingerprints:
+                thread.update_participants_fingerprint()
+
+        Message.managers.clear_unread_totals(participant_ids)
+        threads.update(created)
+        threads_bulk_created.send(Thread, threads=[created[key] for key in missing], request_participant_id=request.rest_messaging_participant.id)
+        return [threads[key] for key in keys]
+
 
 @python_2_unicode_compatible
 class Thread(models.Model):
@@ -103,22 +401,58 @@ class Thread(models.Model):
     """
     name = models.CharField(max_length=255, null=True, blank=True)
     participants = models.ManyToManyField(Participant, through='Participation')
+    # the fingerprint of the participants set, as long as no participant has left the thread
+    participants_fingerprint = models.CharField(max_length=40, null=True, blank=True, unique=True, editable=False)
+    # the last message, maintained when a message is saved
+    last_message = models.ForeignKey('Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+', editable=False)
+    last_message_at = models.DateTimeField(null=True, blank=True, db_index=True, editable=False)
+    # the sequence number of the last message posted in the thread, incremented when a message is posted
+    message_sequence = models.PositiveIntegerField(default=0, editable=False)
     objects = models.Manager()
     managers = ThreadManager()
 
     def __str__(self):
         return self.name if self.name else "Thread {0}".format(self.id)
 
+    def set_participations_cache(self, participations):
+        """ Caches the participations of the thread (see ThreadManager.get_thread_with_participations). """
+        for participation in participations:
+            participation.thread = self
+        self._participations_cache = participations
+
+    def clear_participations_cache(self):
+        self.__dict__.pop('_participations_cache', None)
+
+    def get_participations(self):
+        """ Returns the participations of the thread, cached on the instance and in the Django cache (see ThreadManager.get_participations). """
+        if not hasattr(self, '_participations_cache'):
+            self.set_participations_cache(Thread.managers.get_participations([self.id])[self.id])
+        return self._participations_cache
+
+    def get_participation(self, participant_id):
+        """ Returns the participation of the participant, the active one if he has left and joined again, or None. """
+        participations = sorted([participation for participation in self.get_participations() if participation.participant_id == participant_id], key=lambda participation: participation.is_active)
+        return participations[-1] if participations else None
+
+    def get_participants_ids(self):
+        """ Returns the ids of the participants of the thread, including those who have left. """
+        return list(OrderedDict.fromkeys(participation.participant_id for participation in self.get_participations()))
+
     def is_participant(self, request, *args, **kwargs):
-        """ We ensure request.user is a participant to the thread. """
-        participants = self.participants.all()
-        try:
-            current = Participant.objects.get(id=request.user.id)
-            if current in participants:
-                return current
-        except:
-            pass
-        return False
+        """ We ensure request.user is a participant to the thread. Returns the participant, or False. """
+        # the permissions and the serializers check the same thread several times in a request, we check it once
+        memberships = getattr(request, '_rest_messaging_memberships', None)
+        if memberships is None:
+            memberships = {}
+            setattr(request, '_rest_messaging_memberships', memberships)
+        if self.id not in memberships:
+            participant_id = request.user.id
+            if participant_id is not None and any(participation.participant_id == participant_id for participation in self.get_participations()):
+                # a participant only has an id, we do not need to fetch it
+                memberships[self.id] = Participant.from_db(router.db_for_read(Participant), ['id'], [participant_id])
+            else:
+                memberships[self.id] = False
+        return memberships[self.id]
 
     def add_participants(self, request, *participants_ids):
         """
@@ -126,6 +460,14 @@ class Thread(models.Model):
         By default, a user can add a participant if he himself is a participant.
         A callback can be added in the settings here.
         """
+        with OutboxEvent.managers.atomic():
+            ids = self._add_participants(request, participants_ids)
+            OutboxEvent.managers.record('thread.participants_added', self.id, {'thread': self.id, 'participants': ids, 'request_participant': request.rest_messaging_participant.id, 'created_and_add_participants': True})
+        self.send_participants_changed(request, created=True, created_and_add_participants=True)
+        return ids
+
+    def _add_participants(self, request, participants_ids):
+        """ Adds the participants, without recording the event nor sending post_save (see add_participants and get_or_create_thread). """
         participants_ids_returned_by_callback = getattr(settings, 'REST_MESSAGING_ADD_PARTICIPANTS_CALLBACK', self._limit_participants)(request, *participants_ids)
         participations = []
         ids = []
@@ -134,14 +476,30 @@ class Thread(models.Model):
             ids.append(participant_id)
 
         Participation.objects.bulk_create(participations)
-        post_save.send(Thread, instance=self, created=True, created_and_add_participants=True, request_participant_id=request.rest_messaging_participant.id)
-
+        InboxEntry.managers.add_entries((self.id, participant_id) for participant_id in ids)
+        # bulk_create does not send post_save for the participations
+        Thread.managers.invalidate_participations([self.id])
+        self.clear_participations_cache()
+        Message.managers.clear_unread_totals(ids)
+        self.update_participants_fingerprint()
         return ids
 
+    def send_participants_changed(self, request, **kwargs):
+        """
+        Sends post_save for the thread whose participants changed. With the outbox, the receivers run in the worker instead of the request:
+        rest_messaging.outbox.SignalHandler sends it again from the event recorded with the change.
+        """
+        if not OutboxEvent.managers.is_enabled():
+            post_save.send(Thread, instance=self, request_participant_id=request.rest_messaging_participant.id, **kwargs)
+
     def _limit_participants(self, request, *participants_ids):
         """ By default, we ensure we do not have more than 10 participants. """
-        participants_all = self.participants.all().values_list('id', flat=True)
+        participants_all = self.get_participants_ids()
+        return Thread._select_participants(participants_ids, participants_all)
 
+    @staticmethod
+    def _select_participants(participants_ids, participants_all):
+        """ Selects the participants to add to a thread already involving participants_all (10 participants at most). """
         max = 10 - len(participants_all)
         lst = []
         for index, participant_id in enumerate(participants_ids):
@@ -154,14 +512,49 @@ class Thread(models.Model):
     def remove_participant(self, request, participant):
         removable_participants_ids = self.get_removable_participants_ids(request)
         if participant.id in removable_participants_ids:
-            participation = Participation.objects.get(participant=participant, thread=self, date_left=None)
+            participation = self.get_participation(participant.id)
+            if participation is None or not participation.is_active:
+                raise Participation.DoesNotExist
+            participation.thread = self
+            if participant._state.adding:
+                # the view only knows the id, the participation proves the participant exists
+                participant = Participant.from_db(router.db_for_read(Participant), ['id'], [participation.participant_id])
+            participation.participant = participant
             participation.date_left = now()
-            participation.save()
-            post_save.send(Thread, instance=self, created=False, remove_participant=True, removed_participant=participant, request_participant_id=request.rest_messaging_participant.id)
+            with OutboxEvent.managers.atomic():
+                participation.save()  # this clears the fingerprint
+                OutboxEvent.managers.record('thread.participant_removed', self.id, {'thread': self.id, 'participant': participant.id, 'participation': participation.id, 'request_participant': request.rest_messaging_participant.id, 'remove_participant': True})
+            self.send_participants_changed(request, created=False, remove_participant=True, removed_participant=participant, removed_participation=participation)
             return participation
         else:
             raise Exception('The participant may not be removed.')
 
+    def update_participants_fingerprint(self):
+        """
+        Stores the fingerprint of the participants if no one has left the thread.
+        The fingerprint is left empty if someone has left or if another thread already holds the same participants.
+        """
+        if hasattr(self, '_participations_cache'):
+            participations = [(participation.participant_id, participation.date_left) for participation in self._participations_cache]
+        else:
+            participations = Participation.objects.filter(thread=self).values_list('participant_id', 'date_left')
+        if len(participations) == 0 or any(date_left is not None for participant_id, date_left in participations):
+            fingerprint = None
+        else:
+            fingerprint = compute_participants_fingerprint([participant_id for participant_id, date_left in participations])
+
+        if fingerprint != self.participants_fingerprint:
+            try:
+                with transaction.atomic():
+                    Thread.objects.filter(id=self.id).update(participants_fingerprint=fingerprint)
+            except IntegrityError:
+                # another thread involves the same participants
+                fingerprint = None
+                if self.participants_fingerprint is not None:
+                    Thread.objects.filter(id=self.id).update(participants_fingerprint=None)
+            self.participants_fingerprint = fingerprint
+        return fingerprint
+
     def get_removable_participants_ids(self, request):
         removable_participants_ids = getattr(settings, 'REST_MESSAGING_REMOVE_PARTICIPANTS_CALLBACK', self._can_remove_oneself_only)(request, self)
         return removable_participants_ids
@@ -174,6 +567,24 @@ class Thread(models.Model):
             return []
 
 
+class ParticipationQuerySet(models.QuerySet):
+    """
+    Keeps is_active in sync with date_left when the participations are created or updated in bulk (Participation.save does it for one participation).
+    An update setting date_left with an expression must set is_active too.
+    """
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for participation in objs:
+            participation.is_active = participation.date_left is None
+        return super(ParticipationQuerySet, self).bulk_create(objs, *args, **kwargs)
+
+    def update(self, **kwargs):
+        if 'date_left' in kwargs and 'is_active' not in kwargs and not hasattr(kwargs['date_left'], 'resolve_expression'):
+            kwargs['is_active'] = kwargs['date_left'] is None
+        return super(ParticipationQuerySet, self).update(**kwargs)
+
+
 class Participation(models.Model):
     """
     Links Participant to threads.
@@ -184,36 +595,351 @@ class Participation(models.Model):
     date_joined = models.DateTimeField(auto_now_add=True)
     date_left = models.DateTimeField(null=True, blank=True)
     date_last_check = models.DateTimeField(null=True, blank=True)  # a timestamp to be set when a participant reads a thread
+    is_active = models.BooleanField(default=True, editable=False)  # False once the participant has left, kept in sync with date_left (see ParticipationQuerySet)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)  # the clients sync the participations changed since their last sync
+    objects = ParticipationQuerySet.as_manager()
+
+    class Meta:
+        # a participant is active at most once in a thread: the partial unique index on (thread, participant) is created by migration 0006_composite_indexes
+        index_together = [('participant', 'is_active')]
+
+    def save(self, *args, **kwargs):
+        """ Keeps is_active and the thread's participants fingerprint up to date when the membership changes. """
+        self.is_active = self.date_left is None
+        update_fields = kwargs.get('update_fields', None)
+        if update_fields is not None:
+            extra_fields = (['is_active'] if 'date_left' in update_fields else []) + ['updated_at']
+            kwargs['update_fields'] = update_fields = list(update_fields) + [field for field in extra_fields if field not in update_fields]
+        adding = self._state.adding
+        super(Participation, self).save(*args, **kwargs)
+        # the inbox of the participant
+        if not self.is_active:
+            InboxEntry.managers.remove_entry(self.thread_id, self.participant_id)
+        elif adding:
+            InboxEntry.managers.add_entries([(self.thread_id, self.participant_id)])
+        elif update_fields is None or 'date_last_check' in update_fields:
+            InboxEntry.managers.refresh_unread_counts([(self.thread_id, self.participant_id)])
+        # the unread total of the participant depends on its last check and on its active threads
+        Message.managers.clear_unread_totals([self.participant_id])
+        if update_fields is None or any(field in update_fields for field in ('participant', 'thread', 'date_left')):
+            self.thread.update_participants_fingerprint()
+
+    def mark_as_read(self, when=None):
+        """ The participant has read the thread. With REST_MESSAGING_BUFFER_READ_STATE, the check is buffered in the cache (see rest_messaging.readstate). """
+        self.date_last_check = when or now()
+        if not readstate.is_enabled():
+            self.save(update_fields=['date_last_check'])
+            return
+        readstate.buffer_thread_check(self.thread_id, self.participant_id, self.date_last_check)
+        Message.managers.clear_unread_totals([self.participant_id])
+        # the receivers are told as if the participation was saved (the WebSocket connections receive the read watermark at once)
+        post_save.send(Participation, instance=self, created=False, update_fields=frozenset(['date_last_check']), raw=False, using=router.db_for_write(Participation), buffered=True)
+
+
+class MessageQuerySet(models.QuerySet):
+    """
+    Sets the readers and the notifications of the messages when the queryset is evaluated.
+    Slicing the queryset (ie, paginating it) before it is evaluated restricts the checks to the slice.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MessageQuerySet, self).__init__(*args, **kwargs)
+        self._check_who_read = False
+        self._check_is_notification_for = None
+        self._checks_done = False
+
+    def with_readers(self):
+        """ The messages will get the ids of the participants who read them (see MessageManager.check_who_read). """
+        clone = self._clone()
+        clone._check_who_read = True
+        return clone
+
+    def with_notifications(self, participant_id):
+        """ The messages will say if they require a notification for the participant (see MessageManager.check_is_notification). """
+        clone = self._clone()
+        clone._check_is_notification_for = participant_id
+        return clone
+
+    def as_rows(self):
+        """
+        Returns the messages as dicts of the fields the listings serialize (see rest_messaging.serializers.MessageRowSerializer), without instantiating them.
+        The readers and the notifications are set on the rows as on the messages.
+        """
+        clone = self.values('id', 'body', 'sender', 'thread', 'sent_at')
+        # the participants are only prefetched for the messages
+        clone._prefetch_related_lookups = []
+        return clone
+
+    def _clone(self, *args, **kwargs):
+        clone = super(MessageQuerySet, self)._clone(*args, **kwargs)
+        clone._check_who_read = self._check_who_read
+        clone._check_is_notification_for = self._check_is_notification_for
+        return clone
+
+    def _fetch_all(self):
+        super(MessageQuerySet, self)._fetch_all()
+        if not self._checks_done:
+            self._checks_done = True
+            messages = [m for m in self._result_cache if isinstance(m, Message)]  # not for values_list()
+            rows = [m for m in self._result_cache if isinstance(m, dict)]  # as_rows()
+            if self._check_who_read is True:
+                if len(rows) > 0:
+                    Message.managers.check_who_read_rows(rows)
+                else:
+                    Message.managers.check_who_read(messages)
+            if self._check_is_notification_for is not None:
+                if len(rows) > 0:
+                    Message.managers.check_is_notification_rows(self._check_is_notification_for, rows)
+                else:
+                    Message.managers.check_is_notification(self._check_is_notification_for, messages)
 
 
 class MessageManager(models.Manager):
 
-    def return_daily_messages_count(self, sender):
-        """ Returns the number of messages sent in the last 24 hours so we can ensure the user does not exceed his messaging limits """
-        h24 = now() - timedelta(days=1)
+    def return_daily_messages_count(self, sender, when=None):
+        """
+        Returns the number of messages sent in the 24 hours before when (now by default) so we can ensure the user does not exceed his messaging limits.
+        sender is a participant or its id. The (sender, sent_at) index is scanned (see ratelimit.QueryCountBackend).
+        """
+        h24 = (when or now()) - timedelta(days=1)
         return Message.objects.filter(sender=sender, sent_at__gte=h24).count()
 
+    def get_read_receipts(self, thread_ids):
+        """ Returns the read receipts of the threads, {thread_id: ReadReceipts}. The participations of the threads come from the cache. """
+        # we sort the last checks of each thread once and bisect the messages into them
+        participations = Thread.managers.get_participations(thread_ids)
+        return dict((thread_id, ReadReceipts.from_participations(thread_participations)) for thread_id, thread_participations in six.iteritems(participations))
+
     def check_who_read(self, messages):
         """ Check who read each message. """
-        # we get the corresponding Participation objects
+        receipts = self.get_read_receipts(set(m.thread_id for m in messages))
         for m in messages:
-            readers = []
-            for p in m.thread.participation_set.all():
-                if p.date_last_check is None:
-                    pass
-                elif p.date_last_check > m.sent_at:
-                    # the message has been read
-                    readers.append(p.participant.id)
-            setattr(m, "readers", readers)
+            setattr(m, "readers", receipts[m.thread_id].get_readers(m.sent_at))
 
         return messages
 
-    def check_is_notification(self, participant_id, messages):
-        """ Check if each message requires a notification for the specified participant. """
+    def check_who_read_rows(self, rows):
+        """ check_who_read for the rows of MessageQuerySet.as_rows(). """
+        receipts = self.get_read_receipts(set(row['thread'] for row in rows))
+        for row in rows:
+            row['readers'] = receipts[row['thread']].get_readers(row['sent_at'])
+        return rows
+
+    def get_read_watermarks(self, thread_ids):
+        """
+        Returns the read watermark of each participant of the threads, as an alternative to the readers of each message.
+        A participant has read the messages whose id is lower than or equal to his last_read_message_id (None if he has read nothing).
+        """
+        # the last message sent before the last check of each participation, found by scanning the (thread, id) index backwards
+        last_read = "SELECT m.id FROM {0} m WHERE m.thread_id = {1}.thread_id AND m.sent_at < {1}.date_last_check ORDER BY m.id DESC LIMIT 1".format(
+            connection.ops.quote_name(Message._meta.db_table), connection.ops.quote_name(Participation._meta.db_table))
+        participations = Participation.objects.\
+            filter(thread__id__in=thread_ids).\
+            annotate(last_read_message_id=RawSQL(last_read, [])).\
+            order_by('thread_id', 'participant_id').\
+            values_list('thread_id', 'participant_id', 'date_last_check', 'last_read_message_id')
+        participations = list(participations)
+        if readstate.is_enabled():
+            checks = readstate.get_thread_checks([(thread_id, participant_id) for thread_id, participant_id, date_last_check, message_id in participations])
+            for index, (thread_id, participant_id, date_last_check, message_id) in enumerate(participations):
+                when = checks.get((thread_id, participant_id), None)
+                if when is not None and (date_last_check is None or date_last_check < when):
+                    # the checks not flushed yet
+                    message_id = Message.objects.filter(thread__id=thread_id, sent_at__lt=when).order_by('-id').values_list('id', flat=True).first()
+                    participations[index] = (thread_id, participant_id, when, message_id)
+        return [{
+            'thread': thread_id,
+            'participant': participant_id,
+            'last_read_message_id': message_id,
+            'date_last_check': date_last_check,
+        } for thread_id, participant_id, date_last_check, message_id in participations]
+
+    def get_changes(self, participant_id, after_message_id=None, changed_since=None, limit=None, page_after_id=None):
+        """
+        Returns what changed in the threads of the participant since his last sync, as (messages, has_more, participations, notification_check):
+        the messages posted after after_message_id in his active threads (limit at most, by id, after page_after_id for the next pages),
+        the participations of his threads changed since changed_since (his own included, he learns when he was removed from a thread)
+        and his notification check. Without after_message_id, no message is returned: the client has just loaded the threads.
+        A change committed after a later one (a message with a lower id, a participation updated before changed_since) would be missed:
+        the changes of the REST_MESSAGING_SYNC_OVERLAP seconds before changed_since are returned again, the clients dedupe them by id.
+        """
+        limit = limit or getattr(settings, 'REST_MESSAGING_SYNC_LIMIT', 100)
+        if changed_since is not None:
+            changed_since = changed_since - timedelta(seconds=getattr(settings, 'REST_MESSAGING_SYNC_OVERLAP', 60))
+        active_thread_ids = Participation.objects.filter(participant__id=participant_id, is_active=True).values('thread_id')
+        messages = []
+        if after_message_id is not None:
+            # the messages are ranges of the (thread, id) index
+            messages = Message.objects.filter(thread__id__in=active_thread_ids)
+            if changed_since is not None:
+                messages = messages.filter(Q(id__gt=after_message_id) | Q(sent_at__gte=changed_since))
+            else:
+                messages = messages.filter(id__gt=after_message_id)
+            if page_after_id is not None:
+                messages = messages.filter(id__gt=page_after_id)
+            messages = list(messages.order_by('id')[:limit + 1])
+        participations = Participation.objects.filter(Q(thread__id__in=active_thread_ids) | Q(participant__id=participant_id))
+        notification_check = NotificationCheck.objects.filter(participant__id=participant_id)
+        if changed_since is not None:
+            participations = participations.filter(updated_at__gte=changed_since)
+            notification_check = notification_check.filter(date_check__gte=changed_since)
+        participations = list(participations.order_by('updated_at', 'id'))
+        notification_check = notification_check.first()
+        if readstate.is_enabled():
+            # the checks not flushed yet are sent with the participations changed since, and again once flushed
+            readstate.apply_thread_checks(participations)
+            when = readstate.get_notification_check(participant_id)
+            if when is not None and (changed_since is None or when >= changed_since):
+                if notification_check is None:
+                    notification_check = NotificationCheck(participant_id=participant_id, date_check=when)
+                elif notification_check.date_check < when:
+                    notification_check.date_check = when
+        return messages[:limit], len(messages) > limit, participations, notification_check
+
+    def get_last_message_id(self, participant_id):
+        """ Returns the id of the last message of the active threads of the participant. """
+        return Thread.objects.filter(participation__participant__id=participant_id, participation__is_active=True).aggregate(last_message_id=Max('last_message'))['last_message_id'] or 0
+
+    def get_unread_counts(self, participant_id):
+        """
+        Returns the number of unread messages in each active thread of the participant, as a dict {thread id: count}.
+        A message is unread if it was sent by someone else after the participant's last check. Threads without unread messages are omitted.
+        """
+        # a single grouped query, the conditions on the participation share the same join
+        counts = Message.objects.\
+            filter(
+                Q(thread__participation__date_last_check__isnull=True) | Q(sent_at__gt=F('thread__participation__date_last_check')),
+                thread__participation__participant__id=participant_id,
+                thread__participation__is_active=True).\
+            exclude(sender__id=participant_id).\
+            order_by().\
+            values_list('thread_id').\
+            annotate(count=Count('id'))
+        counts = dict(counts)
+        if readstate.is_enabled() and len(counts) > 0:
+            # the threads read since the last flush are counted again from their buffered checks
+            checks = readstate.get_thread_checks([(thread_id, participant_id) for thread_id in counts])
+            if len(checks) > 0:
+                for thread_id, check_participant_id in checks:
+                    counts.pop(thread_id)
+                counts.update(self.count_unread_messages(participant_id, dict((thread_id, when) for (thread_id, check_participant_id), when in six.iteritems(checks))))
+        return counts
+
+    def count_unread_messages(self, participant_id, checks):
+        """ Returns the number of messages sent by the others after the participant's checks of the threads ({thread id: date}), as {thread id: count}. """
+        if len(checks) == 0:
+            return {}
+        counts = Message.objects.\
+            filter(reduce(operator.or_, [Q(thread__id=thread_id, sent_at__gt=when) for thread_id, when in six.iteritems(checks)])).\
+            exclude(sender__id=participant_id).\
+            order_by().\
+            values_list('thread_id').\
+            annotate(count=Count('id'))
+        return dict(counts)
+
+    def _unread_total_cache_key(self, participant_id):
+        return 'rest_messaging_unread_total_{0}'.format(participant_id)
+
+    def get_unread_total(self, participant_id):
+        """ Returns the number of unread messages of the participant in all his active threads, from the cache if possible. """
+        key = self._unread_total_cache_key(participant_id)
+        total = cache.get(key, None)
+        if total is None:
+            total = sum(self.get_unread_counts(participant_id).values())
+            self.set_unread_total(participant_id, total)
+        return total
+
+    def set_unread_total(self, participant_id, total):
+        cache.set(self._unread_total_cache_key(participant_id), total, getattr(settings, 'REST_MESSAGING_UNREAD_TOTAL_CACHE_TIMEOUT', 60 * 60))
+
+    def clear_unread_totals(self, participant_ids):
+        """ Clears the cached totals of the participants, because they have new messages or because they read a thread. """
+        cache.delete_many([self._unread_total_cache_key(participant_id) for participant_id in participant_ids])
+
+    def bulk_post_messages(self, sender_id, messages, batch_size=None):
+        """
+        Posts many messages of a participant at once. messages is an iterable of (thread_id, body) tuples.
+        The participations and the daily limit are checked for the whole set, the messages are inserted by batches
+        and messages_bulk_created is sent once.
+        """
+        messages = [Message(sender_id=sender_id, thread_id=thread_id, body=body) for thread_id, body in messages]
+        if len(messages) == 0:
+            return messages
+        batch_size = batch_size or getattr(settings, 'REST_MESSAGING_BULK_BATCH_SIZE', 500)
+        thread_ids = sorted(set(message.thread_id for message in messages))
+        # the sender must be active in all the threads
+        active_thread_ids = set()
+        for chunk in _chunks(thread_ids, batch_size):
+            active_thread_ids.update(Participation.objects.filter(participant__id=sender_id, thread__id__in=chunk, is_active=True).values_list('thread_id', flat=True))
+        if len(active_thread_ids) < len(thread_ids):
+            raise PermissionDenied('The sender does not participate in all the threads.')
+        # the limit may depend on the thread or on the recipients, the callback is asked for each message
+        callback = get_daily_limit_callback()
+        limits = [callback(message) for message in messages] if callback is not None else []
+        backend = get_daily_limit_backend()
+        if any(max_messages is not None for max_messages in limits):
+            count = backend.get_count(sender_id)
+            # each message is checked as if the messages before it had been saved one by one
+            if any(max_messages is not None and count + index >= max_messages for index, max_messages in enumerate(limits)):
+                raise Exception('The daily messaging limit would be exceeded by these messages')
+        with transaction.atomic():
+            counts = {}
+            for message in messages:
+                counts[message.thread_id] = counts.get(message.thread_id, 0) + 1
+            first_sequences = Thread.managers.reserve_sequences(counts, batch_size)
+            sequences = dict(first_sequences)
+            for message in messages:
+                message.sequence = sequences[message.thread_id]
+                sequences[message.thread_id] += 1
+            Message.objects.bulk_create(messages, batch_size=batch_size)
+            if any(message.id is None for message in messages):
+                # bulk_create does not set the ids on every database, the messages are found by their sequences
+                ids = {}
+                for chunk in _chunks(thread_ids, batch_size):
+                    ranges = [Q(thread__id=thread_id, sequence__gte=first_sequences[thread_id], sequence__lt=sequences[thread_id]) for thread_id in chunk]
+                    ids.update(((thread_id, sequence), message_id) for thread_id, sequence, message_id in Message.objects.filter(reduce(operator.or_, ranges)).values_list('thread_id', 'sequence', 'id'))
+                for message in messages:
+                    message.id = ids[(message.thread_id, message.sequence)]
+            for chunk in _chunks(thread_ids, batch_size):
+                Thread.managers.refresh_last_messages(chunk)
+            InboxEntry.managers.add_messages(counts, sender_id, batch_size)
+            OutboxEvent.managers.record_many('message.created', [(message.thread_id, message.get_event_payload()) for message in messages], batch_size=batch_size)
+        if callback is not None:
+            backend.increment(sender_id, count=len(messages))
+        # the other participants have new messages
+        for chunk in _chunks(thread_ids, batch_size):
+            self.clear_unread_totals(Participation.objects.filter(thread__id__in=chunk, is_active=True).exclude(participant__id=sender_id).values_list('participant_id', flat=True).distinct())
+        messages_bulk_created.send(sender=Message, participant_id=sender_id, messages=messages, thread_ids=thread_ids)
+        return messages
+
+    def broadcast(self, sender_id, body, thread_ids, batch_size=None):
+        """ Posts the same message to many threads (announcements). """
+        return self.bulk_post_messages(sender_id, [(thread_id, body) for thread_id in thread_ids], batch_size=batch_size)
+
+    def get_last_notification_check(self, participant_id):
+        """ Returns when the participant last checked his notifications, or None. """
         try:
-            # we get the last check
             last_check = NotificationCheck.objects.filter(participant__id=participant_id).latest('id').date_check
         except Exception:
+            last_check = None
+        if readstate.is_enabled():
+            when = readstate.get_notification_check(participant_id)
+            if when is not None and (last_check is None or last_check < when):
+                last_check = when
+        return last_check
+
+    def check_is_notification_rows(self, participant_id, rows):
+        """ check_is_notification for the rows of MessageQuerySet.as_rows(). """
+        last_check = self.get_last_notification_check(participant_id)
+        for row in rows:
+            row['is_notification'] = last_check is None or (row['sent_at'] > last_check and row['sender'] != participant_id)
+        return rows
+
+    def check_is_notification(self, participant_id, messages):
+        """ Check if each message requires a notification for the specified participant. """
+        # we get the last check
+        last_check = self.get_last_notification_check(participant_id)
+        if last_check is None:
             # we have no notification check
             # all the messages are considered as new
             for m in messages:
@@ -228,38 +954,36 @@ class MessageManager(models.Manager):
         return messages
 
     def get_lasts_messages_of_threads(self, participant_id, check_who_read=True, check_is_notification=True):
-        """ Returns the last message in each thread """
-        # we get the last message for each thread
-        # we must query the messages using two queries because only Postgres supports .order_by('thread', '-sent_at').distinct('thread')
-        threads = Thread.managers.\
-            get_threads_where_participant_is_active(participant_id).\
-            annotate(last_message_id=Max('message__id'))
-        messages = Message.objects.filter(id__in=[thread.last_message_id for thread in threads]).\
-            order_by('-id').\
-            distinct().\
+        """
+        Returns the last message in each thread, the most recently active thread first.
+        The readers and the notifications are set when the queryset is evaluated, so only for the page if it is paginated.
+        """
+        # the threads point to their last message, so we need no aggregation
+        threads = Thread.managers.get_threads_where_participant_is_active(participant_id)
+        messages = Message.objects.filter(id__in=threads.values('last_message')).\
+            order_by('-thread__last_message_at', '-id').\
             select_related('thread', 'sender')
 
         if check_who_read is True:
-            messages = messages.prefetch_related('thread__participation_set', 'thread__participation_set__participant')
-            messages = self.check_who_read(messages)
+            messages = messages.with_readers()
         else:
             messages = messages.prefetch_related('thread__participants')
 
         if check_is_notification is True:
-            messages = self.check_is_notification(participant_id, messages)
+            messages = messages.with_notifications(participant_id)
         return messages
 
     def get_all_messages_in_thread(self, participant_id, thread_id, check_who_read=True):
-        """ Returns all the messages in a thread. """
+        """ Returns all the messages in a thread. The readers are set when the queryset is evaluated, so only for the page if it is paginated. """
         try:
             messages = Message.objects.filter(thread__id=thread_id).\
                 order_by('-id').\
-                select_related('thread').\
-                prefetch_related('thread__participation_set', 'thread__participation_set__participant')
+                select_related('thread')
         except Exception:
             return Message.objects.none()
 
-        messages = self.check_who_read(messages)
+        if check_who_read is True:
+            messages = messages.with_readers()
         return messages
 
 
@@ -270,24 +994,64 @@ class Message(models.Model):
     """
 
     body = models.TextField(null=False)
-    sender = models.ForeignKey(Participant, null=False)
-    thread = models.ForeignKey(Thread)
+    # the composite indexes of Meta.index_together start with these columns
+    sender = models.ForeignKey(Participant, null=False, db_index=False)
+    thread = models.ForeignKey(Thread, db_index=False)
     sent_at = models.DateTimeField(auto_now_add=True, blank=True)
-    objects = models.Manager()
+    # the messages of a thread are numbered from 1, without gaps, so the clients can tell if they missed some
+    sequence = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    objects = MessageQuerySet.as_manager()
     managers = MessageManager()
 
+    class Meta:
+        # the messages of a thread are listed by id, and the daily limit counts the messages of a sender by date
+        index_together = [('thread', 'id'), ('sender', 'sent_at')]
+
     def __str__(self):
         return "{0}: {1}".format(self.sender, "{0}".format(self.body[:15]))
 
     def save(self, *args, **kwargs):
         """ Checks if there is a daily limit to the number of messages that can be sent. """
-        max_messages = getattr(settings, 'REST_MESSAGING_DAILY_LIMIT_CALLBACK', lambda message_instance, *args, **kwargs: None)(self, *args, **kwargs)
-        if max_messages is None or Message.managers.return_daily_messages_count(self.sender) < max_messages:
-            super(Message, self).save(*args, **kwargs)
+        callback = get_daily_limit_callback()
+        max_messages = callback(self, *args, **kwargs) if callback is not None else None
+        backend = get_daily_limit_backend()
+        if max_messages is None or backend.get_count(self.sender_id) < max_messages:
+            created = self.pk is None
+            # without savepoint: the message, the thread and the events are saved or rolled back with the enclosing transaction
+            with transaction.atomic(savepoint=False):
+                if created and self.sequence is None:
+                    # the thread is locked until the message is saved, then its sequence and last message are set by a single UPDATE
+                    self.sequence = Thread.managers.lock_sequence(self.thread_id) + 1
+                    super(Message, self).save(*args, **kwargs)
+                    Thread.managers.set_last_message(self, message_sequence=self.sequence)
+                else:
+                    super(Message, self).save(*args, **kwargs)
+                    Thread.managers.set_last_message(self)
+                if created:
+                    InboxEntry.managers.add_messages({self.thread_id: 1}, self.sender_id)
+                    OutboxEvent.managers.record('message.created', self.thread_id, self.get_event_payload())
+            if created:
+                if callback is not None:
+                    # the messages are only counted when they are limited
+                    backend.increment(self.sender_id)
+                # the other participants have one more unread message (the participations are usually cached)
+                participations = Thread.managers.get_participations([self.thread_id])[self.thread_id]
+                Message.managers.clear_unread_totals([participation.participant_id for participation in participations if participation.is_active and participation.participant_id != self.sender_id])
         else:
             # participant cannot write anymore today
             raise Exception('The daily messaging limit has been reached for this sender')
 
+    def get_event_payload(self):
+        return {'message': self.id, 'thread': self.thread_id, 'sequence': self.sequence, 'sender': self.sender_id, 'sent_at': self.sent_at}
+
+    def delete(self, *args, **kwargs):
+        """ Points the thread to its previous message if the last one is deleted. """
+        with transaction.atomic():
+            super(Message, self).delete(*args, **kwargs)
+            Thread.managers.refresh_last_messages([self.thread_id])
+            if InboxEntry.managers.is_enabled():
+                InboxEntry.managers.refresh([self.thread_id])
+
 
 @python_2_unicode_compatible
 class NotificationCheck(models.Model):
@@ -299,3 +1063,215 @@ class NotificationCheck(models.Model):
 
     def __str__(self):
         return "{0}: {1}".format(self.participant, self.date_check)
+
+
+@python_2_unicode_compatible
+class MessageCountBucket(models.Model):
+    """
+    The number of messages sent by a participant during an hour, for the daily limit (see rest_messaging.ratelimit.DatabaseSlidingWindowBackend).
+    """
+    participant = models.ForeignKey(Participant)
+    bucket = models.PositiveIntegerField()  # hours since the epoch
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('participant', 'bucket')
+
+    def __str__(self):
+        return "{0}: {1}".format(self.participant, self.count)
+
+
+class InboxEntryManager(models.Manager):
+
+    def is_enabled(self):
+        return getattr(settings, 'REST_MESSAGING_INBOX', False)
+
+    def _sql(self):
+        """ The subqueries computing the columns of an entry from its thread, its last message and its participation. """
+        tables = dict(
+            inbox=connection.ops.quote_name(InboxEntry._meta.db_table),
+            thread=connection.ops.quote_name(Thread._meta.db_table),
+            message=connection.ops.quote_name(Message._meta.db_table),
+            participation=connection.ops.quote_name(Participation._meta.db_table))
+        return {
+            'last_message': RawSQL("SELECT t.last_message_id FROM {thread} t WHERE t.id = {inbox}.thread_id".format(**tables), []),
+            'last_message_at': RawSQL("SELECT t.last_message_at FROM {thread} t WHERE t.id = {inbox}.thread_id".format(**tables), []),
+            'snippet': RawSQL("COALESCE((SELECT SUBSTR(m.body, 1, %s) FROM {message} m, {thread} t WHERE t.id = {inbox}.thread_id AND m.id = t.last_message_id), '')".format(**tables), [InboxEntry.snippet_length()]),
+            'unread_count': RawSQL(
+                "SELECT COUNT(*) FROM {participation} p, {message} m WHERE p.thread_id = {inbox}.thread_id AND p.participant_id = {inbox}.participant_id AND p.is_active = %s "
+                "AND m.thread_id = p.thread_id AND m.sender_id <> p.participant_id AND (p.date_last_check IS NULL OR m.sent_at > p.date_last_check)".format(**tables), [True]),
+        }
+
+    def refresh(self, thread_ids=None, participant_ids=None):
+        """ Recomputes the entries (all of them by default) from the threads and the participations, in a single UPDATE. """
+        entries = InboxEntry.objects.all()
+        if thread_ids is not None:
+            entries = entries.filter(thread__id__in=thread_ids)
+        if participant_ids is not None:
+            entries = entries.filter(participant__id__in=participant_ids)
+        return entries.update(updated_at=now(), **self._sql())
+
+    def refresh_unread_counts(self, pairs, batch_size=None):
+        """ The participants read the threads. pairs is an iterable of (thread_id, participant_id) tuples. """
+        if not self.is_enabled():
+            return
+        batch_size = batch_size or getattr(settings, 'REST_MESSAGING_BULK_BATCH_SIZE', 500)
+        unread_count = self._sql()['unread_count']
+        for chunk in _chunks(sorted(set(pairs)), batch_size):
+            InboxEntry.objects.filter(reduce(operator.or_, [Q(thread__id=thread_id, participant__id=participant_id) for thread_id, participant_id in chunk])).update(unread_count=unread_count, updated_at=now())
+
+    def add_entries(self, pairs, batch_size=None):
+        """ The participants joined the threads. pairs is an iterable of (thread_id, participant_id) tuples. """
+        if not self.is_enabled():
+            return
+        pairs = list(pairs)
+        batch_size = batch_size or getattr(settings, 'REST_MESSAGING_BULK_BATCH_SIZE', 500)
+        for chunk in _chunks(pairs, batch_size):
+            thread_ids = set(thread_id for thread_id, participant_id in chunk)
+            participant_ids = set(participant_id for thread_id, participant_id in chunk)
+            # a participant who left and joined again may still have an entry
+            existing = set(InboxEntry.objects.filter(thread__id__in=thread_ids, participant__id__in=participant_ids).values_list('thread_id', 'participant_id'))
+            InboxEntry.objects.bulk_create([InboxEntry(thread_id=thread_id, participant_id=participant_id) for thread_id, participant_id in set(chunk) if (thread_id, participant_id) not in existing])
+            self.refresh(thread_ids, participant_ids)
+
+    def remove_entry(self, thread_id, participant_id):
+        """ The participant left the thread. """
+        if self.is_enabled():
+            InboxEntry.objects.filter(thread__id=thread_id, participant__id=participant_id).delete()
+
+    def add_messages(self, counts, sender_id, batch_size=None):
+        """
+        The sender posted counts[thread_id] messages in each thread, the last message of the threads is already set.
+        The entries of the other participants get as many more unread messages, with one UPDATE per distinct count.
+        """
+        if not self.is_enabled():
+            return
+        batch_size = batch_size or getattr(settings, 'REST_MESSAGING_BULK_BATCH_SIZE', 500)
+        sql = self._sql()
+        threads_by_count = {}
+        for thread_id, count in six.iteritems(counts):
+            threads_by_count.setdefault(count, []).append(thread_id)
+        for count, thread_ids in six.iteritems(threads_by_count):
+            unread_count = F('unread_count') + Case(When(participant_id=sender_id, then=Value(0)), default=Value(count), output_field=models.IntegerField())
+            for chunk in _chunks(sorted(thread_ids), batch_size):
+                InboxEntry.objects.filter(thread__id__in=chunk).update(last_message=sql['last_message'], last_message_at=sql['last_message_at'], snippet=sql['snippet'], unread_count=unread_count, updated_at=now())
+
+    def rebuild(self, thread_ids):
+        """ Creates the missing entries of the active participants of the threads, deletes the others and recomputes them. """
+        active = set(Participation.objects.filter(thread__id__in=thread_ids, is_active=True).values_list('thread_id', 'participant_id'))
+        existing = set(InboxEntry.objects.filter(thread__id__in=thread_ids).values_list('thread_id', 'participant_id'))
+        if len(existing - active) > 0:
+            InboxEntry.objects.filter(reduce(operator.or_, [Q(thread__id=thread_id, participant__id=participant_id) for thread_id, participant_id in existing - active])).delete()
+        InboxEntry.objects.bulk_create([InboxEntry(thread_id=thread_id, participant_id=participant_id) for thread_id, participant_id in active - existing])
+        return self.refresh(thread_ids)
+
+    def get_inbox(self, participant_id):
+        """ Returns the entries of the threads of the participant with messages, the most recently active thread first (a range of the (participant, last_message) index). """
+        return InboxEntry.objects.filter(participant__id=participant_id, last_message__isnull=False).order_by('-last_message_id')
+
+    def apply_buffered_checks(self, participant_id, entries):
+        """ With REST_MESSAGING_BUFFER_READ_STATE, the threads read since the last flush are counted again from their buffered checks. """
+        checks = readstate.get_thread_checks([(entry.thread_id, participant_id) for entry in entries if entry.unread_count > 0])
+        if len(checks) > 0:
+            counts = Message.managers.count_unread_messages(participant_id, dict((thread_id, when) for (thread_id, check_participant_id), when in six.iteritems(checks)))
+            for entry in entries:
+                if (entry.thread_id, participant_id) in checks:
+                    entry.unread_count = counts.get(entry.thread_id, 0)
+        return entries
+
+
+@python_2_unicode_compatible
+class InboxEntry(models.Model):
+    """
+    A thread in the inbox of one of its active participants, with its last message and the number of messages the participant has not read.
+    The entries are maintained when the messages are posted and the participants join, leave or read the threads (REST_MESSAGING_INBOX),
+    so listing the inbox does not aggregate the messages. The rebuild_inbox command creates or repairs them.
+    """
+    participant = models.ForeignKey(Participant)
+    thread = models.ForeignKey(Thread)
+    last_message = models.ForeignKey(Message, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    snippet = models.CharField(max_length=255, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    objects = models.Manager()
+    managers = InboxEntryManager()
+
+    class Meta:
+        unique_together = ('participant', 'thread')
+        # the inbox is listed by last message
+        index_together = [('participant', 'last_message')]
+
+    def __str__(self):
+        return "{0}: {1}".format(self.participant, self.thread_id)
+
+    @staticmethod
+    def snippet_length():
+        return min(getattr(settings, 'REST_MESSAGING_INBOX_SNIPPET_LENGTH', 100), 255)
+
+
+class OutboxEventManager(models.Manager):
+
+    def is_enabled(self):
+        return getattr(settings, 'REST_MESSAGING_OUTBOX', False)
+
+    def atomic(self):
+        """ A transaction for a change and the events recording it. Without outbox, the change is made as before, without transaction. """
+        return transaction.atomic() if self.is_enabled() else _no_transaction()
+
+    def record(self, event_type, thread_id, payload):
+        """ Records an event for the outbox handlers (see rest_messaging.outbox), in the transaction of the change it describes. """
+        if self.is_enabled():
+            return OutboxEvent.objects.create(event_type=event_type, thread_id=thread_id, payload=json.dumps(payload, cls=DjangoJSONEncoder))
+
+    def record_many(self, event_type, events, batch_size=None):
+        """ Records many events at once. events is an iterable of (thread_id, payload) tuples. """
+        if self.is_enabled():
+            OutboxEvent.objects.bulk_create([OutboxEvent(event_type=event_type, thread_id=thread_id, payload=json.dumps(payload, cls=DjangoJSONEncoder)) for thread_id, payload in events], batch_size=batch_size)
+
+    def get_pending(self, limit, when=None, lock=False):
+        """
+        Returns the events to deliver, oldest first. The threads with an event waiting for a retry, or claimed by a worker, are held back,
+        so the events of a thread are delivered in order. With lock, the events are locked until the end of the transaction.
+        """
+        when = when or now()
+        pending = OutboxEvent.objects.filter(failed_at__isnull=True)
+        held_thread_ids = list(pending.filter(available_at__gt=when, thread_id__isnull=False).values_list('thread_id', flat=True).distinct())
+        events = pending.filter(available_at__lte=when).exclude(thread_id__in=held_thread_ids).order_by('id')
+        if not lock:
+            return list(events[:limit])
+        events = list(events.select_for_update()[:limit])
+        # another worker may have claimed the events of a thread while we waited for the locks, we hold its next events back
+        thread_ids = set(event.thread_id for event in events if event.thread_id is not None)
+        if len(thread_ids) > 0:
+            held_thread_ids = set(pending.filter(available_at__gt=when, thread_id__in=thread_ids).values_list('thread_id', flat=True))
+            events = [event for event in events if event.thread_id not in held_thread_ids]
+        return events
+
+
+@python_2_unicode_compatible
+class OutboxEvent(models.Model):
+    """
+    An event waiting to be delivered to the outbox handlers. It is written in the transaction of the change it describes,
+    and deleted once delivered.
+    """
+    event_type = models.CharField(max_length=64)
+    thread_id = models.PositiveIntegerField(null=True, blank=True)  # the events of a thread are delivered in order
+    payload = models.TextField()  # json
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=now)  # the time of the next attempt
+    attempts = models.PositiveIntegerField(default=0)
+    failed_at = models.DateTimeField(null=True, blank=True)  # set once the event is given up
+    last_error = models.TextField(blank=True)
+    objects = models.Manager()
+    managers = OutboxEventManager()
+
+    class Meta:
+        # the handlers pick the pending events by id
+        index_together = [('failed_at', 'id')]
+
+    def __str__(self):
+        return "{0} {1}".format(self.event_type, self.id)
+
+    def to_dict(self):
+        return {'id': self.id, 'type': self.event_type, 'thread': self.thread_id, 'created_at': self.created_at, 'payload': json.loads(self.payload)}
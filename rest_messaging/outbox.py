@@ -0,0 +1,129 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+"""
+Delivers the events of the outbox (OutboxEvent) to the handlers, out of the requests: see the drain_outbox command.
+The events are delivered at least once, in order for each thread.
+"""
+
+from __future__ import unicode_literals
+from datetime import timedelta
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import router, transaction
+from django.db.models.signals import post_save
+from django.utils import six
+from django.utils.module_loading import import_string
+from django.utils.six.moves.urllib.request import Request, urlopen
+from django.utils.timezone import now
+from rest_messaging.models import OutboxEvent, Participant, Participation, Thread
+from rest_messaging.signals import outbox_events
+import json
+
+
+class BaseOutboxHandler(object):
+
+    def handle(self, events):
+        """ Delivers a batch of events (see OutboxEvent.to_dict). Raises an exception if the batch must be delivered again. """
+        raise NotImplementedError
+
+
+class SignalHandler(BaseOutboxHandler):
+    """
+    Sends the outbox_events signal, so its receivers run in the worker, and the post_save signals of the threads whose participants
+    changed, which are not sent in the requests with the outbox (see Thread.send_participants_changed).
+    A receiver raising an exception makes the batch be delivered again.
+    """
+
+    def handle(self, events):
+        send_participants_changed(events)
+        outbox_events.send(sender=OutboxEvent, events=events)
+
+
+def send_participants_changed(events):
+    """ Sends post_save for the threads of the events recorded by get_or_create_thread, add_participants and remove_participant. """
+    events = [event for event in events if event['payload'].get('created_and_add_participants', False) or event['payload'].get('remove_participant', False)]
+    if len(events) == 0:
+        return
+    threads = Thread.objects.in_bulk(set(event['thread'] for event in events))
+    participations = Participation.objects.in_bulk([event['payload']['participation'] for event in events if 'participation' in event['payload']])
+    db = router.db_for_read(Participant)
+    for event in events:
+        thread = threads.get(event['thread'], None)
+        if thread is None:
+            # the thread was deleted since
+            continue
+        payload = event['payload']
+        if payload.get('remove_participant', False):
+            post_save.send(
+                Thread, instance=thread, created=False, remove_participant=True, removed_participant=Participant.from_db(db, ['id'], [payload['participant']]),
+                removed_participation=participations.get(payload['participation'], None), request_participant_id=payload['request_participant'])
+        else:
+            post_save.send(Thread, instance=thread, created=True, created_and_add_participants=True, request_participant_id=payload['request_participant'])
+
+
+class WebhookHandler(BaseOutboxHandler):
+    """ Posts each batch as json ({"events": [...]}) to REST_MESSAGING_OUTBOX_WEBHOOK_URL. An error response makes the batch be delivered again. """
+
+    def __init__(self, url=None, timeout=None):
+        self.url = url or getattr(settings, 'REST_MESSAGING_OUTBOX_WEBHOOK_URL', None)
+        self.timeout = timeout or getattr(settings, 'REST_MESSAGING_OUTBOX_WEBHOOK_TIMEOUT', 10)
+
+    def handle(self, events):
+        body = json.dumps({'events': events}, cls=DjangoJSONEncoder).encode('utf8')
+        # urlopen raises an HTTPError for the error responses
+        urlopen(Request(self.url, data=body, headers={'Content-Type': 'application/json'}), timeout=self.timeout).close()
+
+
+def get_outbox_handlers():
+    """ Returns the handlers of REST_MESSAGING_OUTBOX_HANDLERS, classes or their dotted paths. """
+    handlers = []
+    for handler in getattr(settings, 'REST_MESSAGING_OUTBOX_HANDLERS', [SignalHandler]):
+        if isinstance(handler, six.string_types):
+            handler = import_string(handler)
+        handlers.append(handler())
+    return handlers
+
+
+def retry_events(events, error, when):
+    """ The events are delivered again later, with an exponential backoff, until REST_MESSAGING_OUTBOX_MAX_ATTEMPTS. """
+    max_attempts = getattr(settings, 'REST_MESSAGING_OUTBOX_MAX_ATTEMPTS', 10)
+    retry_delay = getattr(settings, 'REST_MESSAGING_OUTBOX_RETRY_DELAY', 30)
+    max_retry_delay = getattr(settings, 'REST_MESSAGING_OUTBOX_MAX_RETRY_DELAY', 60 * 60)
+    for event in events:
+        event.attempts += 1
+        event.last_error = "{0!r}".format(error)
+        if event.attempts >= max_attempts:
+            # the event is given up, the next events of its thread are delivered
+            event.failed_at = when
+        else:
+            event.available_at = when + timedelta(seconds=min(retry_delay * 2 ** (event.attempts - 1), max_retry_delay))
+        event.save(update_fields=['attempts', 'last_error', 'failed_at', 'available_at'])
+
+
+def drain_outbox(handlers=None, batch_size=None):
+    """
+    Delivers a batch of pending events to the handlers. Returns the number of events delivered and the number of events to retry.
+    The events are claimed in a short transaction (the workers draining the outbox at the same time wait for each other on the databases
+    supporting SELECT ... FOR UPDATE), then delivered out of it: a worker stopped while delivering them leaves them to the others
+    once REST_MESSAGING_OUTBOX_CLAIM_TIMEOUT has passed.
+    """
+    handlers = get_outbox_handlers() if handlers is None else handlers
+    batch_size = batch_size or getattr(settings, 'REST_MESSAGING_OUTBOX_BATCH_SIZE', 100)
+    claim_timeout = getattr(settings, 'REST_MESSAGING_OUTBOX_CLAIM_TIMEOUT', 5 * 60)
+    when = now()
+    with transaction.atomic():
+        events = OutboxEvent.managers.get_pending(batch_size, when=when, lock=True)
+        if len(events) == 0:
+            return 0, 0
+        # the claimed events, and the next events of their threads, are not pending until the claim expires
+        OutboxEvent.objects.filter(id__in=[event.id for event in events]).update(available_at=when + timedelta(seconds=claim_timeout))
+    try:
+        for handler in handlers:
+            handler.handle([event.to_dict() for event in events])
+    except Exception as e:
+        retry_events(events, e, now())
+        return 0, len(events)
+    OutboxEvent.objects.filter(id__in=[event.id for event in events]).delete()
+    return len(events), 0
@@ -3,7 +3,13 @@
 # vim: set fileencoding=utf8 :
 
 from __future__ import unicode_literals
+from collections import OrderedDict
 from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from django.utils.http import urlencode, urlsafe_base64_decode, urlsafe_base64_encode
+from django.utils.six.moves.urllib import parse as urlparse
+from rest_framework.exceptions import ParseError
+from rest_framework.response import Response
 
 try:
     from rest_framework.pagination import PageNumberPagination
@@ -13,3 +19,118 @@ except:
 
 class MessagePagination(PageNumberPagination):
     page_size = getattr(settings, "DJANGO_REST_MESSAGING_MESSAGES_PAGE_SIZE", 30)
+
+
+def replace_query_params(url, **params):
+    """ Sets the query parameters of the url, removing the ones set to None. """
+    (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+    query_dict = urlparse.parse_qs(query, keep_blank_values=True)
+    for key, value in params.items():
+        if value is None:
+            query_dict.pop(key, None)
+        else:
+            query_dict[key] = [value]
+    query = urlencode(sorted(list(query_dict.items())), doseq=True)
+    return urlparse.urlunsplit((scheme, netloc, path, query, fragment))
+
+
+class MessageCursorPagination(object):
+    """
+    Keyset pagination of the messages, the most recent first.
+    ?before=<message id> returns the page of messages older than the message, ?after=<message id> the page of messages newer than it.
+    Each page is a range scan on the message ids, with neither COUNT nor OFFSET, so its cost does not depend on its position in the thread.
+    It is used instead of MessagePagination when the request asks for it (?pagination=cursor) or provides a cursor.
+    """
+    page_size = getattr(settings, "DJANGO_REST_MESSAGING_MESSAGES_PAGE_SIZE", 30)
+    before_query_param = 'before'
+    after_query_param = 'after'
+    cursor_field = 'id'  # an indexed, unique field
+
+    @classmethod
+    def is_requested(cls, request):
+        """ Says if the request asks for cursor pagination. """
+        return request.GET.get('pagination') == 'cursor' or cls.before_query_param in request.GET or cls.after_query_param in request.GET
+
+    def get_cursor(self, request, param):
+        value = request.GET.get(param, None)
+        if value is None or value == '':
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise ParseError('Invalid cursor.')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        before = self.get_cursor(request, self.before_query_param)
+        after = self.get_cursor(request, self.after_query_param)
+
+        if before is None and after is not None:
+            # we read the thread forwards and return the page with the most recent messages first
+            page = list(queryset.filter(**{self.cursor_field + '__gt': after}).order_by(self.cursor_field)[:self.page_size + 1])
+            self.has_newer = len(page) > self.page_size
+            page = page[:self.page_size]
+            page.reverse()
+            self.has_older = len(page) > 0
+        else:
+            if before is not None:
+                queryset = queryset.filter(**{self.cursor_field + '__lt': before})
+            page = list(queryset.order_by('-' + self.cursor_field)[:self.page_size + 1])
+            self.has_older = len(page) > self.page_size
+            page = page[:self.page_size]
+            self.has_newer = before is not None and len(page) > 0
+
+        self.page = page
+        return page
+
+    def get_cursor_value(self, item):
+        """ The page holds instances, or rows (see MessageQuerySet.as_rows). """
+        return item[self.cursor_field] if isinstance(item, dict) else getattr(item, self.cursor_field)
+
+    def get_next_link(self):
+        """ The link to the older messages. """
+        if not self.has_older:
+            return None
+        return replace_query_params(self.request.build_absolute_uri(), **{self.before_query_param: self.get_cursor_value(self.page[-1]), self.after_query_param: None, 'pagination': 'cursor'})
+
+    def get_previous_link(self):
+        """ The link to the more recent messages. """
+        if not self.has_newer:
+            return None
+        return replace_query_params(self.request.build_absolute_uri(), **{self.after_query_param: self.get_cursor_value(self.page[0]), self.before_query_param: None, 'pagination': 'cursor'})
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+
+class InboxCursorPagination(MessageCursorPagination):
+    """ Keyset pagination of the inbox entries by last message, the most recently active thread first. """
+    cursor_field = 'last_message_id'
+
+
+def encode_sync_cursor(message_id, changed_since, page_after_id=None):
+    """
+    The sync cursor holds the last message the client received, the time of its sync and, if the sync had more messages,
+    the last message of its page. It is opaque to the clients.
+    """
+    return urlsafe_base64_encode("{0}|{1}|{2}".format(message_id, changed_since.isoformat(), page_after_id or '').encode('utf8')).decode('ascii')
+
+
+def decode_sync_cursor(value):
+    """ Returns the last message id, the time of the sync and the last message of the page encoded in the cursor. """
+    try:
+        parts = urlsafe_base64_decode(value).decode('utf8').split('|')
+        if len(parts) == 2:
+            # a cursor of the previous version
+            parts.append('')
+        message_id, changed_since, page_after_id = parts
+        changed_since = parse_datetime(changed_since)
+        if changed_since is None:
+            raise ValueError
+        return int(message_id), changed_since, int(page_after_id) if page_after_id else None
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ParseError('Invalid cursor.')
@@ -0,0 +1,131 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from abc import ABCMeta, abstractmethod
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import six
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
+import calendar
+
+
+class QueryCountBackend(object):
+    """
+    Counts the messages sent by the participant in the last 24 hours with a COUNT query.
+    This is exact but the query scans all the messages of the window, so the heavy senders pay more for each message.
+    """
+
+    def get_count(self, sender_id, when=None):
+        """ Returns the number of messages sent by the participant in the 24 hours before when. """
+        from rest_messaging.models import Message
+        return Message.managers.return_daily_messages_count(sender_id, when)
+
+    def increment(self, sender_id, count=1, when=None):
+        """ The messages are counted when needed, there is nothing to store. """
+        pass
+
+
+@six.add_metaclass(ABCMeta)
+class SlidingWindowBackend(object):
+    """
+    Counts the messages of the last 24 hours in hourly buckets.
+    The count is the sum of the last 24 buckets, plus the part of the 25th bucket still in the window (we assume the messages
+    of an hour were sent evenly), so it costs the same whatever the number of messages sent by the participant.
+    The subclasses store the buckets.
+    """
+    window = 24  # in buckets
+    bucket_size = 3600  # in seconds
+
+    def get_bucket(self, when):
+        """ Returns the index of the bucket of a date. """
+        return calendar.timegm(when.utctimetuple()) // self.bucket_size
+
+    def get_elapsed(self, when):
+        """ Returns the fraction of the current bucket that has elapsed. """
+        return float(calendar.timegm(when.utctimetuple()) % self.bucket_size) / self.bucket_size
+
+    def get_count(self, sender_id, when=None):
+        """ Returns the estimated number of messages sent by the participant in the 24 hours before when. """
+        when = when or now()
+        current = self.get_bucket(when)
+        oldest = current - self.window
+        counts = self.get_bucket_counts(sender_id, oldest, current)
+        total = sum(count for bucket, count in six.iteritems(counts) if bucket != oldest)
+        return total + int(round(counts.get(oldest, 0) * (1 - self.get_elapsed(when))))
+
+    @abstractmethod
+    def get_bucket_counts(self, sender_id, first, last):
+        """ Returns a dict {bucket: count} of the buckets of the participant between first and last (included). """
+
+    @abstractmethod
+    def increment(self, sender_id, count=1, when=None):
+        """ Adds count messages to the current bucket of the participant. """
+
+
+class CacheSlidingWindowBackend(SlidingWindowBackend):
+    """
+    Stores the buckets in the Django cache. The buckets expire with the window.
+    The counts are lost if the cache is cleared, so a participant may then send more messages than allowed.
+    """
+
+    def get_cache_key(self, sender_id, bucket):
+        return "rest_messaging_daily_count_{0}_{1}".format(sender_id, bucket)
+
+    def get_bucket_counts(self, sender_id, first, last):
+        keys = dict((self.get_cache_key(sender_id, bucket), bucket) for bucket in range(first, last + 1))
+        return dict((keys[key], count) for key, count in six.iteritems(cache.get_many(list(keys))))
+
+    def increment(self, sender_id, count=1, when=None):
+        key = self.get_cache_key(sender_id, self.get_bucket(when or now()))
+        timeout = (self.window + 1) * self.bucket_size
+        # add does nothing if the bucket exists, and incr is atomic on the backends that support it (memcached, redis)
+        cache.add(key, 0, timeout)
+        try:
+            cache.incr(key, count)
+        except ValueError:
+            # the bucket expired between the two calls
+            cache.set(key, count, timeout)
+
+
+class DatabaseSlidingWindowBackend(SlidingWindowBackend):
+    """
+    Stores the buckets in the MessageCountBucket table.
+    Counting reads at most 25 rows and incrementing updates one. The buckets out of the window are deleted when a new bucket is created.
+    """
+
+    def get_bucket_counts(self, sender_id, first, last):
+        from rest_messaging.models import MessageCountBucket
+        return dict(MessageCountBucket.objects.filter(participant__id=sender_id, bucket__gte=first, bucket__lte=last).values_list('bucket', 'count'))
+
+    def increment(self, sender_id, count=1, when=None):
+        from rest_messaging.models import MessageCountBucket
+        bucket = self.get_bucket(when or now())
+        if MessageCountBucket.objects.filter(participant__id=sender_id, bucket=bucket).update(count=F('count') + count):
+            return
+        try:
+            with transaction.atomic():
+                MessageCountBucket.objects.create(participant_id=sender_id, bucket=bucket, count=count)
+        except IntegrityError:
+            # another process created the bucket
+            MessageCountBucket.objects.filter(participant__id=sender_id, bucket=bucket).update(count=F('count') + count)
+        else:
+            # we create a bucket once per hour at most, the old ones can go
+            MessageCountBucket.objects.filter(participant__id=sender_id, bucket__lt=bucket - self.window).delete()
+
+
+def get_daily_limit_callback():
+    """ Returns REST_MESSAGING_DAILY_LIMIT_CALLBACK, or None if the messages are not limited (they are then not counted). """
+    return getattr(settings, 'REST_MESSAGING_DAILY_LIMIT_CALLBACK', None)
+
+
+def get_daily_limit_backend():
+    """ Returns the backend counting the messages for the daily limit. REST_MESSAGING_DAILY_LIMIT_BACKEND may be a class or its dotted path. """
+    backend = getattr(settings, 'REST_MESSAGING_DAILY_LIMIT_BACKEND', QueryCountBackend)
+    if isinstance(backend, six.string_types):
+        backend = import_string(backend)
+    return backend()
@@ -0,0 +1,200 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+"""
+Buffers the read state (Participation.date_last_check and NotificationCheck.date_check) in the Django cache, when
+REST_MESSAGING_BUFFER_READ_STATE is set. The clients marking their threads as read several times a second only write to the cache,
+flush_read_states (see the flush_read_states command) writes the last check of each participation to the database with a few UPDATEs.
+The reads of the read state look in the buffer first, the cache must be shared by the processes and keep the keys until they are flushed.
+
+The buffer holds the last check of each participation, a dirty flag and a journal of the participations to flush:
+a participation is added to the journal when it is marked as read and its flag is not set.
+"""
+
+from __future__ import unicode_literals
+from django.conf import settings
+from django.core import checks
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache
+from django.db.models import Case, DateTimeField, F, Q, Value, When
+from django.utils import six
+from django.utils.six.moves import reduce
+from django.utils.timezone import now
+import operator
+
+SEQUENCE_KEY = 'rest_messaging_read_state_sequence'
+FLUSHED_KEY = 'rest_messaging_read_state_flushed'
+MISSING_KEY = 'rest_messaging_read_state_missing'
+
+
+def is_enabled():
+    return getattr(settings, 'REST_MESSAGING_BUFFER_READ_STATE', False)
+
+
+# the caches local to a process, and the caches culling their entries above MAX_ENTRIES
+LOCAL_CACHE_BACKENDS = ('django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache')
+CULLING_CACHE_BACKENDS = ('django.core.cache.backends.filebased.FileBasedCache', 'django.core.cache.backends.db.DatabaseCache')
+
+
+def check_cache(app_configs, **kwargs):
+    """ The checks buffered in a cache which is not shared by the processes, or which culls its entries, would be lost before they are flushed. """
+    if not is_enabled():
+        return []
+    backend = settings.CACHES.get(DEFAULT_CACHE_ALIAS, {}).get('BACKEND', '')
+    if backend in LOCAL_CACHE_BACKENDS:
+        return [checks.Error(
+            'REST_MESSAGING_BUFFER_READ_STATE needs a cache shared by the processes, {0} is not.'.format(backend),
+            hint='Use memcached or redis as the default cache.', id='rest_messaging.E001')]
+    if backend in CULLING_CACHE_BACKENDS:
+        return [checks.Error(
+            'REST_MESSAGING_BUFFER_READ_STATE needs a cache keeping the checks until they are flushed, {0} culls its entries.'.format(backend),
+            hint='Use memcached or redis as the default cache.', id='rest_messaging.E002')]
+    return []
+
+
+def get_timeout():
+    """ The buffered checks must be flushed before they expire. """
+    return getattr(settings, 'REST_MESSAGING_READ_STATE_BUFFER_TIMEOUT', 24 * 60 * 60)
+
+
+def _thread_check_key(thread_id, participant_id):
+    return 'rest_messaging_read_state_{0}_{1}'.format(thread_id, participant_id)
+
+
+def _notification_check_key(participant_id):
+    return 'rest_messaging_read_state_notifications_{0}'.format(participant_id)
+
+
+def _dirty_key(key):
+    return '{0}_dirty'.format(key)
+
+
+def _journal_key(position):
+    return 'rest_messaging_read_state_journal_{0}'.format(position)
+
+
+def _buffer(key, entry, when):
+    # the check is stored before the flag is tested: a flush clears the flag before it reads the checks
+    timeout = get_timeout()
+    cache.set(key, when, timeout)
+    if cache.add(_dirty_key(key), True, timeout):
+        cache.add(SEQUENCE_KEY, 0, None)
+        try:
+            position = cache.incr(SEQUENCE_KEY)
+        except ValueError:
+            # the sequence was evicted meanwhile
+            cache.add(SEQUENCE_KEY, 0, None)
+            position = cache.incr(SEQUENCE_KEY)
+        cache.set(_journal_key(position), entry, timeout)
+
+
+def buffer_thread_check(thread_id, participant_id, when):
+    """ The participant read the thread at when. """
+    _buffer(_thread_check_key(thread_id, participant_id), ('thread', thread_id, participant_id), when)
+
+
+def buffer_notification_check(participant_id, when):
+    """ The participant checked his notifications at when. """
+    _buffer(_notification_check_key(participant_id), ('notifications', participant_id), when)
+
+
+def get_thread_checks(pairs):
+    """ Returns the buffered checks of the (thread_id, participant_id) pairs, {(thread_id, participant_id): date}. """
+    keys = dict((_thread_check_key(thread_id, participant_id), (thread_id, participant_id)) for thread_id, participant_id in pairs)
+    if len(keys) == 0:
+        return {}
+    return dict((keys[key], when) for key, when in six.iteritems(cache.get_many(list(keys))))
+
+
+def get_notification_checks(participant_ids):
+    """ Returns the buffered notification checks of the participants, {participant_id: date}. """
+    keys = dict((_notification_check_key(participant_id), participant_id) for participant_id in participant_ids)
+    if len(keys) == 0:
+        return {}
+    return dict((keys[key], when) for key, when in six.iteritems(cache.get_many(list(keys))))
+
+
+def get_notification_check(participant_id):
+    """ Returns the buffered notification check of the participant, or None. """
+    return cache.get(_notification_check_key(participant_id), None)
+
+
+def apply_thread_checks(participations):
+    """ Sets the buffered checks on the participations, which may have been read from the database before the checks were flushed. """
+    participations = list(participations)
+    checks = get_thread_checks(set((participation.thread_id, participation.participant_id) for participation in participations))
+    for participation in participations:
+        when = checks.get((participation.thread_id, participation.participant_id), None)
+        if when is not None and (participation.date_last_check is None or participation.date_last_check < when):
+            participation.date_last_check = when
+    return participations
+
+
+def _update_later_checks(queryset, field_name, key_fields, checks, **extra):
+    """ Sets the field of each row to its check in a single UPDATE, unless the row holds a later check. """
+    conditions = [(Q(**dict(zip(key_fields, key))), when) for key, when in six.iteritems(checks)]
+    field_value = Case(
+        *[When(condition & (Q(**{field_name + '__isnull': True}) | Q(**{field_name + '__lt': when})), then=Value(when, output_field=DateTimeField())) for condition, when in conditions],
+        default=F(field_name), output_field=DateTimeField())
+    extra[field_name] = field_value
+    return queryset.filter(reduce(operator.or_, [condition for condition, when in conditions])).update(**extra)
+
+
+def _read_journal(flushed, last, batch_size):
+    """ Returns the entries of the journal after flushed, and the position the next flush starts after. """
+    entries = []
+    first_missing = None
+    for start in range(flushed + 1, last + 1, batch_size):
+        positions = list(range(start, min(start + batch_size, last + 1)))
+        found = cache.get_many([_journal_key(position) for position in positions])
+        for position in positions:
+            if _journal_key(position) in found:
+                entries.append(found[_journal_key(position)])
+            elif first_missing is None:
+                first_missing = position
+    if first_missing is None or cache.get(MISSING_KEY, None) == first_missing:
+        # an entry missing since the previous flush has expired
+        return entries, last
+    # the position of an entry is reserved before the entry is written, the next flush reads the journal again from it
+    cache.set(MISSING_KEY, first_missing, None)
+    return entries, first_missing - 1
+
+
+def flush_read_states(batch_size=None):
+    """
+    Writes the buffered checks to the database, a few UPDATEs for each batch of checks. Returns the number of participations and notification checks flushed.
+    Runs one flush at a time: the checks are written forward only, but two flushes at the same time would write them twice.
+    """
+    from rest_messaging.models import InboxEntry, Message, NotificationCheck, Participation, Thread, _chunks
+
+    batch_size = batch_size or getattr(settings, 'REST_MESSAGING_BULK_BATCH_SIZE', 500)
+    flushed = cache.get(FLUSHED_KEY, 0)
+    last = cache.get(SEQUENCE_KEY, 0)
+    if last < flushed:
+        # the sequence was evicted, the journal starts again
+        flushed = 0
+    if last == flushed:
+        return 0, 0
+    entries, next_flushed = _read_journal(flushed, last, batch_size)
+    thread_pairs = set(tuple(entry[1:]) for entry in entries if entry[0] == 'thread')
+    notification_participant_ids = set(entry[1] for entry in entries if entry[0] == 'notifications')
+    # the flags are cleared before the checks are read, the checks buffered meanwhile are added to the journal again
+    cache.delete_many([_dirty_key(_thread_check_key(*pair)) for pair in thread_pairs] + [_dirty_key(_notification_check_key(participant_id)) for participant_id in notification_participant_ids])
+    thread_checks = get_thread_checks(thread_pairs)
+    notification_checks = get_notification_checks(notification_participant_ids)
+
+    for chunk in _chunks(sorted(thread_checks.items()), batch_size):
+        _update_later_checks(Participation.objects.all(), 'date_last_check', ('thread_id', 'participant_id'), dict(chunk), updated_at=now())
+    for chunk in _chunks(sorted(notification_checks.items()), batch_size):
+        chunk = dict(chunk)
+        existing = set(NotificationCheck.objects.filter(participant__id__in=list(chunk)).values_list('participant_id', flat=True))
+        if len(existing) > 0:
+            _update_later_checks(NotificationCheck.objects.all(), 'date_check', ('participant_id',), dict(((participant_id,), chunk[participant_id]) for participant_id in existing))
+        NotificationCheck.objects.bulk_create([NotificationCheck(participant_id=participant_id, date_check=when) for participant_id, when in six.iteritems(chunk) if participant_id not in existing])
+
+    InboxEntry.managers.refresh_unread_counts(thread_checks, batch_size=batch_size)
+    # the participations were updated without post_save
+    Thread.managers.invalidate_participations([thread_id for thread_id, participant_id in thread_checks])
+    Message.managers.clear_unread_totals(set(participant_id for thread_id, participant_id in thread_checks))
+    cache.set(FLUSHED_KEY, next_flushed, None)
+    return len(thread_checks), len(notification_checks)
@@ -0,0 +1,33 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+import bisect
+
+
+class ReadReceipts(object):
+    """
+    Finds the readers of the messages of a thread.
+    The participants' last checks are sorted once. A message has been read by the participants who checked the thread after it was sent,
+    which we find by bisecting its date in the sorted checks. The messages sent between the same two checks share the same list of readers.
+    """
+
+    def __init__(self, checks):
+        """ checks is an iterable of (participant_id, date_last_check) tuples. The participants who never checked the thread are ignored. """
+        checks = sorted((date_last_check, participant_id) for participant_id, date_last_check in checks if date_last_check is not None)
+        self.dates = [date_last_check for date_last_check, participant_id in checks]
+        self.participant_ids = [participant_id for date_last_check, participant_id in checks]
+        self._readers = {}
+
+    @classmethod
+    def from_participations(cls, participations):
+        return cls((participation.participant_id, participation.date_last_check) for participation in participations)
+
+    def get_readers(self, sent_at):
+        """ Returns the ids of the participants who read a message sent at sent_at. The list is shared and must not be modified. """
+        index = bisect.bisect_right(self.dates, sent_at)
+        readers = self._readers.get(index, None)
+        if readers is None:
+            readers = self._readers[index] = self.participant_ids[index:]
+        return readers
@@ -0,0 +1,13 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from channels.routing import route_class
+from rest_messaging.consumers import MessagingConsumer
+
+
+# include("rest_messaging.routing.channel_routing", path=r"^/messaging/ws/$") in the routing of the project
+channel_routing = [
+    route_class(MessagingConsumer),
+]
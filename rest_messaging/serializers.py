@@ -3,9 +3,10 @@
 # vim: set fileencoding=utf8 :
 
 from __future__ import unicode_literals
+from collections import OrderedDict
 from rest_framework import serializers
 from rest_messaging.compat import compat_serializer_attr, compat_serializer_method_field
-from rest_messaging.models import Message, NotificationCheck, Thread
+from rest_messaging.models import InboxEntry, Message, NotificationCheck, Participation, Thread
 
 
 class ThreadSerializer(serializers.ModelSerializer):
@@ -27,7 +28,7 @@ class ThreadSerializer(serializers.ModelSerializer):
         """ Allows to define a callback for serializing information about the user. """
         # we set the many to many serialization to False, because we only want it with retrieve requests
         if self.callback is None:
-            return [participant.id for participant in obj.participants.all()]
+            return obj.get_participants_ids()
         else:
             # we do not want user information
             return self.callback(obj)
@@ -45,6 +46,30 @@ class SimpleMessageSerializer(serializers.ModelSerializer):
         fields = ('id', 'body', 'sender', 'thread', 'sent_at')
 
 
+class SyncMessageSerializer(serializers.ModelSerializer):
+    """ The messages with their sequence number in the thread. """
+
+    class Meta:
+        model = Message
+        fields = ('id', 'body', 'sender', 'thread', 'sent_at', 'sequence')
+
+
+class ParticipationSerializer(serializers.ModelSerializer):
+    """ Who joined or left a thread, and when he last read it. """
+
+    class Meta:
+        model = Participation
+        fields = ('thread', 'participant', 'date_joined', 'date_left', 'date_last_check', 'is_active')
+
+
+class InboxEntrySerializer(serializers.ModelSerializer):
+    """ A thread of the inbox, with its last message and the number of unread messages. """
+
+    class Meta:
+        model = InboxEntry
+        fields = ('thread', 'last_message', 'last_message_at', 'snippet', 'unread_count', 'updated_at')
+
+
 class ComplexMessageSerializer(serializers.ModelSerializer):
 
     is_notification = compat_serializer_method_field("get_is_notification")
@@ -71,6 +96,53 @@ class ComplexMessageSerializer(serializers.ModelSerializer):
             return []
 
 
+class MessageRowSerializer(object):
+    """
+    Serializes the rows of MessageQuerySet.as_rows() as ComplexMessageSerializer serializes the messages (without the readers,
+    as ReadStateMessageSerializer does, if readers is False). It is read-only and builds plain dicts, without fields to bind for each message.
+    """
+    sent_at_field = serializers.DateTimeField()
+
+    def __init__(self, instance, many=True, readers=True):
+        self.instance = instance
+        self.readers = readers
+
+    def to_representation(self, row):
+        data = OrderedDict([
+            ('id', row['id']),
+            ('body', row['body']),
+            ('sender', row['sender']),
+            ('thread', row['thread']),
+            ('sent_at', self.sent_at_field.to_representation(row['sent_at'])),
+            ('is_notification', row.get('is_notification', False)),
+        ])
+        if self.readers:
+            data['readers'] = row.get('readers', [])
+        return data
+
+    @property
+    def data(self):
+        return [self.to_representation(row) for row in self.instance]
+
+
+class ReadStateMessageSerializer(serializers.ModelSerializer):
+    """ Returns the messages without their readers, which the clients derive from the read watermarks of the participants. """
+
+    is_notification = compat_serializer_method_field("get_is_notification")
+
+    class Meta:
+        model = Message
+        fields = ('id', 'body', 'sender', 'thread', 'sent_at', 'is_notification')
+
+    def get_is_notification(self, obj):
+        """ We say if the message should trigger a notification """
+        try:
+            o = compat_serializer_attr(self, obj)
+            return o.is_notification
+        except Exception:
+            return False
+
+
 class MessageNotificationCheckSerializer(serializers.ModelSerializer):
 
     class Meta:
@@ -3,3 +3,137 @@
 # vim: set fileencoding=utf8 :
 
 from __future__ import unicode_literals
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal
+from django.utils import six
+
+
+# sent once by MessageManager.bulk_post_messages for all the messages it created (post_save is not sent by bulk_create)
+messages_bulk_created = Signal(providing_args=['participant_id', 'messages', 'thread_ids'])
+
+# sent once by ThreadManager.get_or_create_threads for all the threads it created
+threads_bulk_created = Signal(providing_args=['threads', 'request_participant_id'])
+
+# sent once by ThreadManager.mark_threads_as_read for all the threads it marked (the participations are updated without post_save)
+threads_marked_as_read = Signal(providing_args=['participant_id', 'thread_ids', 'date_last_check'])
+
+# sent by rest_messaging.outbox.SignalHandler, in the worker draining the outbox, with a batch of events
+outbox_events = Signal(providing_args=['events'])
+
+
+def on_commit(func):
+    """
+    Runs func once the transaction of the change is committed (at once outside a transaction): the clients must not be told about
+    a change which is rolled back, nor fetch it before it is visible. Django 1.8 has no transaction.on_commit, func runs at once.
+    """
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(func)
+    else:
+        func()
+
+
+def invalidate_thread_participations(sender, instance, **kwargs):
+    """ The participations of the thread changed (a participant joined, left or read it), we invalidate their cache. """
+    if kwargs.get('buffered', False):
+        # the buffered checks are set on the cached participations, flush_read_states invalidates them once written
+        return
+    from rest_messaging.models import Thread
+    Thread.managers.invalidate_participations([instance.thread_id])
+
+
+def invalidate_threads_participants(sender, threads, **kwargs):
+    from rest_messaging.models import Thread
+    Thread.managers.invalidate_participations([thread.id for thread in threads])
+
+
+def invalidate_threads_read(sender, thread_ids, **kwargs):
+    from rest_messaging.models import Thread
+    Thread.managers.invalidate_participations(thread_ids)
+
+
+def publish_message(sender, instance, created, **kwargs):
+    if created:
+        from rest_messaging.events import publish_messages
+        on_commit(lambda: publish_messages([instance]))
+
+
+def publish_bulk_messages(sender, messages, **kwargs):
+    from rest_messaging.events import publish_messages
+    on_commit(lambda: publish_messages(messages))
+
+
+def channels_enabled():
+    """ The messages are pushed to the WebSocket connections when REST_MESSAGING_CHANNELS is set (Django Channels 1.x is then required). """
+    return getattr(settings, 'REST_MESSAGING_CHANNELS', False)
+
+
+def channels_send_message(sender, instance, created, **kwargs):
+    if created and channels_enabled():
+        from rest_messaging.consumers import send_messages
+        on_commit(lambda: send_messages([instance]))
+
+
+def channels_send_bulk_messages(sender, messages, **kwargs):
+    if channels_enabled():
+        from rest_messaging.consumers import send_messages
+        on_commit(lambda: send_messages(messages))
+
+
+def channels_update_participation(sender, instance, created, update_fields=None, **kwargs):
+    """ The connections of the participant join or leave the group of the thread, or the group is told the participant read the thread. """
+    if channels_enabled():
+        from rest_messaging.consumers import send_read_watermark, update_thread_groups
+        if created:
+            on_commit(lambda: update_thread_groups(instance.thread_id, added_participant_ids=[instance.participant_id]))
+        elif instance.date_left is not None:
+            on_commit(lambda: update_thread_groups(instance.thread_id, removed_participant_ids=[instance.participant_id]))
+        elif instance.date_last_check is not None and (update_fields is None or 'date_last_check' in update_fields):
+            on_commit(lambda: send_read_watermark(instance))
+
+
+def channels_threads_marked_as_read(sender, participant_id, thread_ids, date_last_check, **kwargs):
+    if channels_enabled():
+        from rest_messaging.consumers import send_read_watermark
+        from rest_messaging.models import Participation
+
+        def send():
+            for thread_id in thread_ids:
+                send_read_watermark(Participation(thread_id=thread_id, participant_id=participant_id, date_last_check=date_last_check))
+
+        on_commit(send)
+
+
+def channels_add_participants(sender, instance, **kwargs):
+    """ add_participants creates the participations with bulk_create, which sends no post_save. """
+    if kwargs.get('created_and_add_participants', False) and channels_enabled():
+        channels_add_threads_participants(sender, [instance])
+
+
+def channels_add_threads_participants(sender, threads, **kwargs):
+    if channels_enabled():
+        from rest_messaging.consumers import update_thread_groups
+        from rest_messaging.models import Thread
+
+        def update():
+            participations = Thread.managers.get_participations([thread.id for thread in threads])
+            for thread_id, thread_participations in six.iteritems(participations):
+                update_thread_groups(thread_id, added_participant_ids=[participation.participant_id for participation in thread_participations if participation.is_active])
+
+        on_commit(update)
+
+
+# the models import this module, the senders are given as strings
+post_save.connect(invalidate_thread_participations, sender='rest_messaging.Participation', dispatch_uid='rest_messaging_participation_saved')
+post_delete.connect(invalidate_thread_participations, sender='rest_messaging.Participation', dispatch_uid='rest_messaging_participation_deleted')
+threads_bulk_created.connect(invalidate_threads_participants, dispatch_uid='rest_messaging_threads_bulk_created')
+threads_marked_as_read.connect(invalidate_threads_read, dispatch_uid='rest_messaging_threads_marked_as_read')
+post_save.connect(publish_message, sender='rest_messaging.Message', dispatch_uid='rest_messaging_message_published')
+messages_bulk_created.connect(publish_bulk_messages, dispatch_uid='rest_messaging_messages_bulk_published')
+post_save.connect(channels_send_message, sender='rest_messaging.Message', dispatch_uid='rest_messaging_message_channels')
+messages_bulk_created.connect(channels_send_bulk_messages, dispatch_uid='rest_messaging_messages_bulk_channels')
+post_save.connect(channels_update_participation, sender='rest_messaging.Participation', dispatch_uid='rest_messaging_participation_channels')
+post_save.connect(channels_add_participants, sender='rest_messaging.Thread', dispatch_uid='rest_messaging_thread_participants_channels')
+threads_bulk_created.connect(channels_add_threads_participants, dispatch_uid='rest_messaging_threads_bulk_channels')
+threads_marked_as_read.connect(channels_threads_marked_as_read, dispatch_uid='rest_messaging_threads_read_channels')
@@ -5,18 +5,40 @@
 from __future__ import unicode_literals
 
 from django.conf import settings
-from django.utils.timezone import now
+from django.core.exceptions import PermissionDenied
+from django.http import Http404
+from django.utils import six
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware, now
 from rest_framework import mixins, permissions, status, viewsets
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.response import Response
-from rest_messaging.compat import compat_get_paginated_response, compat_get_request_data, compat_pagination_messages, compat_serializer_check_is_valid, compat_thread_serializer_set, compat_perform_update
-from rest_messaging.models import Message, NotificationCheck, Participant, Participation, Thread
+from rest_messaging import readstate
+from rest_messaging.compat import DRFVLIST, compat_get_paginated_response, compat_get_request_data, compat_pagination_messages, compat_serializer_check_is_valid, compat_thread_serializer_set, compat_perform_update
+from rest_messaging.events import get_event_bus
+from rest_messaging.models import InboxEntry, Message, NotificationCheck, Participant, Thread
+from rest_messaging.pagination import InboxCursorPagination, MessageCursorPagination, decode_sync_cursor, encode_sync_cursor
 from rest_messaging.permissions import IsInThread
-from rest_messaging.serializers import MessageNotificationCheckSerializer, ComplexMessageSerializer, SimpleMessageSerializer, ThreadSerializer
+from rest_messaging.serializers import MessageNotificationCheckSerializer, ComplexMessageSerializer, InboxEntrySerializer, MessageRowSerializer, ParticipationSerializer, ReadStateMessageSerializer, SimpleMessageSerializer, SyncMessageSerializer, ThreadSerializer
 import json
+import math
 
 
-class ThreadView(mixins.RetrieveModelMixin,
+class ThreadLookupMixin(object):
+    """ The detail routes work on one thread. """
+
+    def get_thread(self, pk):
+        """ Fetches the thread and its participations in one query, and checks the request's user participates in it. """
+        try:
+            thread = Thread.managers.get_thread_with_participations(pk)
+        except (Thread.DoesNotExist, ValueError):
+            raise Http404
+        self.check_object_permissions(self.request, thread)
+        return thread
+
+
+class ThreadView(ThreadLookupMixin,
+                 mixins.RetrieveModelMixin,
                  mixins.CreateModelMixin,
                  mixins.UpdateModelMixin,
                  viewsets.GenericViewSet):
@@ -28,6 +50,9 @@ class ThreadView(mixins.RetrieveModelMixin,
     serializer_class = ThreadSerializer
     permission_classes = (IsInThread,)
 
+    def get_object(self):
+        return self.get_thread(self.kwargs[self.lookup_url_kwarg or self.lookup_field])
+
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
         serializer = ThreadSerializer(instance, callback=getattr(settings, 'REST_MESSAGING_SERIALIZE_PARTICIPANTS_CALLBACK', None), context={'request': request})  # self.get_serializer will raise an error in DRF 2.4
@@ -64,8 +89,7 @@ class ThreadView(mixins.RetrieveModelMixin,
     @detail_route(methods=['post'])
     def add_participants(self, request, pk=None):
         # we get the thread and check for permission
-        thread = Thread.objects.get(id=pk)
-        self.check_object_permissions(request, thread)
+        thread = self.get_thread(pk)
         # we get the participants and add them
         participants_ids = json.loads(compat_get_request_data(self.request).get('participants'))
         thread.add_participants(request, *participants_ids)
@@ -76,11 +100,12 @@ class ThreadView(mixins.RetrieveModelMixin,
     @detail_route(methods=['post'])
     def remove_participant(self, request, pk=None):
         # we get the thread and check for permission
-        thread = Thread.objects.get(id=pk)
-        self.check_object_permissions(request, thread)
-        # we get the participant
-        participant_id = compat_get_request_data(self.request).get('participant')
-        participant = Participant.objects.get(id=participant_id)
+        thread = self.get_thread(pk)
+        # we get the participant (a participant only has an id, we do not need to fetch it)
+        try:
+            participant = Participant(id=int(compat_get_request_data(self.request).get('participant')))
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
         # we remove him if thread.remove_participant allows us to
         try:
             thread.remove_participant(request, participant)
@@ -93,8 +118,7 @@ class ThreadView(mixins.RetrieveModelMixin,
     @detail_route(methods=['get'])
     def get_removable_participants_ids(self, request, pk=None):
         # we get the thread and check for permission
-        thread = Thread.objects.get(id=pk)
-        self.check_object_permissions(request, thread)
+        thread = self.get_thread(pk)
         # we get the removable participants
         removable_participants_ids = thread.get_removable_participants_ids(request)
         # we remove him if thread.remove_participant allows us to
@@ -103,17 +127,34 @@ class ThreadView(mixins.RetrieveModelMixin,
         except Exception:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
+    @list_route(methods=['post'])
+    def mark_all_as_read(self, request, *args, **kwargs):
+        """
+        Marks all the active threads of the participant as read at once. threads (a json list of ids) limits the threads marked,
+        before (an ISO 8601 time) marks the messages sent before it only. Returns the ids of the threads marked.
+        """
+        data = compat_get_request_data(request)
+        try:
+            thread_ids = [int(thread_id) for thread_id in json.loads(data['threads'])] if data.get('threads', None) else None
+            before = parse_datetime(data['before']) if data.get('before', None) else None
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if data.get('before', None) and before is None:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if before is not None and settings.USE_TZ and is_naive(before):
+            before = make_aware(before)
+        thread_ids, date_last_check = Thread.managers.mark_threads_as_read(request.rest_messaging_participant.id, thread_ids=thread_ids, before=before)
+        return Response({'count': len(thread_ids), 'threads': thread_ids, 'date_last_check': date_last_check})
+
     @detail_route(methods=['post'])
     def mark_thread_as_read(self, request, pk=None):
         """ Pk is the pk of the Thread to which the messages belong. """
         # we get the thread and check for permission
-        thread = Thread.objects.get(id=pk)
-        self.check_object_permissions(request, thread)
+        thread = self.get_thread(pk)
         # we save the date
         try:
-            participation = Participation.objects.get(thread=thread, participant=request.rest_messaging_participant)
-            participation.date_last_check = now()
-            participation.save()
+            participation = thread.get_participation(request.rest_messaging_participant.id)
+            participation.mark_as_read()
             # we return the thread
             serializer = self.get_serializer(thread)
             return Response(serializer.data)
@@ -122,7 +163,8 @@ class ThreadView(mixins.RetrieveModelMixin,
 
 
 @compat_pagination_messages
-class MessageView(mixins.ListModelMixin,
+class MessageView(ThreadLookupMixin,
+                  mixins.ListModelMixin,
                   viewsets.GenericViewSet):
     """ The view only lists and creates. """
 
@@ -133,15 +175,135 @@ class MessageView(mixins.ListModelMixin,
     def get_queryset(self):
         """ We list all the threads involving the user """
         check_notifications = self.request.GET.get("check_notifications", True)
-        messages = Message.managers.get_lasts_messages_of_threads(self.request.rest_messaging_participant.id, check_who_read=True, check_is_notification=check_notifications)
+        messages = Message.managers.get_lasts_messages_of_threads(self.request.rest_messaging_participant.id, check_who_read=not self.read_watermarks_requested(), check_is_notification=check_notifications)
         return messages
 
+    def read_watermarks_requested(self):
+        """ With ?read_state=watermarks, the messages do not list their readers: the response holds the read watermark of each participant instead. """
+        return self.request.GET.get('read_state', None) == 'watermarks'
+
+    def get_serializer_class(self):
+        if self.read_watermarks_requested():
+            return ReadStateMessageSerializer
+        return super(MessageView, self).get_serializer_class()
+
+    def rows_requested(self):
+        """ With REST_MESSAGING_FAST_SERIALIZATION, the listings serialize rows instead of messages (see MessageRowSerializer). Requires DRF 3.1 or higher. """
+        return getattr(settings, 'REST_MESSAGING_FAST_SERIALIZATION', False) and (DRFVLIST[0], DRFVLIST[1]) >= (3, 1)
+
+    def get_row_serializer(self, rows):
+        return MessageRowSerializer(rows, many=True, readers=not self.read_watermarks_requested())
+
+    def add_read_watermarks(self, response, thread_ids):
+        """ Adds the read watermarks of the threads to the response. """
+        if not isinstance(response.data, dict):
+            response.data = {'results': response.data}
+        response.data['watermarks'] = Message.managers.get_read_watermarks(thread_ids)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        if self.rows_requested():
+            rows = self.get_queryset().as_rows()
+            page = self.paginate_queryset(rows)
+            if page is not None:
+                response = self.get_paginated_response(self.get_row_serializer(page).data)
+            else:
+                response = Response(self.get_row_serializer(rows).data)
+        else:
+            response = super(MessageView, self).list(request, *args, **kwargs)
+        if self.read_watermarks_requested():
+            messages = response.data['results'] if isinstance(response.data, dict) else response.data
+            response = self.add_read_watermarks(response, set([message['thread'] for message in messages]))
+        return response
+
+    @list_route(methods=['get'])
+    def inbox(self, request, *args, **kwargs):
+        """
+        Lists the threads of the participant from the materialized inbox (REST_MESSAGING_INBOX), the most recently active first.
+        The pages are ranges of the inbox index (?before=<last message id>).
+        """
+        if not InboxEntry.managers.is_enabled():
+            return Response("The inbox is not enabled (REST_MESSAGING_INBOX).", status=status.HTTP_501_NOT_IMPLEMENTED)
+        participant_id = request.rest_messaging_participant.id
+        paginator = InboxCursorPagination()
+        page = paginator.paginate_queryset(InboxEntry.managers.get_inbox(participant_id), request, view=self)
+        if readstate.is_enabled():
+            InboxEntry.managers.apply_buffered_checks(participant_id, page)
+        return paginator.get_paginated_response(InboxEntrySerializer(page, many=True).data)
+
+    @list_route(methods=['get'])
+    def unread_counts(self, request, *args, **kwargs):
+        """ Returns the number of unread messages in each active thread of the participant, and their total. """
+        counts = Message.managers.get_unread_counts(request.rest_messaging_participant.id)
+        total = sum(counts.values())
+        Message.managers.set_unread_total(request.rest_messaging_participant.id, total)
+        return Response({'total': total, 'threads': [{'thread': thread_id, 'count': count} for thread_id, count in sorted(counts.items())]})
+
+    @list_route(methods=['get'])
+    def unread_total(self, request, *args, **kwargs):
+        """ Returns the number of unread messages of the participant (for badges). The total is cached. """
+        return Response({'total': Message.managers.get_unread_total(request.rest_messaging_participant.id)})
+
+    @list_route(methods=['get'])
+    def sync(self, request, *args, **kwargs):
+        """
+        Returns what changed in the threads of the participant since the cursor of his previous sync: the new messages of his active threads,
+        the participations which changed (joined, left, read) and his notification check. Without cursor, the client gets the current state
+        of the participations and a cursor to sync from. If has_more is true, the client syncs again with the new cursor at once.
+        """
+        participant_id = request.rest_messaging_participant.id
+        started = now()
+        cursor = request.GET.get('cursor', None)
+        if cursor:
+            after_message_id, changed_since, page_after_id = decode_sync_cursor(cursor)
+        else:
+            after_message_id, changed_since, page_after_id = None, None, None
+        messages, has_more, participations, notification_check = Message.managers.get_changes(participant_id, after_message_id, changed_since, page_after_id=page_after_id)
+        if has_more:
+            # the next page of the same sync
+            cursor = encode_sync_cursor(after_message_id, changed_since, messages[-1].id)
+        else:
+            # the next sync starts from the time this one started, the participations changed meanwhile are sent again
+            if after_message_id is None:
+                after_message_id = Message.managers.get_last_message_id(participant_id)
+            cursor = encode_sync_cursor(max([after_message_id] + [message.id for message in messages]), started)
+        return Response({
+            'cursor': cursor,
+            'has_more': has_more,
+            'messages': SyncMessageSerializer(messages, many=True).data,
+            'participations': ParticipationSerializer(participations, many=True).data,
+            'notification_check': notification_check.date_check if notification_check is not None else None,
+        })
+
+    @list_route(methods=['get'])
+    def long_poll(self, request, *args, **kwargs):
+        """
+        Waits until a message is posted in one of the threads of the participant, for REST_MESSAGING_LONG_POLL_TIMEOUT seconds at most.
+        cursor is the cursor of the previous response, without it the request waits for the next message.
+        The response holds the new cursor and the events, an empty list if the request timed out.
+        """
+        bus = get_event_bus()
+        if bus is None:
+            return Response("The event bus is not configured (REST_MESSAGING_EVENT_BUS).", status=status.HTTP_501_NOT_IMPLEMENTED)
+        participant_id = request.rest_messaging_participant.id
+        max_timeout = getattr(settings, 'REST_MESSAGING_LONG_POLL_TIMEOUT', 25)
+        try:
+            cursor = int(request.GET['cursor']) if 'cursor' in request.GET else bus.get_cursor(participant_id)
+            timeout = float(request.GET.get('timeout', max_timeout))
+            # nan would never time out
+            if math.isnan(timeout) or math.isinf(timeout):
+                raise ValueError('The timeout must be a finite number.')
+            timeout = min(max(timeout, 0), max_timeout)
+        except ValueError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        cursor, events = bus.wait(participant_id, cursor, timeout)
+        return Response({'cursor': cursor, 'events': events})
+
     @detail_route(methods=['post'], permission_classes=[IsInThread], serializer_class=SimpleMessageSerializer)
     def post_message(self, request, pk=None):
         """ Pk is the pk of the Thread to which the message belongs. """
         # we get the thread and check for permission
-        thread = Thread.objects.get(id=pk)
-        self.check_object_permissions(request, thread)
+        thread = self.get_thread(pk)
         # we get the body
         body = compat_get_request_data(self.request).get('body')
         # we create the message
@@ -154,18 +316,57 @@ class MessageView(mixins.ListModelMixin,
         except Exception:
             return Response(status=status.HTTP_412_PRECONDITION_FAILED)
 
+    @list_route(methods=['post'])
+    def bulk_post_messages(self, request, *args, **kwargs):
+        """ Posts many messages at once. messages is a json list of {"thread": thread_id, "body": body} objects. """
+        try:
+            messages = [(int(item['thread']), item['body']) for item in json.loads(compat_get_request_data(request).get('messages'))]
+        except (KeyError, TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if not all(isinstance(body, six.string_types) and body for thread_id, body in messages):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if len(messages) > getattr(settings, 'REST_MESSAGING_BULK_POST_MAX_MESSAGES', 500):
+            return Response("Too many messages.", status=status.HTTP_400_BAD_REQUEST)
+        # Message.managers.bulk_post_messages could return an Exception
+        try:
+            messages = Message.managers.bulk_post_messages(request.rest_messaging_participant.id, messages)
+        except PermissionDenied:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        except Exception:
+            return Response(status=status.HTTP_412_PRECONDITION_FAILED)
+        return Response({'count': len(messages), 'threads': sorted(set(message.thread_id for message in messages))}, status=status.HTTP_201_CREATED)
+
     @detail_route(methods=['get'], permission_classes=[IsInThread], serializer_class=ComplexMessageSerializer)
     def list_messages_in_thread(self, request, pk=None):
         """ Pk is the pk of the Thread to which the messages belong. """
         # we get the thread and check for permission
-        thread = Thread.objects.get(id=pk)
-        self.check_object_permissions(request, thread)
-        messages = Message.managers.get_all_messages_in_thread(participant_id=request.rest_messaging_participant.id, thread_id=thread.id, check_who_read=True)
-        page = self.paginate_queryset(messages)
-        if page is not None:
-            return compat_get_paginated_response(self, page)
-        serializer = ComplexMessageSerializer(messages, many=True)
-        return Response(serializer.data)
+        thread = self.get_thread(pk)
+        # the readers are only checked for the page
+        read_watermarks = self.read_watermarks_requested()
+        messages = Message.managers.get_all_messages_in_thread(participant_id=request.rest_messaging_participant.id, thread_id=thread.id, check_who_read=not read_watermarks)
+        if self.rows_requested():
+            messages = messages.as_rows()
+        if MessageCursorPagination.is_requested(request):
+            paginator = MessageCursorPagination()
+            page = paginator.paginate_queryset(messages, request, view=self)
+            serializer = self.get_row_serializer(page) if self.rows_requested() else self.get_serializer_class()(page, many=True)
+            response = paginator.get_paginated_response(serializer.data)
+        elif self.rows_requested():
+            page = self.paginate_queryset(messages)
+            if page is not None:
+                response = self.get_paginated_response(self.get_row_serializer(page).data)
+            else:
+                response = Response(self.get_row_serializer(messages).data)
+        else:
+            page = self.paginate_queryset(messages)
+            if page is not None:
+                response = compat_get_paginated_response(self, page)
+            else:
+                serializer = self.get_serializer_class()(messages, many=True)
+                response = Response(serializer.data)
+        if read_watermarks:
+            response = self.add_read_watermarks(response, [thread.id])
+        return response
 
 
 class NotificationCheckView(mixins.ListModelMixin, viewsets.GenericViewSet):
@@ -177,6 +378,13 @@ class NotificationCheckView(mixins.ListModelMixin, viewsets.GenericViewSet):
     def check(self, request, *args, **kwargs):
         # we get the NotificationCheck instance corresponding to the user or we create it
 
+        if readstate.is_enabled():
+            # the check is buffered (see rest_messaging.readstate), it is not saved yet
+            nc = NotificationCheck(participant=request.rest_messaging_participant, date_check=now())
+            readstate.buffer_notification_check(nc.participant_id, nc.date_check)
+            serializer = self.get_serializer(nc)
+            return Response(serializer.data, status=status.HTTP_200_OK)
+
         try:
             nc = NotificationCheck.objects.get(participant=request.rest_messaging_participant)
             if nc:
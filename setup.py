@@ -78,14 +78,19 @@ setup(
     packages=get_packages(package),
     package_data=get_package_data(package),
     install_requires = [
-         'django>=1.6',
-         'djangorestframework>=2.4.3',
+         'django>=1.8',
+         'djangorestframework>=3.0',
          'six',
     ],
+    extras_require={
+        'channels': ['channels>=1.0,<2'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
         'Framework :: Django',
+        'Framework :: Django :: 1.8',
+        'Framework :: Django :: 1.9',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
@@ -1,5 +1,11 @@
 def pytest_configure():
     from django.conf import settings
+    # the WebSocket consumer is tested when Django Channels is installed
+    try:
+        import channels  # NOQA
+        channels_apps = ('channels',)
+    except ImportError:
+        channels_apps = ()
     settings.configure(
         DEBUG_PROPAGATE_EXCEPTIONS=True,
         DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
@@ -36,7 +42,13 @@ def pytest_configure():
 
             # rest_messaging
             'rest_messaging',
-        ),
+        ) + channels_apps,
+        CHANNEL_LAYERS={
+            'default': {
+                'BACKEND': 'asgiref.inmemory.ChannelLayer',
+                'ROUTING': 'rest_messaging.routing.channel_routing',
+            },
+        },
         PASSWORD_HASHERS=(
             'django.contrib.auth.hashers.SHA1PasswordHasher',
             'django.contrib.auth.hashers.PBKDF2PasswordHasher',
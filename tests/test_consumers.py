@@ -0,0 +1,92 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from django.test.utils import override_settings
+from django.utils.timezone import now
+from unittest import skipUnless
+from rest_messaging.models import Message, Participation, Thread
+from .utils import TestScenario, commit_callbacks
+
+try:
+    from channels.test import WSClient
+    from channels.test.base import ChannelTestCaseMixin
+except ImportError:
+    WSClient = None
+
+    class ChannelTestCaseMixin(object):
+        pass
+
+
+@skipUnless(WSClient is not None, "Django Channels 1.x is not installed")
+@override_settings(REST_MESSAGING_CHANNELS=True)
+class TestMessagingConsumer(ChannelTestCaseMixin, TestScenario):
+
+    def connect(self, user):
+        client = WSClient()
+        client.force_login(user)
+        client.send_and_consume('websocket.connect', path='/messaging/ws/')
+        return client
+
+    def test_anonymous_user(self):
+        client = WSClient()
+        client.send_and_consume('websocket.connect', path='/messaging/ws/', check_accept=False)
+        self.assertEqual({'close': True}, client.receive(json=False))
+
+    def test_messages(self):
+        client = self.connect(self.user)
+        # the participant is in the thread, the message is sent once it is committed
+        with commit_callbacks():
+            message = Message.objects.create(sender=self.participant2, thread=self.thread1, body="hi")
+            self.assertEqual(None, client.receive())
+        received = client.receive()
+        self.assertEqual("message", received["type"])
+        self.assertEqual(message.id, received["message"]["id"])
+        self.assertEqual("hi", received["message"]["body"])
+        self.assertEqual(None, client.receive())
+        # he is not
+        with commit_callbacks():
+            Message.objects.create(sender=self.participant4, thread=self.thread_unrelated, body="hi")
+        self.assertEqual(None, client.receive())
+        # the messages posted at once
+        with commit_callbacks():
+            Message.managers.broadcast(self.participant2.id, "hello", [self.thread1.id, self.thread2.id])
+        self.assertEqual(["hello", "hello"], [client.receive()["message"]["body"] for i in range(2)])
+        # the connections are closed
+        client.send_and_consume('websocket.disconnect', path='/messaging/ws/')
+        with commit_callbacks():
+            Message.objects.create(sender=self.participant2, thread=self.thread1, body="hi")
+        self.assertEqual(None, client.receive())
+
+    def test_read_watermarks(self):
+        client = self.connect(self.user)
+        with commit_callbacks():
+            self.participation2.date_last_check = now()
+            self.participation2.save(update_fields=['date_last_check'])
+        received = client.receive()
+        self.assertEqual({"type": "read", "thread": self.thread1.id, "participant": self.participant2.id}, dict((key, received[key]) for key in ["type", "thread", "participant"]))
+        self.assertTrue(received["date_last_check"])
+
+    def test_threads_marked_as_read(self):
+        client = self.connect(self.user)
+        with commit_callbacks():
+            Thread.managers.mark_threads_as_read(self.participant2.id, thread_ids=[self.thread1.id])
+        received = client.receive()
+        self.assertEqual({"type": "read", "thread": self.thread1.id, "participant": self.participant2.id}, dict((key, received[key]) for key in ["type", "thread", "participant"]))
+        self.assertEqual(None, client.receive())
+
+    def test_participants_join_and_leave(self):
+        client = self.connect(self.user)
+        # the participant joins a thread
+        with commit_callbacks():
+            Participation.objects.create(participant=self.participant1, thread=self.thread_unrelated)
+            Message.objects.create(sender=self.participant4, thread=self.thread_unrelated, body="hi")
+        self.assertEqual("hi", client.receive()["message"]["body"])
+        # he leaves it
+        participation = Participation.objects.get(participant=self.participant1, thread=self.thread_unrelated)
+        with commit_callbacks():
+            participation.date_left = now()
+            participation.save()
+            Message.objects.create(sender=self.participant4, thread=self.thread_unrelated, body="hi")
+        self.assertEqual(None, client.receive())
@@ -0,0 +1,121 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase
+from django.test.utils import override_settings
+from rest_messaging import events
+from rest_messaging.events import CacheEventBus, InProcessEventBus, get_event_bus
+from rest_messaging.models import Message
+from .utils import TestScenario, commit_callbacks
+import threading
+import time
+
+
+class EventBusTests(object):
+
+    def get_bus(self):
+        raise NotImplementedError
+
+    def test_publish(self):
+        bus = self.get_bus()
+        self.assertEqual(0, bus.get_cursor(1))
+        bus.publish([1, 2], {"message": 1})
+        bus.publish([1], {"message": 2})
+        self.assertEqual((2, [{"message": 1}, {"message": 2}]), bus.get_events(1, 0))
+        self.assertEqual((2, [{"message": 2}]), bus.get_events(1, 1))
+        self.assertEqual((1, [{"message": 1}]), bus.get_events(2, 0))
+        self.assertEqual((0, []), bus.get_events(3, 0))
+
+    @override_settings(REST_MESSAGING_EVENT_BUS_BACKLOG=2)
+    def test_backlog(self):
+        bus = self.get_bus()
+        for i in range(3):
+            bus.publish([1], {"message": i})
+        # the client has missed an event
+        self.assertEqual((3, [{"message": 1}, {"message": 2}]), bus.get_events(1, 0))
+
+    def test_wait(self):
+        bus = self.get_bus()
+        # the request times out
+        self.assertEqual((0, []), bus.wait(1, 0, 0))
+        # the events published before are returned at once
+        bus.publish([1], {"message": 1})
+        self.assertEqual((1, [{"message": 1}]), bus.wait(1, 0, 5))
+        # a message is posted while the client waits
+        publisher = threading.Timer(0.1, bus.publish, args=([1], {"message": 2}))
+        publisher.start()
+        start = time.time()
+        self.assertEqual((2, [{"message": 2}]), bus.wait(1, 1, 5))
+        self.assertTrue(time.time() - start < 5)
+        publisher.join()
+        # the client has a cursor from another bus
+        self.assertEqual((2, []), bus.wait(1, 10, 5))
+        # a timeout which is not a number does not wait forever
+        self.assertEqual((2, []), bus.wait(1, 2, float('nan')))
+
+
+class TestInProcessEventBus(EventBusTests, TestCase):
+
+    def get_bus(self):
+        return InProcessEventBus()
+
+
+@override_settings(REST_MESSAGING_EVENT_BUS_POLL_INTERVAL=0.01)
+class TestCacheEventBus(EventBusTests, TestCase):
+
+    def get_bus(self):
+        cache.clear()
+        return CacheEventBus()
+
+    def test_shared_by_the_processes(self):
+        bus = self.get_bus()
+        bus.publish([1], {"message": 1})
+        self.assertEqual((1, [{"message": 1}]), CacheEventBus().get_events(1, 0))
+
+
+@override_settings(REST_MESSAGING_EVENT_BUS='rest_messaging.events.InProcessEventBus')
+class TestPublishMessages(TestScenario):
+
+    def setUp(self):
+        super(TestPublishMessages, self).setUp()
+        events._event_buses.clear()
+
+    def test_get_event_bus(self):
+        self.assertTrue(isinstance(get_event_bus(), InProcessEventBus))
+        self.assertTrue(get_event_bus() is get_event_bus())
+        with override_settings(REST_MESSAGING_EVENT_BUS=None):
+            self.assertEqual(None, get_event_bus())
+
+    def test_publish_messages(self):
+        bus = get_event_bus()
+        # the message is published once it is committed
+        with commit_callbacks():
+            message = Message.objects.create(sender=self.participant1, thread=self.thread2, body="hi")
+            self.assertEqual(0, bus.get_cursor(self.participant2.id))
+        cursor, published = bus.get_events(self.participant2.id, 0)
+        self.assertEqual([{"type": "message", "thread": self.thread2.id, "message": message.id, "sender": self.participant1.id, "sent_at": message.sent_at.isoformat()}], published)
+        # the sender is notified too, not the participants who left
+        self.assertEqual(1, bus.get_cursor(self.participant1.id))
+        self.assertEqual(0, bus.get_cursor(self.participant3.id))
+        # the messages posted at once
+        with commit_callbacks():
+            Message.managers.broadcast(self.participant1.id, "hello", [self.thread1.id, self.thread3.id])
+        self.assertEqual([self.thread1.id, self.thread3.id], sorted(event["thread"] for event in bus.get_events(self.participant3.id, 0)[1]))
+        # the updates are not published
+        with commit_callbacks():
+            message.body = "edited"
+            message.save()
+        self.assertEqual(3, bus.get_cursor(self.participant1.id))
+        # nor the messages rolled back
+        with commit_callbacks():
+            try:
+                with transaction.atomic():
+                    Message.objects.create(sender=self.participant1, thread=self.thread2, body="hi")
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(3, bus.get_cursor(self.participant1.id))
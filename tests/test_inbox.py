@@ -0,0 +1,119 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+from django.utils.timezone import now
+from rest_framework.test import APIRequestFactory
+from rest_messaging.models import InboxEntry, Message, Participation, Thread
+from .utils import TestScenario, parse_json_response
+
+
+@override_settings(REST_MESSAGING_INBOX=True)
+class TestInbox(TestScenario):
+
+    def setUp(self):
+        super(TestInbox, self).setUp()
+        self.url = "{0}inbox/".format(reverse('rest_messaging:messages-list'))
+        self.request = APIRequestFactory()
+        self.request.user = self.user
+        self.request.rest_messaging_participant = self.participant1
+
+    def get_entries(self):
+        return dict(((entry.thread_id, entry.participant_id), (entry.last_message_id, entry.snippet, entry.unread_count)) for entry in InboxEntry.objects.all())
+
+    def assertEntriesRebuilt(self):
+        """ The entries maintained are those the rebuild computes. """
+        entries = self.get_entries()
+        InboxEntry.objects.all().delete()
+        InboxEntry.managers.rebuild(list(Thread.objects.values_list('id', flat=True)))
+        self.assertEqual(self.get_entries(), entries)
+
+    def test_scenario(self):
+        entries = self.get_entries()
+        # the active participants only
+        self.assertEqual(10, len(entries))
+        self.assertEqual((self.m33.id, "hi", 2), entries[(self.thread3.id, self.participant1.id)])
+        self.assertEqual((self.m33.id, "hi", 1), entries[(self.thread3.id, self.participant3.id)])
+        self.assertEqual((None, "", 0), entries[(self.thread_unrelated.id, self.participant4.id)])
+        self.assertEntriesRebuilt()
+
+    @override_settings(REST_MESSAGING_INBOX_SNIPPET_LENGTH=5)
+    def test_messages(self):
+        message = Message.objects.create(sender=self.participant2, thread=self.thread1, body="Hello everyone")
+        entries = self.get_entries()
+        self.assertEqual((message.id, "Hello", 1), entries[(self.thread1.id, self.participant1.id)])
+        # his own messages are not unread
+        self.assertEqual((message.id, "Hello", 1), entries[(self.thread1.id, self.participant2.id)])
+        Message.managers.broadcast(self.participant1.id, "Good morning", [self.thread1.id, self.thread2.id])
+        entries = self.get_entries()
+        self.assertEqual(("Good ", 1), entries[(self.thread1.id, self.participant1.id)][1:])
+        self.assertEqual(2, entries[(self.thread1.id, self.participant2.id)][2])
+        self.assertEqual(2, entries[(self.thread2.id, self.participant2.id)][2])
+        self.assertEntriesRebuilt()
+        # the last message is deleted
+        last = Message.objects.filter(thread=self.thread1).latest('id')
+        last.delete()
+        self.assertEqual((message.id, "Hello", 1), self.get_entries()[(self.thread1.id, self.participant2.id)])
+
+    def test_participants(self):
+        self.thread1.add_participants(self.request, self.participant4.id)
+        self.assertEqual((self.m11.id, "hi", 1), self.get_entries()[(self.thread1.id, self.participant4.id)])
+        self.thread1.remove_participant(self.request, self.participant1)
+        self.assertFalse((self.thread1.id, self.participant1.id) in self.get_entries())
+        # joining again
+        Participation.objects.create(thread=self.thread1, participant=self.participant1)
+        self.assertEqual((self.m11.id, "hi", 0), self.get_entries()[(self.thread1.id, self.participant1.id)])
+        Thread.managers.get_or_create_threads(self.request, [[self.participant4.id], [self.participant5.id]])
+        self.assertEqual(10 + 1 + 4, len(self.get_entries()))
+        self.assertEntriesRebuilt()
+
+    def test_read(self):
+        self.p1.mark_as_read()
+        self.assertEqual(0, self.get_entries()[(self.thread3.id, self.participant1.id)][2])
+        Thread.managers.mark_threads_as_read(self.participant1.id)
+        self.assertEqual(0, self.get_entries()[(self.thread2.id, self.participant1.id)][2])
+        self.assertEntriesRebuilt()
+
+    @override_settings(REST_MESSAGING_BUFFER_READ_STATE=True)
+    def test_buffered_read(self):
+        from rest_messaging.readstate import flush_read_states
+        self.client_authenticated.get(self.url)  # the participant is cached
+        self.p1.mark_as_read()
+        self.assertEqual(2, self.get_entries()[(self.thread3.id, self.participant1.id)][2])
+        parsed = parse_json_response(self.client_authenticated.get(self.url).data)
+        self.assertEqual([0], [entry["unread_count"] for entry in parsed["results"] if entry["thread"] == self.thread3.id])
+        flush_read_states()
+        self.assertEqual(0, self.get_entries()[(self.thread3.id, self.participant1.id)][2])
+
+    @override_settings(DJANGO_REST_MESSAGING_MESSAGES_PAGE_SIZE=2)
+    def test_view(self):
+        self.assertEqual(403, self.client_unauthenticated.get(self.url).status_code)
+        self.client_authenticated.get(self.url)  # the participant is cached
+        # a range of the index
+        with self.assertNumQueries(3):
+            response = self.client_authenticated.get(self.url)
+        self.assertEqual(200, response.status_code)
+        parsed = parse_json_response(response.data)
+        self.assertEqual([self.thread3.id, self.thread2.id, self.thread1.id], [entry["thread"] for entry in parsed["results"]])
+        self.assertEqual({"thread": self.thread2.id, "last_message": self.m22.id, "snippet": "hi", "unread_count": 1}, dict((key, parsed["results"][1][key]) for key in ["thread", "last_message", "snippet", "unread_count"]))
+        # the pages
+        response = self.client_authenticated.get(self.url, data={"before": self.m33.id})
+        self.assertEqual([self.thread2.id, self.thread1.id], [entry["thread"] for entry in parse_json_response(response.data)["results"]])
+
+    @override_settings(REST_MESSAGING_INBOX=False)
+    def test_view_disabled(self):
+        self.assertEqual(501, self.client_authenticated.get(self.url).status_code)
+
+    def test_command(self):
+        entries = self.get_entries()
+        InboxEntry.objects.all().delete()
+        out = StringIO()
+        call_command('rebuild_inbox', batch_size=2, stdout=out)
+        self.assertEqual(entries, self.get_entries())
+        self.assertTrue("10 inbox entries rebuilt." in out.getvalue())
+        self.assertTrue(InboxEntry.objects.filter(updated_at__lte=now()).exists())
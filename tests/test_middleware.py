@@ -5,11 +5,16 @@
 from __future__ import unicode_literals
 
 from django.core.cache import cache
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.middleware import AuthenticationMiddleware
 from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
 from django.core.exceptions import ObjectDoesNotExist
 from django.test import RequestFactory, TestCase
+from django.test.utils import override_settings
 from rest_messaging.middleware import MessagingMiddleware
 from rest_messaging.models import Participant
+from rest_messaging.views import MessageView
 
 
 class TestMessagingMiddleware(TestCase):
@@ -28,14 +33,18 @@ class TestMessagingMiddleware(TestCase):
         cache.clear()
         # we have no participant yet
         self.assertRaises(ObjectDoesNotExist, Participant.objects.get, id=self.request.user.id)
-        with self.assertNumQueries(2):
+        # the participant is resolved when it is used, and created in a savepoint
+        with self.assertNumQueries(0):
             self.middleware.process_view(request=self.request, callback=None, callback_args=None, callback_kwargs=None)
+        with self.assertNumQueries(4):
+            self.request.rest_messaging_participant.id
         # the user has been created
         self.assertTrue(Participant.objects.get(id=self.request.user.id))
         self.assertEqual(self.request.rest_messaging_participant.id, self.request.user.id)
         # we rehit the middleware, rest_messaging_participant has been cached
         with self.assertNumQueries(0):
             self.middleware.process_view(request=self.request, callback=None, callback_args=None, callback_kwargs=None)
+            self.assertEqual(self.request.rest_messaging_participant.id, self.request.user.id)
 
     def test_middleware_existing_participant(self):
         """ This test ensures the middleware creates the Participant corresponding to request.user, if not done yet. """
@@ -45,7 +54,75 @@ class TestMessagingMiddleware(TestCase):
         Participant.objects.create(id=self.request.user.id)
         with self.assertNumQueries(1):
             self.middleware.process_view(request=self.request, callback=None, callback_args=None, callback_kwargs=None)
-        self.assertEqual(self.request.rest_messaging_participant.id, self.request.user.id)
+            self.assertEqual(self.request.rest_messaging_participant.id, self.request.user.id)
         # we rehit the middleware, rest_messaging_participant has been cached
         with self.assertNumQueries(0):
             self.middleware.process_view(request=self.request, callback=None, callback_args=None, callback_kwargs=None)
+            self.assertEqual(self.request.rest_messaging_participant.id, self.request.user.id)
+
+    @override_settings(REST_MESSAGING_PARTICIPANT_LOCAL_CACHE_SIZE=2)
+    def test_middleware_local_cache(self):
+        """ The in-process cache avoids the requests to the Django cache. """
+        cache.clear()
+        middleware = MessagingMiddleware()
+        Participant.objects.create(id=self.request.user.id)
+        for i in range(3):
+            middleware.process_view(request=self.request, callback=None, callback_args=None, callback_kwargs=None)
+            self.assertEqual(self.request.rest_messaging_participant.id, self.request.user.id)
+        self.assertEqual({'local_cache_hits': 2, 'local_cache_misses': 1, 'shared_cache_hits': 0, 'shared_cache_misses': 1}, middleware.get_stats())
+        # another process finds the id in the Django cache
+        other_middleware = MessagingMiddleware()
+        with self.assertNumQueries(0):
+            other_middleware.process_view(request=self.request, callback=None, callback_args=None, callback_kwargs=None)
+            self.request.rest_messaging_participant.id
+        self.assertEqual({'local_cache_hits': 0, 'local_cache_misses': 1, 'shared_cache_hits': 1, 'shared_cache_misses': 0}, other_middleware.get_stats())
+        # the participant is usable as a saved instance
+        self.assertFalse(self.request.rest_messaging_participant._state.adding)
+        self.assertEqual(Participant.objects.get(id=self.request.user.id), self.request.rest_messaging_participant)
+
+    def test_middleware_anonymous_user(self):
+        self.request.user.is_authenticated = lambda *args, **kwargs: False
+        self.middleware.process_view(request=self.request, callback=None, callback_args=None, callback_kwargs=None)
+        self.assertTrue(self.request.rest_messaging_participant is None)
+        self.assertEqual({'local_cache_hits': 0, 'local_cache_misses': 0, 'shared_cache_hits': 0, 'shared_cache_misses': 0}, self.middleware.get_stats())
+
+    def test_middleware_lazy_user(self):
+        # the session and the user are loaded by the authentication middleware when request.user is first used
+        request = self.factory.get('/')
+        request.session = SessionStore()
+        request.session[SESSION_KEY] = self.request.user.pk
+        request.session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        request.session[HASH_SESSION_KEY] = self.request.user.get_session_auth_hash()
+        request.session.save()
+        request.session = SessionStore(request.session.session_key)
+        AuthenticationMiddleware().process_request(request)
+        cache.clear()
+        # a view which does not use the participant loads nothing
+        with self.assertNumQueries(0):
+            self.middleware.process_view(request=request, callback=lambda request: None, callback_args=None, callback_kwargs=None)
+        self.assertEqual({'local_cache_hits': 0, 'local_cache_misses': 0, 'shared_cache_hits': 0, 'shared_cache_misses': 0}, self.middleware.get_stats())
+        # the session, the user and the participant are loaded when it is used
+        with self.assertNumQueries(2 + 4):
+            self.assertEqual(self.request.user.id, request.rest_messaging_participant.id)
+        # an anonymous user not loaded yet has a participant resolved to None
+        request = self.factory.get('/')
+        request.session = SessionStore()
+        AuthenticationMiddleware().process_request(request)
+        with self.assertNumQueries(0):
+            self.middleware.process_view(request=request, callback=lambda request: None, callback_args=None, callback_kwargs=None)
+        self.assertFalse(request.rest_messaging_participant)
+
+    @override_settings(REST_MESSAGING_MIDDLEWARE_ONLY_FOR_MESSAGING_VIEWS=True)
+    def test_middleware_only_for_messaging_views(self):
+        self.middleware.process_view(request=self.request, callback=lambda request: None, callback_args=None, callback_kwargs=None)
+        self.assertTrue(self.request.rest_messaging_participant is None)
+        # the views of the router, and their subclasses
+        self.middleware.process_view(request=self.request, callback=MessageView.as_view({'get': 'list'}), callback_args=None, callback_kwargs=None)
+        self.assertEqual(self.request.rest_messaging_participant.id, self.request.user.id)
+
+        class CustomMessageView(MessageView):
+            pass
+
+        del self.request.rest_messaging_participant
+        self.middleware.process_view(request=self.request, callback=CustomMessageView.as_view({'get': 'list'}), callback_args=None, callback_kwargs=None)
+        self.assertEqual(self.request.rest_messaging_participant.id, self.request.user.id)
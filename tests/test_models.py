@@ -3,12 +3,23 @@
 # vim: set fileencoding=utf8 :
 
 from __future__ import unicode_literals
-from django.db import IntegrityError
+from contextlib import contextmanager
+from django.apps import apps
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.backends.utils import CursorDebugWrapper
+from django.utils.six import StringIO
 from django.utils.timezone import now, timedelta
 from django.test import RequestFactory, TestCase
-from django.test.utils import override_settings
-from rest_messaging.models import Message, Participant, Participation, Thread
-from .utils import TestScenario
+from django.test.utils import CaptureQueriesContext, override_settings
+from unittest import skipUnless
+from rest_messaging.models import Message, Participant, Participation, Thread, compute_participants_fingerprint
+from rest_messaging.ratelimit import QueryCountBackend
+from rest_messaging.signals import messages_bulk_created, threads_bulk_created
+from .utils import TestScenario, commit_callbacks
+import importlib
 
 
 # callback to check override_settings
@@ -63,18 +74,49 @@ class TestThread(TestScenario):
 
     def test_get_threads_where_participant_is_active(self):
         # participant 1 is active in thread 1, 2 and 3
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             threads = Thread.managers.get_threads_where_participant_is_active(self.participant1.id)
             self.assertEqual(set([self.thread1, self.thread2, self.thread3]), set(threads))  # ordering is indifferent
             self.assertEqual(3, len(threads))
         # participant 1 leave thread 1
         self.participation1.date_left = now()
         self.participation1.save()
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             threads = Thread.managers.get_threads_where_participant_is_active(self.participant1.id)
             self.assertEqual(set([self.thread2, self.thread3]), set(threads))  # ordering is indifferent
             self.assertEqual(2, len(threads))
 
+    def test_get_threads_where_participant_is_active_is_flat(self):
+        # the query does not grow with the number of threads of the participant
+        queries = []
+        for count in [10, 1000]:
+            threads = [Thread(name="Thread {0}".format(i)) for i in range(count)]
+            Thread.objects.bulk_create(threads)
+            participations = [Participation(participant=self.participant6, thread=thread) for thread in Thread.objects.filter(name__startswith="Thread ")]
+            Participation.objects.bulk_create(participations)
+            with self.assertNumQueries(1):
+                threads = Thread.managers.get_threads_where_participant_is_active(self.participant6.id)
+                self.assertEqual(count + 1, len(threads))  # with self.thread_unrelated
+            queries.append(str(threads.query))
+            Participation.objects.filter(thread__name__startswith="Thread ").delete()
+            Thread.objects.filter(name__startswith="Thread ").delete()
+        self.assertEqual(queries[0], queries[1])
+
+    def test_participation_is_active(self):
+        self.assertTrue(Participation.objects.get(id=self.participation1.id).is_active)
+        self.participation1.date_left = now()
+        self.participation1.save(update_fields=['date_left'])
+        self.assertFalse(Participation.objects.get(id=self.participation1.id).is_active)
+
+    def test_participation_is_active_in_bulk(self):
+        # the participations created or updated without save
+        Participation.objects.filter(id=self.participation1.id).update(date_left=now())
+        self.assertFalse(Participation.objects.get(id=self.participation1.id).is_active)
+        Participation.objects.filter(id=self.participation1.id).update(date_left=None)
+        self.assertTrue(Participation.objects.get(id=self.participation1.id).is_active)
+        Participation.objects.bulk_create([Participation(participant=self.participant4, thread=self.thread1, date_left=now())])
+        self.assertFalse(Participation.objects.get(participant=self.participant4, thread=self.thread1).is_active)
+
     def test_get_active_threads_involving_all_participants(self):
         # there is an active thread with participants 1, 2 and 3
         with self.assertNumQueries(1):
@@ -106,25 +148,89 @@ class TestThread(TestScenario):
             thread = Thread.managers.get_or_create_thread(self.request_authenticated, None, self.participant1.id, self.participant2.id, self.participant3.id)
         self.assertEqual(thread.id, self.thread1.id)
         # if we ask the Thread for Participant 1 and 2, we get a new Thread because user 3 was in self.thread2
-        with self.assertNumQueries(4):
+        # (the thread and its participants are created in a savepoint, the thread is inserted in a nested one
+        # and its fingerprint is checked once the participants are added)
+        with self.assertNumQueries(9):
             thread_new = Thread.managers.get_or_create_thread(self.request_authenticated, None, self.participant1.id, self.participant2.id)
         self.assertNotEqual(thread_new.id, self.thread2.id)
         self.assertEqual(thread_new.id, Thread.objects.latest('id').id)
         # if we open a Thread for Participant 1 and 4 (not existing yet, we simply get a new one)
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(9):
             thread_new2 = Thread.managers.get_or_create_thread(self.request_authenticated, None, self.participant1.id, self.participant4.id)
         self.assertEqual(thread_new2.id, Thread.objects.latest('id').id)
 
+    def test_get_or_create_thread_rolled_back(self):
+        setattr(self.request_authenticated, "rest_messaging_participant", self.participant1)
+        count = Thread.objects.count()
+
+        def failing_callback(request, *participant_ids):
+            raise ValueError
+
+        # the thread is not left without participants, holding the fingerprint
+        with override_settings(REST_MESSAGING_ADD_PARTICIPANTS_CALLBACK=failing_callback):
+            self.assertRaises(ValueError, Thread.managers.get_or_create_thread, self.request_authenticated, None, self.participant1.id, self.participant4.id)
+        self.assertEqual(count, Thread.objects.count())
+        self.assertEqual(None, Thread.managers.get_thread_by_participants_fingerprint(self.participant1.id, self.participant4.id))
+        thread = Thread.managers.get_or_create_thread(self.request_authenticated, None, self.participant1.id, self.participant4.id)
+        self.assertEqual(set([self.participant1.id, self.participant4.id]), set(thread.get_participants_ids()))
+
     @override_settings(REST_MESSAGING_THREAD_UNIQUE_FOR_ACTIVE_RECIPIENTS=False)
     def test_get_or_create_thread_multiple(self):
         # we set rest_messaging_participant, which is normally done in the middleware
         setattr(self.request_authenticated, "rest_messaging_participant", self.participant1)
         # we get the same as above but do not re-attach to older Thread instances
-        with self.assertNumQueries(3):
+        # the new thread cannot hold the fingerprint, which belongs to self.thread1
+        with self.assertNumQueries(10):
             thread = Thread.managers.get_or_create_thread(self.request_authenticated, None, self.participant1.id, self.participant2.id, self.participant3.id)
         self.assertNotEqual(thread.id, self.thread1.id)
         self.assertEqual(thread.id, Thread.objects.latest('id').id)
 
+    def test_get_or_create_threads(self):
+        # we set rest_messaging_participant, which is normally done in the middleware
+        setattr(self.request_authenticated, "rest_messaging_participant", self.participant1)
+        Participant.objects.bulk_create([Participant(id=i) for i in range(7, 107)])
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        threads_bulk_created.connect(receiver)
+        try:
+            # participant 1 opens a discussion with each of 100 participants and one with participants 2 and 3 (self.thread1)
+            groups = [[i] for i in range(7, 107)] + [[self.participant2.id, self.participant3.id]]
+            # the lookup, the threads inserted (in a savepoint) and fetched, and the participations, all in a savepoint
+            with self.assertNumQueries(8):
+                threads = Thread.managers.get_or_create_threads(self.request_authenticated, groups)
+        finally:
+            threads_bulk_created.disconnect(receiver)
+        self.assertEqual(101, len(threads))
+        self.assertEqual(self.thread1, threads[-1])
+        self.assertEqual(1, len(received))
+        self.assertEqual(threads[:-1], received[0]['threads'])
+        for i, thread in enumerate(threads[:-1]):
+            self.assertEqual(set([self.participant1.id, i + 7]), set(thread.participants.values_list('id', flat=True)))
+            self.assertEqual(compute_participants_fingerprint([self.participant1.id, i + 7]), thread.participants_fingerprint)
+        # the threads are found again, a thread is not created twice for the same group
+        with self.assertNumQueries(1):
+            self.assertEqual(threads[:2], Thread.managers.get_or_create_threads(self.request_authenticated, [[7], [8]]))
+        self.assertEqual([threads[0]] * 2, Thread.managers.get_or_create_threads(self.request_authenticated, [[7], [7, self.participant1.id]]))
+        # the groups are the same as for get_or_create_thread
+        self.assertEqual(threads[2], Thread.managers.get_or_create_thread(self.request_authenticated, None, 9))
+        self.assertRaises(Exception, Thread.managers.get_or_create_threads, self.request_authenticated, [[7], []])
+        # the number of participants is limited
+        thread = Thread.managers.get_or_create_threads(self.request_authenticated, [range(7, 27)])[0]
+        self.assertEqual(10, thread.participants.count())
+        self.assertEqual(compute_participants_fingerprint(thread.participants.values_list('id', flat=True)), Thread.objects.get(id=thread.id).participants_fingerprint)
+
+    @override_settings(REST_MESSAGING_THREAD_UNIQUE_FOR_ACTIVE_RECIPIENTS=False)
+    def test_get_or_create_threads_multiple(self):
+        # we set rest_messaging_participant, which is normally done in the middleware
+        setattr(self.request_authenticated, "rest_messaging_participant", self.participant1)
+        threads = Thread.managers.get_or_create_threads(self.request_authenticated, [[self.participant2.id, self.participant3.id], [self.participant4.id], [self.participant4.id]])
+        self.assertEqual(3, len(set(thread.id for thread in threads)))
+        self.assertNotIn(self.thread1, threads)
+        self.assertEqual(set([self.participant1.id, self.participant4.id]), set(threads[2].participants.values_list('id', flat=True)))
+
     def test_get_or_create_thread_one_participant(self):
         # we set rest_messaging_participant, which is normally done in the middleware
         setattr(self.request_authenticated, "rest_messaging_participant", self.participant1)
@@ -139,7 +245,8 @@ class TestThread(TestScenario):
         request.rest_messaging_participant = Participant.objects.get(id=self.user.id)
         self.assertTrue(all(participant in [self.participant1, self.participant2, self.participant3] for participant in self.thread1.participants.all()))
         self.assertEqual(3, len(self.thread1.participants.all()))
-        with self.assertNumQueries(2):
+        # the fingerprint is updated in a savepoint
+        with self.assertNumQueries(6):
             self.thread1.add_participants(request, self.participant4.id, self.participant5.id)
         self.assertTrue(all(participant in [self.participant1, self.participant2, self.participant3, self.participant4, self.participant5] for participant in self.thread1.participants.all()))
         self.assertEqual(5, len(self.thread1.participants.all()))
@@ -151,6 +258,116 @@ class TestThread(TestScenario):
         self.thread1.add_participants(request, *[p.id for p in l])
         self.assertEqual(10, len(self.thread1.participants.all()))
 
+    def test_get_thread_with_participations(self):
+        request = RequestFactory()
+        request.user = self.user
+        with self.assertNumQueries(1):
+            thread = Thread.managers.get_thread_with_participations(self.thread2.id)
+            self.assertEqual(self.thread2, thread)
+            self.assertEqual(self.participant1, thread.is_participant(request))
+            self.assertEqual([self.participant1.id, self.participant2.id, self.participant3.id], thread.get_participants_ids())
+            self.assertEqual(self.participant3.id, thread.get_participation(self.participant3.id).participant_id)
+            self.assertEqual(None, thread.get_participation(self.participant4.id))
+            self.assertEqual(None, thread.update_participants_fingerprint())
+        self.assertRaises(Thread.DoesNotExist, Thread.managers.get_thread_with_participations, 0)
+        # the cache is cleared when participants are added
+        request.rest_messaging_participant = self.participant1
+        thread.add_participants(request, self.participant4.id)
+        self.assertEqual(set([self.participant1.id, self.participant2.id, self.participant3.id, self.participant4.id]), set(thread.get_participants_ids()))
+
+    def test_participations_cache_uncommitted(self):
+        request = RequestFactory()
+        request.user = self.user
+        request.rest_messaging_participant = self.participant1
+        thread_id = self.thread1.id
+        Thread.managers.get_participations([thread_id])  # cached
+        version = Thread.managers._get_participations_versions([thread_id])[thread_id]
+        participations_before = cache.get(Thread.managers._participations_cache_key(thread_id, version))
+        with commit_callbacks():
+            self.thread1.add_participants(request, self.participant4.id)
+            # the transaction does not cache its change
+            self.assertEqual(4, len(Thread.managers.get_participations([thread_id])[thread_id]))
+            version = Thread.managers._get_participations_versions([thread_id])[thread_id]
+            self.assertEqual(None, cache.get(Thread.managers._participations_cache_key(thread_id, version)))
+            # another process reads the participations before the commit
+            cache.set(Thread.managers._participations_cache_key(thread_id, version), participations_before)
+        # they are invalidated again once it is committed
+        other_request = RequestFactory()
+        other_request.user = other_request.rest_messaging_participant = self.participant4
+        self.assertEqual(self.participant4, Thread.objects.get(id=thread_id).is_participant(other_request))
+        with self.assertNumQueries(0):
+            self.assertEqual(4, len(Thread.managers.get_participations([thread_id])[thread_id]))
+
+    def test_participations_cache(self):
+        with self.assertNumQueries(1):
+            participations = Thread.managers.get_participations([self.thread1.id, self.thread2.id])
+        self.assertEqual([self.participant1.id, self.participant2.id, self.participant3.id], [p.participant_id for p in participations[self.thread2.id]])
+        self.assertEqual([True, True, False], [p.is_active for p in participations[self.thread2.id]])
+        self.assertFalse(participations[self.thread1.id][0]._state.adding)
+        # the participations are cached
+        request = RequestFactory()
+        request.user = self.user
+        request.rest_messaging_participant = self.participant1
+        with self.assertNumQueries(0):
+            self.assertEqual(self.participant1, self.thread1.is_participant(request))
+            self.assertEqual([self.participant1.id, self.participant2.id, self.participant3.id], self.thread1.get_participants_ids())
+        # the participants join
+        self.thread1.add_participants(request, self.participant4.id)
+        self.assertEqual([self.participant1.id, self.participant2.id, self.participant3.id, self.participant4.id], [p.participant_id for p in Thread.managers.get_participations([self.thread1.id])[self.thread1.id]])
+        # they read the thread
+        participation = self.thread1.get_participation(self.participant4.id)
+        participation.date_last_check = now()
+        participation.save(update_fields=['date_last_check'])
+        self.assertEqual(participation.date_last_check, Thread.managers.get_participations([self.thread1.id])[self.thread1.id][3].date_last_check)
+        # they leave
+        other_request = RequestFactory()
+        other_request.user = other_request.rest_messaging_participant = self.participant4
+        Thread.objects.get(id=self.thread1.id).remove_participant(other_request, self.participant4)
+        self.assertFalse(Thread.managers.get_participations([self.thread1.id])[self.thread1.id][3].is_active)
+        # the participations are deleted
+        self.assertEqual(2, len(Thread.managers.get_participations([self.thread3.id])[self.thread3.id]))
+        Participation.objects.filter(thread=self.thread3).delete()
+        self.assertEqual([], Thread.managers.get_participations([self.thread3.id])[self.thread3.id])
+        # the threads opened at once
+        thread = Thread.managers.get_or_create_threads(request, [[self.participant5.id]])[0]
+        self.assertEqual(set([self.participant1.id, self.participant5.id]), set(Thread.objects.get(id=thread.id).get_participants_ids()))
+        # the other threads are still cached
+        with self.assertNumQueries(0):
+            Thread.managers.get_participations([self.thread2.id])
+
+    def test_participants_fingerprint(self):
+        # the fingerprint is set for the threads where no one has left
+        self.assertEqual(compute_participants_fingerprint([self.participant1.id, self.participant2.id, self.participant3.id]), Thread.objects.get(id=self.thread1.id).participants_fingerprint)
+        self.assertEqual(compute_participants_fingerprint([self.participant3.id, self.participant1.id]), Thread.objects.get(id=self.thread3.id).participants_fingerprint)
+        self.assertEqual(None, Thread.objects.get(id=self.thread2.id).participants_fingerprint)
+        # the lookup is a single query
+        with self.assertNumQueries(1):
+            self.assertEqual(self.thread3, Thread.managers.get_thread_by_participants_fingerprint(self.participant3.id, self.participant1.id))
+        # adding participants updates the fingerprint
+        request = RequestFactory()
+        request.user = self.user
+        request.rest_messaging_participant = self.participant1
+        self.thread3.add_participants(request, self.participant4.id)
+        self.assertEqual(self.thread3, Thread.managers.get_thread_by_participants_fingerprint(self.participant1.id, self.participant3.id, self.participant4.id))
+        self.assertEqual(None, Thread.managers.get_thread_by_participants_fingerprint(self.participant1.id, self.participant3.id))
+        # get_or_create_thread re-attaches to the thread
+        thread = Thread.managers.get_or_create_thread(request, None, self.participant3.id, self.participant4.id)
+        self.assertEqual(self.thread3.id, thread.id)
+        # someone leaving clears the fingerprint
+        self.thread3.remove_participant(request, self.participant1)
+        self.assertEqual(None, Thread.objects.get(id=self.thread3.id).participants_fingerprint)
+        self.assertEqual(None, Thread.managers.get_thread_by_participants_fingerprint(self.participant1.id, self.participant3.id, self.participant4.id))
+
+    def test_participants_fingerprint_unique(self):
+        # a second thread with the same participants does not get the fingerprint
+        thread = Thread.objects.create(name="All in, again")
+        for participant in [self.participant1, self.participant2, self.participant3]:
+            Participation.objects.create(participant=participant, thread=thread)
+        self.assertEqual(None, Thread.objects.get(id=thread.id).participants_fingerprint)
+        self.assertEqual(self.thread1, Thread.managers.get_thread_by_participants_fingerprint(self.participant1.id, self.participant2.id, self.participant3.id))
+        # two threads cannot be inserted with the same fingerprint
+        self.assertRaises(IntegrityError, Thread.objects.create, participants_fingerprint=Thread.objects.get(id=self.thread1.id).participants_fingerprint)
+
     @override_settings(REST_MESSAGING_ADD_PARTICIPANTS_CALLBACK=lambda *args: [])
     def test_add_participants_callback(self):
         # this can be overriden
@@ -214,8 +431,125 @@ class TestMessage(TestScenario):
         new = Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
         self.assertEqual(new.id, last.id + 1)
 
+    def test_bulk_post_messages(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        messages_bulk_created.connect(receiver)
+        try:
+            # the number of queries does not depend on the number of messages (with small batches, on the number of batches),
+            # the sequences of the threads are reserved by one UPDATE for each number of messages per thread,
+            # and the ids of the messages inserted are read back by their sequences (bulk_create does not set them on SQLite)
+            with self.assertNumQueries(10):
+                messages = Message.managers.bulk_post_messages(self.participant1.id, [(self.thread1.id, "a"), (self.thread3.id, "b"), (self.thread1.id, "c")])
+            with self.assertNumQueries(9):
+                Message.managers.bulk_post_messages(self.participant1.id, [(self.thread1.id, "hi {0}".format(i)) for i in range(100)])
+        finally:
+            messages_bulk_created.disconnect(receiver)
+        self.assertEqual(3, len(messages))
+        self.assertEqual([2, 4, 3], [message.sequence for message in messages])
+        self.assertEqual(2, len(received))
+        self.assertEqual([self.thread1.id, self.thread3.id], received[0]['thread_ids'])
+        self.assertEqual(messages, received[0]['messages'])
+        self.assertEqual(self.participant1.id, received[0]['participant_id'])
+        # the threads point to their last message
+        self.assertEqual("hi 99", Thread.objects.get(id=self.thread1.id).last_message.body)
+        self.assertEqual("b", Thread.objects.get(id=self.thread3.id).last_message.body)
+        # the batches split the insert, the sequences and the lookups
+        with self.assertNumQueries(16):
+            Message.managers.broadcast(self.participant1.id, "announce", [self.thread1.id, self.thread2.id, self.thread3.id], batch_size=2)
+        self.assertEqual(3, Message.objects.filter(body="announce").count())
+
+    def test_sequence(self):
+        # the messages of each thread are numbered
+        self.assertEqual([1, 2, 3], list(Message.objects.filter(thread=self.thread3).order_by('id').values_list('sequence', flat=True)))
+        # the thread is locked, the message inserted, then the sequence and the last message of the thread are set by one UPDATE
+        Thread.managers.get_participations([self.thread3.id])  # cached
+        with self.assertNumQueries(3):
+            message = Message.objects.create(sender=self.participant1, thread=self.thread3, body="hi")
+        self.assertEqual(4, message.sequence)
+        self.assertEqual((4, message.id), Thread.objects.filter(id=self.thread3.id).values_list('message_sequence', 'last_message').get())
+        # an update keeps the sequence
+        message.save()
+        self.assertEqual(4, Message.objects.get(id=message.id).sequence)
+        # the migration numbers the existing messages
+        Message.objects.update(sequence=None)
+        Thread.objects.update(message_sequence=0)
+        migration = importlib.import_module('rest_messaging.migrations.0007_message_sequence')
+        # in several batches
+        batch_size, migration.BATCH_SIZE = migration.BATCH_SIZE, 2
+        try:
+            migration.number_messages(apps, connection.schema_editor())
+        finally:
+            migration.BATCH_SIZE = batch_size
+        self.assertEqual([1, 2, 3, 4], list(Message.objects.filter(thread=self.thread3).order_by('id').values_list('sequence', flat=True)))
+        self.assertEqual([1, 2], list(Message.objects.filter(thread=self.thread2).order_by('id').values_list('sequence', flat=True)))
+        self.assertEqual(4, Thread.objects.get(id=self.thread3.id).message_sequence)
+
+    def test_bulk_post_messages_checks_participations(self):
+        # participant 3 has left thread 2
+        for thread in [self.thread2, self.thread_unrelated]:
+            self.assertRaises(PermissionDenied, Message.managers.bulk_post_messages, self.participant3.id, [(self.thread1.id, "a"), (thread.id, "b")])
+        self.assertEqual(0, Message.objects.filter(body="a").count())
+        self.assertEqual([], Message.managers.bulk_post_messages(self.participant3.id, []))
+
+    @override_settings(REST_MESSAGING_DAILY_LIMIT_CALLBACK=lambda *args, **kwargs: 10)
+    def test_bulk_post_messages_daily_limit(self):
+        # participant 1 has sent 3 messages in setUp, the set is accepted or refused as a whole
+        self.assertRaises(Exception, Message.managers.bulk_post_messages, self.participant1.id, [(self.thread1.id, "a")] * 8)
+        self.assertEqual(0, Message.objects.filter(body="a").count())
+        Message.managers.bulk_post_messages(self.participant1.id, [(self.thread1.id, "a")] * 7)
+        self.assertEqual(7, Message.objects.filter(body="a").count())
+
+    def test_bulk_post_messages_daily_limit_per_message(self):
+        # the limit depends on the thread, the callback is asked for each message
+        thread1_id = self.thread1.id
+        with override_settings(REST_MESSAGING_DAILY_LIMIT_CALLBACK=lambda message, *args, **kwargs: 4 if message.thread_id == thread1_id else None):
+            self.assertRaises(Exception, Message.managers.bulk_post_messages, self.participant1.id, [(self.thread3.id, "a"), (self.thread1.id, "a")])
+            self.assertEqual(0, Message.objects.filter(body="a").count())
+            Message.managers.bulk_post_messages(self.participant1.id, [(self.thread3.id, "a")] * 5)
+        self.assertEqual(5, Message.objects.filter(body="a").count())
+
+    def test_bulk_post_messages_ids(self):
+        # the messages returned and their events have ids, on every database
+        messages = Message.managers.bulk_post_messages(self.participant1.id, [(self.thread1.id, "a"), (self.thread3.id, "b"), (self.thread1.id, "c")], batch_size=1)
+        self.assertEqual(list(Message.objects.filter(body__in=["a", "b", "c"]).order_by('id').values_list('id', flat=True)), sorted(message.id for message in messages))
+        self.assertEqual(["a", "b", "c"], [Message.objects.get(id=message.id).body for message in messages])
+
+    def test_last_message(self):
+        # the threads point to their last message
+        self.assertEqual(self.m11.id, Thread.objects.get(id=self.thread1.id).last_message_id)
+        self.assertEqual(self.m33.id, Thread.objects.get(id=self.thread3.id).last_message_id)
+        self.assertEqual(self.m33.sent_at, Thread.objects.get(id=self.thread3.id).last_message_at)
+        self.assertEqual(None, Thread.objects.get(id=self.thread_unrelated.id).last_message_id)
+        # saving an older message does not move the pointer back
+        self.m31.body = "edited"
+        self.m31.save()
+        self.assertEqual(self.m33.id, Thread.objects.get(id=self.thread3.id).last_message_id)
+        # a new message moves it
+        m34 = Message.objects.create(sender=self.participant1, thread=self.thread3, body="hi")
+        self.assertEqual(m34.id, Thread.objects.get(id=self.thread3.id).last_message_id)
+        # setting the sequence with an older message does not move it back either
+        Thread.managers.set_last_message(self.m33, message_sequence=5)
+        self.assertEqual((5, m34.id, m34.sent_at), Thread.objects.filter(id=self.thread3.id).values_list('message_sequence', 'last_message', 'last_message_at').get())
+        # deleting the last message points the thread to the previous one
+        m34.delete()
+        self.assertEqual(self.m33.id, Thread.objects.get(id=self.thread3.id).last_message_id)
+        self.assertEqual(self.m33.sent_at, Thread.objects.get(id=self.thread3.id).last_message_at)
+
+    def test_backfill_last_messages(self):
+        Thread.objects.update(last_message=None, last_message_at=None)
+        call_command('backfill_last_messages', batch_size=2, stdout=StringIO())
+        self.assertEqual(self.m11.id, Thread.objects.get(id=self.thread1.id).last_message_id)
+        self.assertEqual(self.m22.id, Thread.objects.get(id=self.thread2.id).last_message_id)
+        self.assertEqual(self.m33.id, Thread.objects.get(id=self.thread3.id).last_message_id)
+        self.assertEqual(self.m33.sent_at, Thread.objects.get(id=self.thread3.id).last_message_at)
+        self.assertEqual(None, Thread.objects.get(id=self.thread_unrelated.id).last_message_id)
+
     def test_get_lasts_messages_of_threads(self):
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(2):
             messages = Message.managers.get_lasts_messages_of_threads(self.participant1.id, check_who_read=False, check_is_notification=False)
             # the messages are ordered from most recent to older
             self.assertEqual([self.m33.id, self.m22.id, self.m11.id], [m.id for m in messages])
@@ -235,7 +569,7 @@ class TestMessage(TestScenario):
         self.participation2.save()
         # we do not modify self.participation3.date_last_check
         # this means participant 1 and 2 have read the message, not 3
-        with self.assertNumQueries(5):
+        with self.assertNumQueries(2):
             messages = Message.managers.get_lasts_messages_of_threads(self.participant1.id, check_who_read=True, check_is_notification=False)
             # the ordering has not been modified
             self.assertEqual([self.m33.id, self.m22.id, self.m11.id], [m.id for m in messages])
@@ -245,7 +579,7 @@ class TestMessage(TestScenario):
             self.assertFalse(self.participant3.id in messages[0].readers)
 
     def test_get_lasts_messages_of_threads_check_is_notification(self):
-        with self.assertNumQueries(5):
+        with self.assertNumQueries(3):
             messages = Message.managers.get_lasts_messages_of_threads(self.participant1.id, check_who_read=False, check_is_notification=True)
             # the ordering has not been modified
             self.assertEqual([self.m33.id, self.m22.id, self.m11.id], [m.id for m in messages])
@@ -261,7 +595,7 @@ class TestMessage(TestScenario):
         self.participation2.date_last_check = now() + timedelta(days=1)
         self.participation2.save()
         # we create a notification check
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(3):
             messages = Message.managers.get_lasts_messages_of_threads(self.participant1.id, check_who_read=True, check_is_notification=True)
             # the ordering has not been modified
             self.assertEqual([self.m33.id, self.m22.id, self.m11.id], [m.id for m in messages])
@@ -272,6 +606,51 @@ class TestMessage(TestScenario):
             # participant 1 and 2 have read Thread 1
             self.assertTrue(self.participant1.id in messages[2].readers)
 
+    def test_get_read_watermarks(self):
+        # participant 3 has read the 2 last messages of thread 3, participant 1 none
+        self.m31.sent_at = now() - timedelta(days=3)
+        self.m31.save()
+        self.m32.sent_at = now() - timedelta(days=1, hours=12)
+        self.m32.save()
+        # one query, the last message read by each participant is looked up in the (thread, id) index
+        with self.assertNumQueries(1):
+            watermarks = Message.managers.get_read_watermarks([self.thread3.id, self.thread1.id])
+        self.assertEqual([
+            {'thread': self.thread1.id, 'participant': self.participant1.id, 'last_read_message_id': None, 'date_last_check': None},
+            {'thread': self.thread1.id, 'participant': self.participant2.id, 'last_read_message_id': None, 'date_last_check': None},
+            {'thread': self.thread1.id, 'participant': self.participant3.id, 'last_read_message_id': None, 'date_last_check': None},
+            {'thread': self.thread3.id, 'participant': self.participant1.id, 'last_read_message_id': self.m31.id, 'date_last_check': self.p1.date_last_check},
+            {'thread': self.thread3.id, 'participant': self.participant3.id, 'last_read_message_id': self.m32.id, 'date_last_check': self.p2.date_last_check},
+        ], watermarks)
+        # the watermarks give the same readers as check_who_read
+        for message in Message.managers.get_all_messages_in_thread(self.participant1.id, self.thread3.id):
+            readers = [w['participant'] for w in watermarks if w['thread'] == self.thread3.id and w['last_read_message_id'] is not None and message.id <= w['last_read_message_id']]
+            self.assertEqual(set(message.readers), set(readers))
+
+    def test_get_unread_counts(self):
+        # thread 1: participant 1 wrote the only message
+        # thread 2: one message from participant 2, participant 1 never checked the thread
+        # thread 3: two messages from participant 3 after participant 1's last check
+        with self.assertNumQueries(1):
+            counts = Message.managers.get_unread_counts(self.participant1.id)
+        self.assertEqual({self.thread2.id: 1, self.thread3.id: 2}, counts)
+        # participant 3 left thread 2 and has not read the last message of thread 3
+        self.assertEqual({self.thread1.id: 1, self.thread3.id: 1}, Message.managers.get_unread_counts(self.participant3.id))
+
+    def test_get_unread_total(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(3, Message.managers.get_unread_total(self.participant1.id))
+        # the total is cached
+        with self.assertNumQueries(0):
+            self.assertEqual(3, Message.managers.get_unread_total(self.participant1.id))
+        # a new message clears it
+        Message.objects.create(sender=self.participant2, thread=self.thread1, body="hi")
+        self.assertEqual(4, Message.managers.get_unread_total(self.participant1.id))
+        # so does reading a thread
+        self.p1.date_last_check = now()
+        self.p1.save()
+        self.assertEqual(2, Message.managers.get_unread_total(self.participant1.id))
+
     def test_get_all_messages_in_thread(self):
         # we change the date of the messages
         self.m31.sent_at = self.p2.date_last_check = now() - timedelta(days=3)
@@ -279,9 +658,75 @@ class TestMessage(TestScenario):
         self.m32.sent_at = self.p2.date_last_check = now() - timedelta(days=1, hours=12)
         self.m32.save()
         # we get all the messages
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             messages = Message.managers.get_all_messages_in_thread(self.participant1.id, self.thread3.id)
             self.assertEqual([self.m33.id, self.m32.id, self.m31.id], [m.id for m in messages])
             self.assertEqual(set(messages[2].readers), set([self.participant1.id, self.participant3.id]))  # we do not care about the order of the readers
             self.assertEqual(messages[1].readers, [self.participant3.id])
             self.assertEqual(messages[0].readers, [])
+
+
+@contextmanager
+def capture_statements(statements):
+    """ Captures the SQL and the parameters of the queries, so they can be explained. """
+    execute = CursorDebugWrapper.execute
+
+    def capture(cursor, sql, params=None):
+        statements.append((sql, params))
+        return execute(cursor, sql, params)
+
+    CursorDebugWrapper.execute = capture
+    try:
+        with CaptureQueriesContext(connection):
+            yield
+    finally:
+        CursorDebugWrapper.execute = execute
+
+
+@skipUnless(connection.vendor == 'sqlite', "EXPLAIN QUERY PLAN is specific to SQLite")
+class TestIndexes(TestScenario):
+
+    def get_index_name(self, model, *columns):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+        return [name for name, constraint in constraints.items() if constraint['index'] and tuple(constraint['columns']) == columns][0]
+
+    def assertUsesIndex(self, index_name, func, *args, **kwargs):
+        """ Checks the query plan of one of the SELECT queries run by func uses the index. """
+        statements = []
+        with capture_statements(statements):
+            func(*args, **kwargs)
+        plans = []
+        with connection.cursor() as cursor:
+            for sql, params in statements:
+                if sql.startswith("SELECT"):
+                    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+                    plans.append(" ".join("{0}".format(row[-1]) for row in cursor.fetchall()))
+        self.assertTrue(any(index_name in plan for plan in plans), "{0} not used by {1}".format(index_name, plans))
+
+    def test_active_threads(self):
+        index_name = self.get_index_name(Participation, 'participant_id', 'is_active')
+        self.assertUsesIndex(index_name, lambda: list(Thread.managers.get_threads_where_participant_is_active(self.participant1.id)))
+        self.assertUsesIndex(index_name, Message.managers.get_unread_counts, self.participant1.id)
+
+    def test_messages_in_thread(self):
+        index_name = self.get_index_name(Message, 'thread_id', 'id')
+        self.assertUsesIndex(index_name, lambda: list(Message.managers.get_all_messages_in_thread(self.participant1.id, self.thread1.id)[:30]))
+
+    def test_daily_messages_count(self):
+        index_name = self.get_index_name(Message, 'sender_id', 'sent_at')
+        # the query of the backend counting the messages in Message.save
+        self.assertUsesIndex(index_name, QueryCountBackend().get_count, self.participant1.id)
+
+    def test_active_participation(self):
+        # the partial index is used to find the active participation of a participant
+        self.assertUsesIndex('rest_messaging_participation_active_uniq', Participation.objects.get, thread__id=self.thread1.id, participant__id=self.participant1.id, date_left=None)
+        request = RequestFactory()
+        request.user = self.user
+        request.rest_messaging_participant = self.participant1
+        self.thread1.remove_participant(request, self.participant1)
+        # and a participant cannot be active twice in a thread
+        with transaction.atomic():
+            self.assertRaises(IntegrityError, Participation.objects.create, participant=self.participant2, thread=self.thread1)
+        # but can join again after leaving
+        Participation.objects.create(participant=self.participant1, thread=self.thread1)
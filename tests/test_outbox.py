@@ -0,0 +1,262 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+from django.utils.six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from django.utils.timezone import now, timedelta
+from rest_framework.test import APIRequestFactory
+from rest_messaging.models import Message, OutboxEvent, Participant, Thread
+from rest_messaging.outbox import BaseOutboxHandler, WebhookHandler, drain_outbox
+from rest_messaging.signals import outbox_events
+from .utils import TestScenario
+import json
+import threading
+
+
+class RecordingHandler(BaseOutboxHandler):
+    """ Keeps the batches it receives, and fails the first ones if asked to. """
+
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+
+    def handle(self, events):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ValueError("unavailable")
+        self.batches.append(events)
+
+
+class WebhookStandIn(object):
+    """ A local HTTP server standing for the webhook, recording the bodies posted to it. """
+
+    def __init__(self, status=200):
+        self.bodies = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                stand_in.bodies.append(json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf8')))
+                self.send_response(stand_in.status)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.status = status
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}/events'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@override_settings(REST_MESSAGING_OUTBOX=True)
+class TestOutbox(TestScenario):
+
+    def setUp(self):
+        super(TestOutbox, self).setUp()
+        # the events of the scenario
+        OutboxEvent.objects.all().delete()
+        self.request = APIRequestFactory()
+        self.request.user = self.user
+        self.request.rest_messaging_participant = self.participant1
+
+    @override_settings(REST_MESSAGING_OUTBOX=False)
+    def test_disabled(self):
+        Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+        self.thread1.add_participants(self.request, self.participant4.id)
+        self.assertEqual(0, OutboxEvent.objects.count())
+
+    def test_record(self):
+        message = Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+        Message.managers.broadcast(self.participant1.id, "hello", [self.thread2.id, self.thread3.id])
+        self.thread1.add_participants(self.request, self.participant4.id)
+        self.thread1.remove_participant(self.request, self.participant1)
+        events = [event.to_dict() for event in OutboxEvent.objects.order_by('id')]
+        self.assertEqual(["message.created"] * 3 + ["thread.participants_added", "thread.participant_removed"], [event['type'] for event in events])
+        self.assertEqual([self.thread1.id, self.thread2.id, self.thread3.id, self.thread1.id, self.thread1.id], [event['thread'] for event in events])
+        self.assertEqual({"message": message.id, "thread": self.thread1.id, "sequence": message.sequence, "sender": self.participant1.id}, dict((key, events[0]['payload'][key]) for key in ["message", "thread", "sequence", "sender"]))
+        self.assertEqual([self.participant4.id], events[3]['payload']['participants'])
+        self.assertEqual(self.participant1.id, events[4]['payload']['participant'])
+
+    def test_record_get_or_create_thread(self):
+        Participant.objects.create(id=7)
+        thread = Thread.managers.get_or_create_thread(self.request, "New", self.participant1.id, 7)
+        # a single event for the thread and its participants
+        self.assertEqual(["thread.created"], list(OutboxEvent.objects.order_by('id').values_list('event_type', flat=True)))
+        event = OutboxEvent.objects.get(event_type="thread.created")
+        self.assertEqual(thread.id, event.thread_id)
+        self.assertEqual(sorted([self.participant1.id, 7]), sorted(event.to_dict()['payload']['participants']))
+
+    def test_record_rolled_back(self):
+        # the event is written in the transaction of the change
+        try:
+            with transaction.atomic():
+                Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(0, OutboxEvent.objects.count())
+
+    def test_thread_signals(self):
+        received = []
+
+        def receiver(sender, instance, **kwargs):
+            # the participants changed (Thread.objects.create sends its own post_save)
+            if kwargs.get('created_and_add_participants', False) or kwargs.get('remove_participant', False):
+                received.append((instance.id, kwargs.get('created_and_add_participants', False), kwargs.get('removed_participant', None), kwargs.get('removed_participation', None)))
+
+        post_save.connect(receiver, sender=Thread)
+        try:
+            Participant.objects.create(id=7)
+            thread = Thread.managers.get_or_create_thread(self.request, "New", self.participant1.id, 7)
+            self.thread1.add_participants(self.request, self.participant4.id)
+            participation = self.thread1.remove_participant(self.request, self.participant1)
+            # the receivers do not run in the requests
+            self.assertEqual([], received)
+            # but in the worker
+            self.assertEqual((3, 0), drain_outbox())
+        finally:
+            post_save.disconnect(receiver, sender=Thread)
+        self.assertEqual([(thread.id, True, None, None), (self.thread1.id, True, None, None), (self.thread1.id, False, self.participant1, participation)], received)
+
+    @override_settings(REST_MESSAGING_OUTBOX=False)
+    def test_thread_signals_disabled(self):
+        received = []
+
+        def receiver(sender, instance, **kwargs):
+            received.append(instance.id)
+
+        post_save.connect(receiver, sender=Thread)
+        try:
+            self.thread1.add_participants(self.request, self.participant4.id)
+        finally:
+            post_save.disconnect(receiver, sender=Thread)
+        self.assertEqual([self.thread1.id], received)
+
+    def test_drain(self):
+        received = []
+
+        def receiver(sender, events, **kwargs):
+            received.extend(events)
+
+        outbox_events.connect(receiver)
+        try:
+            Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+            Message.objects.create(sender=self.participant1, thread=self.thread2, body="hi")
+            Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+            # the signal handler by default
+            self.assertEqual((2, 0), drain_outbox(batch_size=2))
+            self.assertEqual((1, 0), drain_outbox(batch_size=2))
+            self.assertEqual((0, 0), drain_outbox(batch_size=2))
+        finally:
+            outbox_events.disconnect(receiver)
+        self.assertEqual([self.thread1.id, self.thread2.id, self.thread1.id], [event['thread'] for event in received])
+        # the delivered events are deleted
+        self.assertEqual(0, OutboxEvent.objects.count())
+
+    def test_claim(self):
+        test = self
+
+        class ClaimHandler(BaseOutboxHandler):
+
+            def handle(self, events):
+                # the batch and the next events of its thread are claimed while they are delivered
+                Message.objects.create(sender=test.participant1, thread=test.thread1, body="hi")
+                test.assertEqual([test.thread2.id], [event.thread_id for event in OutboxEvent.managers.get_pending(10, lock=True)])
+
+        Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+        Message.objects.create(sender=self.participant1, thread=self.thread2, body="hi")
+        self.assertEqual((1, 0), drain_outbox(handlers=[ClaimHandler()], batch_size=1))
+        # the thread is released once its batch is delivered
+        self.assertEqual((2, 0), drain_outbox(handlers=[RecordingHandler()]))
+
+    @override_settings(REST_MESSAGING_OUTBOX_CLAIM_TIMEOUT=60)
+    def test_claim_expired(self):
+        class StoppedHandler(BaseOutboxHandler):
+
+            def handle(self, events):
+                # the worker stops before the batch is delivered
+                raise KeyboardInterrupt
+
+        Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+        with self.assertRaises(KeyboardInterrupt):
+            drain_outbox(handlers=[StoppedHandler()])
+        self.assertEqual((0, 0), drain_outbox(handlers=[RecordingHandler()]))
+        # the other workers deliver it once the claim has expired
+        OutboxEvent.objects.update(available_at=now())
+        self.assertEqual((1, 0), drain_outbox(handlers=[RecordingHandler()]))
+
+    @override_settings(REST_MESSAGING_OUTBOX_RETRY_DELAY=30)
+    def test_retry(self):
+        handler = RecordingHandler(failures=1)
+        Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+        self.assertEqual((0, 1), drain_outbox(handlers=[handler]))
+        event = OutboxEvent.objects.get()
+        self.assertEqual(1, event.attempts)
+        self.assertTrue("unavailable" in event.last_error)
+        self.assertTrue(event.available_at > now() + timedelta(seconds=25))
+        # the thread is held back until the retry, the other threads are not
+        Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+        Message.objects.create(sender=self.participant1, thread=self.thread2, body="hi")
+        self.assertEqual((1, 0), drain_outbox(handlers=[handler]))
+        self.assertEqual([self.thread2.id], [delivered['thread'] for delivered in handler.batches[0]])
+        # the retry delivers the events of the thread in order
+        OutboxEvent.objects.update(available_at=now())
+        self.assertEqual((2, 0), drain_outbox(handlers=[handler]))
+        self.assertEqual([event.id, event.id + 1], [delivered['id'] for delivered in handler.batches[1]])
+
+    @override_settings(REST_MESSAGING_OUTBOX_MAX_ATTEMPTS=2, REST_MESSAGING_OUTBOX_RETRY_DELAY=30, REST_MESSAGING_OUTBOX_MAX_RETRY_DELAY=40)
+    def test_max_attempts(self):
+        handler = RecordingHandler(failures=2)
+        Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+        self.assertEqual((0, 1), drain_outbox(handlers=[handler]))
+        OutboxEvent.objects.update(available_at=now())
+        self.assertEqual((0, 1), drain_outbox(handlers=[handler]))
+        # the event is given up, it does not hold the thread back anymore
+        event = OutboxEvent.objects.get()
+        self.assertEqual(2, event.attempts)
+        self.assertNotEqual(None, event.failed_at)
+        Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+        self.assertEqual((1, 0), drain_outbox(handlers=[handler]))
+
+    def test_webhook(self):
+        Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+        Message.objects.create(sender=self.participant1, thread=self.thread2, body="hi")
+        with WebhookStandIn() as stand_in:
+            self.assertEqual((2, 0), drain_outbox(handlers=[WebhookHandler(url=stand_in.url)]))
+        self.assertEqual(1, len(stand_in.bodies))
+        self.assertEqual([self.thread1.id, self.thread2.id], [event['thread'] for event in stand_in.bodies[0]['events']])
+
+    def test_webhook_error(self):
+        Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+        with WebhookStandIn(status=503) as stand_in:
+            self.assertEqual((0, 1), drain_outbox(handlers=[WebhookHandler(url=stand_in.url)]))
+        self.assertEqual(1, len(stand_in.bodies))
+        self.assertEqual(1, OutboxEvent.objects.get().attempts)
+
+    def test_command(self):
+        Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+        Message.objects.create(sender=self.participant1, thread=self.thread2, body="hi")
+        Message.objects.create(sender=self.participant1, thread=self.thread3, body="hi")
+        with WebhookStandIn() as stand_in:
+            with override_settings(REST_MESSAGING_OUTBOX_HANDLERS=['rest_messaging.outbox.WebhookHandler'], REST_MESSAGING_OUTBOX_WEBHOOK_URL=stand_in.url):
+                out = StringIO()
+                call_command('drain_outbox', batch_size=2, stdout=out)
+        self.assertEqual([2, 1], [len(body['events']) for body in stand_in.bodies])
+        self.assertTrue("3 events delivered, 0 to retry." in out.getvalue())
@@ -0,0 +1,80 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from datetime import datetime
+from django.test.utils import override_settings
+from django.utils.timezone import now, timedelta, utc
+from rest_messaging.models import Message, MessageCountBucket
+from rest_messaging.ratelimit import CacheSlidingWindowBackend, DatabaseSlidingWindowBackend, QueryCountBackend, SlidingWindowBackend, get_daily_limit_backend
+from tests.utils import TestScenario
+
+
+class TestSlidingWindowBackends(TestScenario):
+
+    def check_sliding_window(self, backend):
+        # half past noon
+        t = datetime(2016, 1, 10, 12, 30, tzinfo=utc)
+        self.assertEqual(0, backend.get_count(self.participant1.id, when=t))
+        # 20 messages yesterday between noon and 1pm (the 25th bucket), 10 at 6pm and 5 now
+        backend.increment(self.participant1.id, count=10, when=t - timedelta(days=1, minutes=20))
+        backend.increment(self.participant1.id, count=10, when=t - timedelta(days=1) + timedelta(minutes=10))
+        backend.increment(self.participant1.id, count=10, when=t - timedelta(hours=18, minutes=30))
+        for i in range(5):
+            backend.increment(self.participant1.id, when=t)
+        # the 25th bucket is half in the window, so we count half of its messages
+        self.assertEqual(10 + 10 + 5, backend.get_count(self.participant1.id, when=t))
+        # the other participants are counted apart
+        self.assertEqual(0, backend.get_count(self.participant2.id, when=t))
+        # a day later, only the last messages remain
+        self.assertEqual(5, backend.get_count(self.participant1.id, when=t + timedelta(hours=23)))
+        self.assertEqual(0, backend.get_count(self.participant1.id, when=t + timedelta(days=1, hours=1)))
+
+    def test_cache_sliding_window(self):
+        self.check_sliding_window(CacheSlidingWindowBackend())
+
+    def test_database_sliding_window(self):
+        backend = DatabaseSlidingWindowBackend()
+        self.check_sliding_window(backend)
+        # counting and incrementing cost one query, whatever the number of messages
+        t = now()
+        with self.assertNumQueries(1):
+            backend.get_count(self.participant1.id, when=t)
+        backend.increment(self.participant1.id, when=t)
+        with self.assertNumQueries(1):
+            backend.increment(self.participant1.id, when=t)
+        # the buckets out of the window are deleted when a new bucket is created
+        self.assertEqual(1, MessageCountBucket.objects.filter(participant=self.participant1).count())
+
+    def test_sliding_window_is_abstract(self):
+        self.assertRaises(TypeError, SlidingWindowBackend)
+
+    @override_settings(REST_MESSAGING_DAILY_LIMIT_BACKEND=DatabaseSlidingWindowBackend)
+    def test_not_counted_without_limit(self):
+        # without callback, the messages are not counted
+        Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+        Message.managers.bulk_post_messages(self.participant1.id, [(self.thread1.id, "hi")])
+        self.assertEqual(0, MessageCountBucket.objects.count())
+        with override_settings(REST_MESSAGING_DAILY_LIMIT_CALLBACK=lambda *args, **kwargs: 50):
+            Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+            Message.managers.bulk_post_messages(self.participant1.id, [(self.thread1.id, "hi")])
+        self.assertEqual(2, MessageCountBucket.objects.get(participant=self.participant1).count)
+
+    def test_get_daily_limit_backend(self):
+        self.assertTrue(isinstance(get_daily_limit_backend(), QueryCountBackend))
+        with override_settings(REST_MESSAGING_DAILY_LIMIT_BACKEND='rest_messaging.ratelimit.CacheSlidingWindowBackend'):
+            self.assertTrue(isinstance(get_daily_limit_backend(), CacheSlidingWindowBackend))
+        with override_settings(REST_MESSAGING_DAILY_LIMIT_BACKEND=DatabaseSlidingWindowBackend):
+            self.assertTrue(isinstance(get_daily_limit_backend(), DatabaseSlidingWindowBackend))
+
+    @override_settings(REST_MESSAGING_DAILY_LIMIT_CALLBACK=lambda *args, **kwargs: 50, REST_MESSAGING_DAILY_LIMIT_BACKEND=CacheSlidingWindowBackend)
+    def test_check_callback_and_save(self):
+        # the messages sent in setUp were not counted, participant 1 can send 50 more
+        count_already_created = Message.objects.filter(sender=self.participant1).count()
+        for i in range(100):
+            try:
+                Message.objects.create(sender=self.participant1, thread=self.thread1, body="hi")
+            except Exception:
+                pass
+        self.assertEqual(50 + count_already_created, Message.objects.filter(sender=self.participant1).count())
@@ -0,0 +1,126 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+from django.utils.timezone import now, timedelta
+from rest_messaging import readstate
+from rest_messaging.models import Message, NotificationCheck, Participation, Thread
+from .utils import TestScenario, parse_json_response
+
+
+@override_settings(REST_MESSAGING_BUFFER_READ_STATE=True)
+class TestReadStateBuffer(TestScenario):
+
+    def setUp(self):
+        super(TestReadStateBuffer, self).setUp()
+        self.thread_url = "{0}{1}/".format(reverse('rest_messaging:threads-list'), self.thread3.id)
+        self.messages_url = reverse('rest_messaging:messages-list')
+        self.notifications_url = reverse('rest_messaging:notifications-list')
+
+    def test_mark_thread_as_read(self):
+        self.client_authenticated.get(self.messages_url)  # the participant is cached
+        date_last_check = Participation.objects.get(id=self.p1.id).date_last_check
+        # the thread and its participations only, nothing is written
+        with self.assertNumQueries(3):
+            self.assertEqual(200, self.client_authenticated.post("{0}mark_thread_as_read/".format(self.thread_url)).status_code)
+        self.assertEqual(date_last_check, Participation.objects.get(id=self.p1.id).date_last_check)
+        # the reads look in the buffer
+        buffered = Thread.managers.get_thread_with_participations(self.thread3.id).get_participation(self.participant1.id).date_last_check
+        self.assertTrue(buffered > date_last_check)
+        self.assertEqual(buffered, Thread.managers.get_participations([self.thread3.id])[self.thread3.id][0].date_last_check)
+        self.assertEqual({self.thread2.id: 1}, Message.managers.get_unread_counts(self.participant1.id))
+        self.assertEqual(1, Message.managers.get_unread_total(self.participant1.id))
+        watermarks = [watermark for watermark in Message.managers.get_read_watermarks([self.thread3.id]) if watermark['participant'] == self.participant1.id]
+        self.assertEqual([(self.m33.id, buffered)], [(watermark['last_read_message_id'], watermark['date_last_check']) for watermark in watermarks])
+        messages = Message.managers.get_all_messages_in_thread(self.participant1.id, self.thread3.id)
+        self.assertTrue(all(self.participant1.id in message.readers for message in messages))
+        # the sync sends the buffered check
+        messages, has_more, participations, notification_check = Message.managers.get_changes(self.participant1.id, changed_since=now() - timedelta(seconds=5))
+        self.assertEqual([buffered], [participation.date_last_check for participation in participations if participation.id == self.p1.id])
+
+    def test_notification_check(self):
+        self.client_authenticated.get(self.messages_url)  # the participant is cached
+        date_check = self.notification_check.date_check
+        with self.assertNumQueries(2):
+            response = self.client_authenticated.post("{0}check/".format(self.notifications_url))
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(parse_json_response(response.data)["date_check"])
+        self.assertEqual(date_check, NotificationCheck.objects.get(participant=self.participant1).date_check)
+        # the messages sent before the buffered check are not notified
+        messages = Message.managers.get_lasts_messages_of_threads(self.participant1.id)
+        self.assertEqual([False], list(set(message.is_notification for message in messages)))
+        messages, has_more, participations, notification_check = Message.managers.get_changes(self.participant1.id, changed_since=now() - timedelta(seconds=5))
+        self.assertEqual(readstate.get_notification_check(self.participant1.id), notification_check.date_check)
+
+    def test_flush(self):
+        when = now()
+        self.p1.mark_as_read(when)
+        self.p1.mark_as_read(when + timedelta(seconds=1))
+        Participation.objects.get(thread=self.thread2, participant=self.participant1).mark_as_read(when)
+        readstate.buffer_notification_check(self.participant1.id, when)
+        readstate.buffer_notification_check(self.participant2.id, when)
+        # the participations are updated in one statement, the notification checks in one update and one insert
+        with self.assertNumQueries(4):
+            self.assertEqual((2, 2), readstate.flush_read_states())
+        self.assertEqual(when + timedelta(seconds=1), Participation.objects.get(id=self.p1.id).date_last_check)
+        self.assertEqual(when, Participation.objects.get(thread=self.thread2, participant=self.participant1).date_last_check)
+        self.assertEqual(when, NotificationCheck.objects.get(participant=self.participant1).date_check)
+        self.assertEqual(when, NotificationCheck.objects.get(participant=self.participant2).date_check)
+        self.assertEqual((0, 0), readstate.flush_read_states())
+        # the participation is marked again after the flush
+        self.p1.mark_as_read(when + timedelta(seconds=2))
+        self.assertEqual((1, 0), readstate.flush_read_states(batch_size=1))
+        self.assertEqual(when + timedelta(seconds=2), Participation.objects.get(id=self.p1.id).date_last_check)
+
+    def test_flush_forward_only(self):
+        when = now()
+        self.p1.mark_as_read(when - timedelta(hours=1))
+        Participation.objects.filter(id=self.p1.id).update(date_last_check=when)
+        self.assertEqual((1, 0), readstate.flush_read_states())
+        self.assertEqual(when, Participation.objects.get(id=self.p1.id).date_last_check)
+
+    def test_flush_missing_entry(self):
+        # an entry being written: its position is reserved, the entry is not there yet
+        cache.add(readstate.SEQUENCE_KEY, 0, None)
+        cache.incr(readstate.SEQUENCE_KEY)
+        self.p1.mark_as_read()
+        self.assertEqual((1, 0), readstate.flush_read_states())
+        self.assertEqual(0, cache.get(readstate.FLUSHED_KEY))
+        # it is still missing at the next flush, it has expired
+        self.assertEqual((1, 0), readstate.flush_read_states())
+        self.assertEqual(2, cache.get(readstate.FLUSHED_KEY))
+        self.assertEqual((0, 0), readstate.flush_read_states())
+
+    def test_command(self):
+        self.p1.mark_as_read()
+        out = StringIO()
+        call_command('flush_read_states', stdout=out)
+        self.assertTrue("1 read participations and 0 notification checks flushed." in out.getvalue())
+        self.assertEqual(self.p1.date_last_check, Participation.objects.get(id=self.p1.id).date_last_check)
+
+    def test_cached_participations(self):
+        Thread.managers.get_participations([self.thread3.id])
+        # a buffered check does not invalidate the cached participations, it is set on them
+        self.p1.mark_as_read()
+        with self.assertNumQueries(0):
+            participations = Thread.managers.get_participations([self.thread3.id])[self.thread3.id]
+        self.assertEqual(self.p1.date_last_check, [participation for participation in participations if participation.id == self.p1.id][0].date_last_check)
+        # the flush invalidates them
+        readstate.flush_read_states()
+        with self.assertNumQueries(1):
+            Thread.managers.get_participations([self.thread3.id])
+
+    def test_check_cache(self):
+        self.assertEqual(['rest_messaging.E001'], [error.id for error in readstate.check_cache(None)])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'cache'}}):
+            self.assertEqual(['rest_messaging.E002'], [error.id for error in readstate.check_cache(None)])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache', 'LOCATION': '127.0.0.1:11211'}}):
+            self.assertEqual([], readstate.check_cache(None))
+        with override_settings(REST_MESSAGING_BUFFER_READ_STATE=False):
+            self.assertEqual([], readstate.check_cache(None))
@@ -0,0 +1,28 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from django.test import TestCase
+from django.utils.timezone import now, timedelta
+from rest_messaging.receipts import ReadReceipts
+
+
+class TestReadReceipts(TestCase):
+
+    def test_get_readers(self):
+        t = now()
+        # participant 4 never checked the thread
+        receipts = ReadReceipts([(1, t - timedelta(days=1)), (2, t + timedelta(days=1)), (3, t), (4, None)])
+        self.assertEqual(set([1, 2, 3]), set(receipts.get_readers(t - timedelta(days=2))))
+        self.assertEqual(set([2, 3]), set(receipts.get_readers(t - timedelta(hours=1))))
+        # a message sent at the time of the check has not been read
+        self.assertEqual([2], receipts.get_readers(t))
+        self.assertEqual([], receipts.get_readers(t + timedelta(days=2)))
+
+    def test_shared_readers(self):
+        # the messages sent between two checks share the same list
+        t = now()
+        receipts = ReadReceipts([(1, t - timedelta(days=1)), (2, t + timedelta(days=1))])
+        self.assertTrue(receipts.get_readers(t) is receipts.get_readers(t + timedelta(hours=1)))
+        self.assertFalse(receipts.get_readers(t) is receipts.get_readers(t - timedelta(days=2)))
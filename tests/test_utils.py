@@ -0,0 +1,34 @@
+# coding=utf8
+# -*- coding: utf8 -*-
+# vim: set fileencoding=utf8 :
+
+from __future__ import unicode_literals
+from django.test import TestCase
+from rest_messaging.utils import LRUCache
+
+
+class TestLRUCache(TestCase):
+
+    def test_eviction(self):
+        lru = LRUCache(2, 60)
+        lru.set(1, "a")
+        lru.set(2, "b")
+        # 1 becomes the most recently used, so 2 is evicted
+        self.assertEqual("a", lru.get(1))
+        lru.set(3, "c")
+        self.assertEqual(2, len(lru))
+        self.assertEqual(None, lru.get(2))
+        self.assertEqual("a", lru.get(1))
+        self.assertEqual("c", lru.get(3))
+        self.assertEqual((3, 1), (lru.hits, lru.misses))
+        lru.delete(1)
+        self.assertEqual("default", lru.get(1, "default"))
+        lru.clear()
+        self.assertEqual((0, 0, 0), (len(lru), lru.hits, lru.misses))
+
+    def test_expiration(self):
+        lru = LRUCache(2, -1)
+        lru.set(1, "a")
+        self.assertEqual(None, lru.get(1))
+        # the expired entry is dropped
+        self.assertEqual(0, len(lru))
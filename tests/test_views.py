@@ -4,14 +4,20 @@
 
 from __future__ import unicode_literals
 
-from django.test.utils import override_settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models.signals import post_init, post_save
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils.timezone import now, timedelta
 
 from rest_framework.reverse import reverse
 
+from rest_messaging import events
 from rest_messaging.models import Message, NotificationCheck, Participation, Thread
+from rest_messaging.pagination import decode_sync_cursor, encode_sync_cursor
 
-from .utils import TestScenario, parse_json_response
+from .utils import TestScenario, commit_callbacks, parse_json_response
 
 import json
 
@@ -124,8 +130,23 @@ class ThreadViewTests(TestScenario):
         p = Participation.objects.get(participant=self.participant1, thread=self.thread1)
         self.assertEqual(p.date_left, None)
         # we will remove him
-        response = self.client_authenticated.post("{0}{1}/remove_participant/".format(self.url, self.thread1.id), data={"participant": self.participant1.id})
+        received = []
+
+        def receiver(sender, **kwargs):
+            if kwargs.get('remove_participant', False):
+                received.append(kwargs)
+
+        post_save.connect(receiver, sender=Thread)
+        try:
+            response = self.client_authenticated.post("{0}{1}/remove_participant/".format(self.url, self.thread1.id), data={"participant": self.participant1.id})
+        finally:
+            post_save.disconnect(receiver, sender=Thread)
         self.assertEqual(200, response.status_code)
+        # the receivers get the participant as a saved instance, and the participation
+        self.assertEqual(self.participant1, received[0]['removed_participant'])
+        self.assertFalse(received[0]['removed_participant']._state.adding)
+        self.assertEqual(p.id, received[0]['removed_participation'].id)
+        self.assertNotEqual(None, received[0]['removed_participation'].date_left)
         parsed = parse_json_response(response.data)
         # we get the Thread
         self.assertEqual(parsed["name"], self.thread1.name)
@@ -175,6 +196,85 @@ class ThreadViewTests(TestScenario):
         parsed = parse_json_response(response.data)
         self.assertEqual(parsed["id"], self.thread1.id)
 
+    def test_mark_all_as_read(self):
+        url = "{0}mark_all_as_read/".format(self.url)
+        # no authentication
+        self.assertEqual(403, self.client_unauthenticated.post(url).status_code)
+        # invalid parameters
+        self.assertEqual(400, self.client_authenticated.post(url, data={"threads": "nope"}).status_code)
+        self.assertEqual(400, self.client_authenticated.post(url, data={"before": "yesterday"}).status_code)
+        # the messages sent before a time, in some threads
+        before = now() - timedelta(hours=1)
+        response = self.client_authenticated.post(url, data={"threads": json.dumps([self.thread1.id, self.thread3.id, self.thread_unrelated.id]), "before": before.isoformat()})
+        self.assertEqual(200, response.status_code)
+        parsed = parse_json_response(response.data)
+        self.assertEqual((2, [self.thread1.id, self.thread3.id]), (parsed["count"], parsed["threads"]))
+        self.assertEqual(before, Participation.objects.get(id=self.p1.id).date_last_check)
+        self.assertEqual(None, Participation.objects.get(thread=self.thread2, participant=self.participant1).date_last_check)
+        # a time in the future is clamped to now
+        response = self.client_authenticated.post(url, data={"threads": json.dumps([self.thread3.id]), "before": (now() + timedelta(days=1)).isoformat()})
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(before < Participation.objects.get(id=self.p1.id).date_last_check <= now())
+        Thread.managers.get_participations([self.thread3.id])  # cached
+        # all the threads, in one update and the select of the threads marked
+        with self.assertNumQueries(4):
+            response = self.client_authenticated.post(url)
+        parsed = parse_json_response(response.data)
+        self.assertEqual([self.thread1.id, self.thread2.id, self.thread3.id], parsed["threads"])
+        self.assertEqual({}, Message.managers.get_unread_counts(self.participant1.id))
+        self.assertEqual(0, Message.managers.get_unread_total(self.participant1.id))
+        # the cached participations were invalidated
+        self.assertTrue(Thread.objects.get(id=self.thread3.id).get_participation(self.participant1.id).date_last_check > before)
+        # the other participants are not marked
+        self.assertEqual(None, Participation.objects.get(id=self.participation2.id).date_last_check)
+
+    def test_num_queries(self):
+        # the thread, its participations and the membership are fetched with one query
+        # (each request also fetches the session and the user)
+        self.client_authenticated.get(reverse('rest_messaging:messages-list'))  # the participant is cached
+        thread_url = "{0}{1}/".format(self.url, self.thread1.id)
+        with self.assertNumQueries(3):
+            self.assertEqual(200, self.client_authenticated.get(thread_url).status_code)
+        with self.assertNumQueries(3):
+            self.assertEqual(403, self.client_authenticated.get("{0}{1}/".format(self.url, self.thread_unrelated.id)).status_code)
+        # a thread without participations is looked up again
+        with self.assertNumQueries(4):
+            self.assertEqual(404, self.client_authenticated.get("{0}0/".format(self.url)).status_code)
+        with self.assertNumQueries(4):
+            self.assertEqual(200, self.client_authenticated.put(thread_url, data={"name": "New thread name"}).status_code)
+        with self.assertNumQueries(3):
+            self.assertEqual(200, self.client_authenticated.get("{0}get_removable_participants_ids/".format(thread_url)).status_code)
+        # the participations, the insert, the fingerprint (in a savepoint) and the new participants
+        with self.assertNumQueries(9):
+            self.assertEqual(200, self.client_authenticated.post("{0}add_participants/".format(thread_url), data={"participants": json.dumps([self.participant4.id])}).status_code)
+        with self.assertNumQueries(4):
+            self.assertEqual(200, self.client_authenticated.post("{0}mark_thread_as_read/".format(thread_url)).status_code)
+        # the participations, the update and the fingerprint (in a savepoint)
+        with self.assertNumQueries(7):
+            self.assertEqual(200, self.client_authenticated.post("{0}remove_participant/".format(thread_url), data={"participant": self.participant1.id}).status_code)
+        # a new thread (created with its participants in a savepoint), then the same one, whose participations are cached once read after the commit
+        data = {"participants": json.dumps([self.participant5.id])}
+        with self.assertNumQueries(12), commit_callbacks():
+            self.assertEqual(201, self.client_authenticated.post(self.url, data=data).status_code)
+        with self.assertNumQueries(4):
+            self.assertEqual(201, self.client_authenticated.post(self.url, data=data).status_code)
+        with self.assertNumQueries(3):
+            self.assertEqual(201, self.client_authenticated.post(self.url, data=data).status_code)
+
+    def test_is_participant(self):
+        request = RequestFactory()
+        request.user = self.user
+        with self.assertNumQueries(1):
+            self.assertEqual(self.participant1, self.thread1.is_participant(request))
+            self.assertEqual(self.participant1, self.thread1.is_participant(request))
+        with self.assertNumQueries(1):
+            self.assertFalse(self.thread_unrelated.is_participant(request))
+            self.assertFalse(self.thread_unrelated.is_participant(request))
+        # the participants who have left can still read the thread
+        request = RequestFactory()
+        request.user = User.objects.create(id=self.participant3.id, username="participant3")
+        self.assertEqual(self.participant3, self.thread2.is_participant(request))
+
 
 class MessageViewTests(TestScenario):
 
@@ -188,10 +288,10 @@ class MessageViewTests(TestScenario):
         self.assertEqual(403, response.status_code)
         # ok
         # participant 3 has read the 2 last messages, 1 only the first
-        p1 = Participation.objects.create(participant=self.participant3, thread=self.thread3)
+        p1 = self.p2  # participant 3 in thread 3
         p1.date_last_check = now() - timedelta(days=1)
         p1.save()
-        p2 = Participation.objects.create(participant=self.participant1, thread=self.thread3)
+        p2 = self.p1  # participant 1 in thread 3
         p2.date_last_check = now() - timedelta(days=2)
         p2.save()
         response = self.client_authenticated.get(self.url)
@@ -207,6 +307,129 @@ class MessageViewTests(TestScenario):
         self.assertEqual(messages[1]["is_notification"], False)  # because written by the user himself
         self.assertEqual(messages[2]["is_notification"], False)  # because written by the user himself
 
+    def test_get_queryset_read_watermarks(self):
+        self.participation2.date_last_check = now() + timedelta(days=1)
+        self.participation2.save()
+        response = self.client_authenticated.get(self.url, data={"read_state": "watermarks"})
+        self.assertEqual(200, response.status_code)
+        parsed = parse_json_response(response.data)
+        self.assertEqual([self.m33.id, self.m22.id, self.m11.id], [m["id"] for m in parsed["results"]])
+        # the messages do not hold their readers
+        self.assertFalse(any("readers" in m for m in parsed["results"]))
+        self.assertEqual(parsed["results"][0]["is_notification"], True)
+        # each participant of the threads has a watermark
+        watermarks = dict(((w["thread"], w["participant"]), w["last_read_message_id"]) for w in parsed["watermarks"])
+        self.assertEqual(8, len(watermarks))
+        self.assertEqual(self.m11.id, watermarks[(self.thread1.id, self.participant2.id)])
+        self.assertEqual(None, watermarks[(self.thread1.id, self.participant1.id)])
+
+    def test_unread_counts(self):
+        response = self.client_unauthenticated.get("{0}unread_counts/".format(self.url))
+        self.assertEqual(403, response.status_code)
+        response = self.client_authenticated.get("{0}unread_counts/".format(self.url))
+        self.assertEqual(200, response.status_code)
+        parsed = parse_json_response(response.data)
+        self.assertEqual(3, parsed["total"])
+        self.assertEqual([{"thread": self.thread2.id, "count": 1}, {"thread": self.thread3.id, "count": 2}], parsed["threads"])
+
+    def test_unread_total(self):
+        response = self.client_unauthenticated.get("{0}unread_total/".format(self.url))
+        self.assertEqual(403, response.status_code)
+        response = self.client_authenticated.get("{0}unread_total/".format(self.url))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({"total": 3}, parse_json_response(response.data))
+
+    @override_settings(REST_MESSAGING_SYNC_OVERLAP=0)
+    def test_sync(self):
+        url = "{0}sync/".format(self.url)
+        self.assertEqual(403, self.client_unauthenticated.get(url).status_code)
+        self.assertEqual(400, self.client_authenticated.get(url, data={"cursor": "invalid"}).status_code)
+        # the first sync returns the participations of the threads of the participant
+        response = self.client_authenticated.get(url)
+        self.assertEqual(200, response.status_code)
+        parsed = parse_json_response(response.data)
+        self.assertEqual([], parsed["messages"])
+        self.assertEqual(set([self.thread1.id, self.thread2.id, self.thread3.id]), set(p["thread"] for p in parsed["participations"]))
+        self.assertTrue(parsed["notification_check"])
+        # nothing changed, the sync costs 3 queries after the session and the user
+        with self.assertNumQueries(5):
+            parsed = parse_json_response(self.client_authenticated.get(url, data={"cursor": parsed["cursor"]}).data)
+        self.assertEqual(([], [], None, False), (parsed["messages"], parsed["participations"], parsed["notification_check"], parsed["has_more"]))
+        # messages are posted, participants read and leave
+        m1 = Message.objects.create(sender=self.participant2, thread=self.thread1, body="hi")
+        Message.objects.create(sender=self.participant4, thread=self.thread_unrelated, body="hi")
+        m2 = Message.objects.create(sender=self.participant3, thread=self.thread3, body="hi")
+        self.participation2.date_last_check = now()
+        self.participation2.save(update_fields=['date_last_check'])
+        self.p1.date_left = now()
+        self.p1.save()
+        cursor = parsed["cursor"]
+        parsed = parse_json_response(self.client_authenticated.get(url, data={"cursor": cursor}).data)
+        # the messages of the thread the participant has left are not sent anymore
+        self.assertEqual([(m1.id, 2)], [(m["id"], m["sequence"]) for m in parsed["messages"]])
+        self.assertEqual([(self.thread1.id, self.participant2.id, True), (self.thread3.id, self.participant1.id, False)], [(p["thread"], p["participant"], p["is_active"]) for p in parsed["participations"]])
+        # the client syncs again until it has everything
+        self.p1.date_left = None
+        self.p1.save()
+        with override_settings(REST_MESSAGING_SYNC_LIMIT=1):
+            parsed = parse_json_response(self.client_authenticated.get(url, data={"cursor": cursor}).data)
+            self.assertEqual(([m1.id], True), ([m["id"] for m in parsed["messages"]], parsed["has_more"]))
+            parsed = parse_json_response(self.client_authenticated.get(url, data={"cursor": parsed["cursor"]}).data)
+            self.assertEqual(([m2.id], False), ([m["id"] for m in parsed["messages"]], parsed["has_more"]))
+
+    def test_sync_overlap(self):
+        url = "{0}sync/".format(self.url)
+        # a message committed after a later one: the previous sync received the later one only
+        m1 = Message.objects.create(sender=self.participant2, thread=self.thread1, body="hi")
+        m2 = Message.objects.create(sender=self.participant3, thread=self.thread3, body="hi")
+        self.participation2.date_last_check = now()
+        self.participation2.save(update_fields=['date_last_check'])
+        cursor = encode_sync_cursor(m2.id, now())
+        with override_settings(REST_MESSAGING_SYNC_OVERLAP=0):
+            parsed = parse_json_response(self.client_authenticated.get(url, data={"cursor": cursor}).data)
+        self.assertEqual(([], []), (parsed["messages"], parsed["participations"]))
+        # the changes of the overlap are sent again
+        parsed = parse_json_response(self.client_authenticated.get(url, data={"cursor": cursor}).data)
+        self.assertTrue(m1.id in [m["id"] for m in parsed["messages"]])
+        self.assertTrue((self.thread1.id, self.participant2.id) in [(p["thread"], p["participant"]) for p in parsed["participations"]])
+        # the pages of the sync move forward
+        with override_settings(REST_MESSAGING_SYNC_LIMIT=1):
+            ids = []
+            has_more = True
+            while has_more:
+                parsed = parse_json_response(self.client_authenticated.get(url, data={"cursor": cursor}).data)
+                ids.extend(m["id"] for m in parsed["messages"])
+                cursor, has_more = parsed["cursor"], parsed["has_more"]
+        self.assertEqual(sorted(set(ids)), ids)
+        self.assertTrue(m1.id in ids)
+        # the next sync starts after the last message received
+        self.assertEqual(m2.id, decode_sync_cursor(cursor)[0])
+
+    def test_long_poll(self):
+        url = "{0}long_poll/".format(self.url)
+        self.assertEqual(501, self.client_authenticated.get(url).status_code)
+        events._event_buses.clear()
+        with override_settings(REST_MESSAGING_EVENT_BUS='rest_messaging.events.InProcessEventBus'):
+            self.assertEqual(403, self.client_unauthenticated.get(url).status_code)
+            for data in [{"cursor": "a"}, {"cursor": "nan"}, {"timeout": "nan"}, {"timeout": "inf"}, {"timeout": "-inf"}]:
+                self.assertEqual(400, self.client_authenticated.get(url, data=data).status_code)
+            # nothing happens
+            response = self.client_authenticated.get(url, data={"timeout": 0})
+            self.assertEqual({"cursor": 0, "events": []}, parse_json_response(response.data))
+            # a message is posted, waiting for it costs no query but the session and the user
+            with commit_callbacks():
+                message = Message.objects.create(sender=self.participant2, thread=self.thread1, body="hi")
+            with self.assertNumQueries(2):
+                response = self.client_authenticated.get(url, data={"cursor": 0})
+            parsed = parse_json_response(response.data)
+            self.assertEqual(1, parsed["cursor"])
+            self.assertEqual([message.id], [event["message"] for event in parsed["events"]])
+            # the messages of the threads the participant is not in
+            with commit_callbacks():
+                Message.objects.create(sender=self.participant4, thread=self.thread_unrelated, body="hi")
+            response = self.client_authenticated.get(url, data={"cursor": 1, "timeout": 0})
+            self.assertEqual({"cursor": 1, "events": []}, parse_json_response(response.data))
+
     def test_post_message(self):
         # no authentication
         response = self.client_unauthenticated.post("{0}{1}/post_message/".format(self.url, self.thread1.id), data={})
@@ -224,6 +447,34 @@ class MessageViewTests(TestScenario):
         self.assertTrue(parsed["body"] == last_message.body == body)
         self.assertEqual(parsed["sender"], self.participant1.id)
 
+    def test_bulk_post_messages(self):
+        url = "{0}bulk_post_messages/".format(self.url)
+        messages = [{"thread": self.thread1.id, "body": "a"}, {"thread": self.thread3.id, "body": "b"}]
+        # no authentication
+        response = self.client_unauthenticated.post(url, data={"messages": json.dumps(messages)})
+        self.assertEqual(403, response.status_code)
+        # no permission
+        response = self.client_authenticated.post(url, data={"messages": json.dumps(messages + [{"thread": self.thread_unrelated.id, "body": "c"}])})
+        self.assertEqual(403, response.status_code)
+        # malformed
+        for data in [{}, {"messages": "["}, {"messages": json.dumps([{"thread": self.thread1.id}])}, {"messages": json.dumps([{"thread": self.thread1.id, "body": ""}])}]:
+            response = self.client_authenticated.post(url, data=data)
+            self.assertEqual(400, response.status_code)
+        self.assertEqual(0, Message.objects.filter(body__in=["a", "b", "c"]).count())
+        # ok
+        response = self.client_authenticated.post(url, data={"messages": json.dumps(messages)})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual({"count": 2, "threads": [self.thread1.id, self.thread3.id]}, parse_json_response(response.data))
+        self.assertEqual(2, Message.objects.filter(sender=self.participant1, body__in=["a", "b"]).count())
+        # daily limit
+        with override_settings(REST_MESSAGING_DAILY_LIMIT_CALLBACK=lambda *args, **kwargs: 6):
+            response = self.client_authenticated.post(url, data={"messages": json.dumps(messages)})
+        self.assertEqual(412, response.status_code)
+        # too many messages
+        with override_settings(REST_MESSAGING_BULK_POST_MAX_MESSAGES=1):
+            response = self.client_authenticated.post(url, data={"messages": json.dumps(messages)})
+        self.assertEqual(400, response.status_code)
+
     def test_list_messages_in_thread(self):
         # no authentication
         response = self.client_unauthenticated.get("{0}{1}/list_messages_in_thread/".format(self.url, self.thread1.id))
@@ -233,10 +484,10 @@ class MessageViewTests(TestScenario):
         self.assertEqual(403, response.status_code)
         # ok
         # participant 3 has read the 2 last messages, 1 only the first
-        p1 = Participation.objects.create(participant=self.participant3, thread=self.thread3)
+        p1 = self.p2  # participant 3 in thread 3
         p1.date_last_check = now() - timedelta(days=1)
         p1.save()
-        p2 = Participation.objects.create(participant=self.participant1, thread=self.thread3)
+        p2 = self.p1  # participant 1 in thread 3
         p2.date_last_check = now() - timedelta(days=2)
         p2.save()
         # we change the date of the messages
@@ -250,6 +501,106 @@ class MessageViewTests(TestScenario):
         self.assertEqual([self.m33.id, self.m32.id, self.m31.id], [m["id"] for m in messages])
         self.assertEqual([set([]), set([self.participant3.id]), set([self.participant1.id, self.participant3.id])], [set(m["readers"]) for m in messages])
 
+    def test_fast_serialization(self):
+        # the rows are serialized as the messages
+        self.m31.sent_at = now() - timedelta(days=3)
+        self.m31.save()
+        thread_url = "{0}{1}/list_messages_in_thread/".format(self.url, self.thread3.id)
+        requests = [
+            (self.url, {}),
+            (self.url, {"read_state": "watermarks"}),
+            (self.url, {"check_notifications": ""}),
+            (thread_url, {}),
+            (thread_url, {"read_state": "watermarks"}),
+            (thread_url, {"pagination": "cursor"}),
+            (thread_url, {"before": self.m33.id}),
+        ]
+        self.client_authenticated.get(self.url)  # the participant is cached
+        for url, data in requests:
+            with CaptureQueriesContext(connection) as queries:
+                expected = self.client_authenticated.get(url, data=data)
+            with override_settings(REST_MESSAGING_FAST_SERIALIZATION=True):
+                with CaptureQueriesContext(connection) as fast_queries:
+                    response = self.client_authenticated.get(url, data=data)
+            # the participants are not prefetched for the rows
+            self.assertTrue(len(fast_queries) <= len(queries))
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(parse_json_response(expected.data), parse_json_response(response.data))
+        self.assertTrue(self.m31.id in [message["id"] for message in parse_json_response(response.data)["results"]])
+
+    def test_list_messages_in_thread_read_watermarks(self):
+        self.m31.sent_at = now() - timedelta(days=3)
+        self.m31.save()
+        url = "{0}{1}/list_messages_in_thread/".format(self.url, self.thread3.id)
+        for data in [{"read_state": "watermarks"}, {"read_state": "watermarks", "pagination": "cursor"}]:
+            response = self.client_authenticated.get(url, data=data)
+            self.assertEqual(200, response.status_code)
+            parsed = parse_json_response(response.data)
+            self.assertEqual([self.m33.id, self.m32.id, self.m31.id], [m["id"] for m in parsed["results"]])
+            self.assertFalse(any("readers" in m for m in parsed["results"]))
+            self.assertEqual([(self.participant1.id, self.m31.id), (self.participant3.id, self.m31.id)], [(w["participant"], w["last_read_message_id"]) for w in parsed["watermarks"]])
+
+    def test_list_messages_in_thread_bounded_by_page_size(self):
+        # the readers are checked for the page only: fetching the first page of a thread
+        # instantiates one page of messages and costs the same whatever the size of the thread
+        instantiated = []
+
+        def count_instances(sender, instance, **kwargs):
+            instantiated.append(instance)
+
+        url = "{0}{1}/list_messages_in_thread/".format(self.url, self.thread1.id)
+        # we warm the participant cache of the middleware and the cache of the participations
+        self.client_authenticated.get(url)
+        for count in [100, 300]:
+            Message.objects.bulk_create([Message(sender=self.participant2, thread=self.thread1, body="hi") for i in range(count)])
+            post_init.connect(count_instances, sender=Message)
+            try:
+                with self.assertNumQueries(5):
+                    response = self.client_authenticated.get(url)
+            finally:
+                post_init.disconnect(count_instances, sender=Message)
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(30, len(parse_json_response(response.data)["results"]))
+            self.assertEqual(30, len(instantiated))
+            del instantiated[:]
+
+    def test_list_messages_in_thread_cursor_pagination(self):
+        # 65 messages in thread 1 (1 in setUp)
+        for i in range(64):
+            Message.objects.create(sender=self.participant2, thread=self.thread1, body="hi {0}".format(i))
+        ids = list(Message.objects.filter(thread=self.thread1).order_by('-id').values_list('id', flat=True))
+        url = "{0}{1}/list_messages_in_thread/".format(self.url, self.thread1.id)
+        # first page
+        response = self.client_authenticated.get(url, data={"pagination": "cursor"})
+        self.assertEqual(200, response.status_code)
+        page1 = parse_json_response(response.data)
+        self.assertEqual(ids[:30], [m["id"] for m in page1["results"]])
+        self.assertEqual(None, page1["previous"])
+        self.assertTrue("before={0}".format(ids[29]) in page1["next"])
+        # the pages cost the same number of queries wherever they are in the thread
+        with self.assertNumQueries(4):
+            response = self.client_authenticated.get(page1["next"])
+        page2 = parse_json_response(response.data)
+        self.assertEqual(ids[30:60], [m["id"] for m in page2["results"]])
+        with self.assertNumQueries(4):
+            response = self.client_authenticated.get(page2["next"])
+        page3 = parse_json_response(response.data)
+        self.assertEqual(ids[60:], [m["id"] for m in page3["results"]])
+        self.assertEqual(None, page3["next"])
+        # we go back to the more recent messages
+        response = self.client_authenticated.get(page3["previous"])
+        self.assertEqual(ids[30:60], [m["id"] for m in parse_json_response(response.data)["results"]])
+        response = self.client_authenticated.get(url, data={"after": ids[31]})
+        parsed = parse_json_response(response.data)
+        self.assertEqual(ids[1:31], [m["id"] for m in parsed["results"]])
+        self.assertTrue("after={0}".format(ids[1]) in parsed["previous"])
+        self.assertTrue("before={0}".format(ids[30]) in parsed["next"])
+        # the readers are set
+        self.assertTrue(all("readers" in m for m in parsed["results"]))
+        # invalid cursor
+        response = self.client_authenticated.get(url, data={"before": "abc"})
+        self.assertEqual(400, response.status_code)
+
 
 class TestMessageNotificationCheckView(TestScenario):
 
@@ -3,7 +3,10 @@
 # vim: set fileencoding=utf8 :
 
 from __future__ import unicode_literals
+from contextlib import contextmanager
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
 from django.utils.six import BytesIO
 from django.utils.timezone import now, timedelta
 from rest_framework.parsers import JSONParser
@@ -12,10 +15,33 @@ from rest_framework.test import APIClient, APIRequestFactory, APITestCase
 from rest_messaging.models import Message, NotificationCheck, Participant, Participation, Thread
 
 
+@contextmanager
+def commit_callbacks():
+    """ The tests run in a transaction which is never committed: runs the transaction.on_commit callbacks registered in the block, as if it was committed. """
+    if not hasattr(connection, 'run_on_commit'):  # Django 1.8 runs them at once
+        yield
+        return
+    # the list is replaced when a savepoint is rolled back
+    start = len(connection.run_on_commit)
+    yield
+    while len(connection.run_on_commit) > start:
+        registered = connection.run_on_commit[start:]
+        connection.run_on_commit = connection.run_on_commit[:start]
+        for savepoint_ids, func in registered:
+            func()
+
+
 class TestScenario(APITestCase):
     """ Defaults for testing. """
 
     def setUp(self):
+        # the ids are reused from one test to another, we do not want anything cached by a previous test
+        cache.clear()
+        # the scenario is used as if it was committed
+        with commit_callbacks():
+            self.create_scenario()
+
+    def create_scenario(self):
         # we create a user and a client
         password = "password"
         self.user = User(username="User")